@@ -0,0 +1,234 @@
+"""Long-lived worker keeping the analysis stack loaded, running the jobs of thin clients sent over a Unix socket."""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import traceback
+
+# Commands run by the worker and the scripts providing them
+COMMANDS = {
+    "remove_background": "remove_background.py",
+    "analyze": "analyze.py",
+}
+
+
+def default_socket_path():
+    """
+    Returns the socket of the worker of the current user
+
+    Returns:
+        str: Path in the runtime directory of the user, or in the temporary directory if it is not set
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"audio-latency-tester-{os.getuid()}.sock")
+
+
+def run_command(command, args):
+    """
+    Runs a command line interface in the current process
+
+    Args:
+        command (str): Name of the command, one of COMMANDS
+        args (List[str]): Command line arguments
+
+    Returns:
+        int: Exit code of the command
+    """
+    argv = sys.argv
+    # The usage messages show the name of the script providing the command
+    sys.argv = [COMMANDS[command], *args]
+    try:
+        if command == "remove_background":
+            import remove_background
+            remove_background.main(args)
+        else:
+            from automated_test import analyze
+            analyze.main.main(args=args, prog_name=COMMANDS[command])
+    except SystemExit as error:
+        if error.code is None or isinstance(error.code, int):
+            return error.code or 0
+        print(error.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.argv = argv
+    return 0
+
+
+def warm_up():
+    """
+    Loads the modules used by the commands, including the parts of librosa loaded on first use
+    """
+    import librosa
+    import numpy as np
+    import soundfile  # noqa: F401
+
+    import remove_background  # noqa: F401
+    from automated_test import analyze  # noqa: F401
+
+    samples = np.zeros(4096, dtype=np.float32)
+    librosa.istft(librosa.stft(samples))
+    librosa.resample(samples, orig_sr=44100, target_sr=16000)
+
+
+class MessageWriter(io.TextIOBase):
+    """ Text stream forwarding the output of a job to the client, as JSON messages """
+
+    def __init__(self, connection, stream):
+        """
+        Args:
+            connection (socket.socket): Connection with the client
+            stream (str): Name of the redirected stream, "stdout" or "stderr"
+        """
+        self.connection = connection
+        self.stream = stream
+
+    @property
+    def encoding(self):
+        return "utf-8"
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        # Rejecting bytes makes click recognize a text stream
+        if not isinstance(text, str):
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        if text:
+            send_message(self.connection, {self.stream: text})
+        return len(text)
+
+
+def send_message(connection, message):
+    """
+    Sends a JSON message terminated by a newline
+
+    Args:
+        connection (socket.socket): Connection with the other side
+        message (dict): Message to be sent
+    """
+    connection.sendall(json.dumps(message).encode() + b"\n")
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """ Runs the job requested in a connection, streaming its output back """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            command, args, cwd = request["command"], request["args"], request["cwd"]
+        except (ValueError, KeyError, TypeError):
+            send_message(self.connection, {"stderr": "Malformed job request\n"})
+            send_message(self.connection, {"exit_code": 2})
+            return
+        if command not in COMMANDS:
+            send_message(self.connection, {"stderr": f"Unknown command {command}\n"})
+            send_message(self.connection, {"exit_code": 2})
+            return
+
+        # The jobs run one at a time, in the working directory of the client
+        previous_cwd = os.getcwd()
+        stdout = MessageWriter(self.connection, "stdout")
+        stderr = MessageWriter(self.connection, "stderr")
+        try:
+            os.chdir(cwd)
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                exit_code = run_command(command, args)
+            send_message(self.connection, {"exit_code": exit_code})
+        except OSError as error:
+            # The client went away or its working directory is not accessible
+            print(f"Job {command} failed: {error}", file=sys.stderr)
+        finally:
+            os.chdir(previous_cwd)
+
+
+def serve(socket_path):
+    """
+    Loads the analysis stack and runs the jobs sent to the socket until interrupted
+
+    Args:
+        socket_path (str): Path of the Unix socket to listen on
+    """
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                # Left behind by a worker which was killed
+                os.unlink(socket_path)
+            else:
+                sys.exit(f"A worker is already listening on {socket_path}")
+
+    warm_up()
+    with socketserver.UnixStreamServer(socket_path, JobHandler) as server:
+        os.chmod(socket_path, 0o600)
+        print(f"Listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+
+def submit(socket_path, command, args):
+    """
+    Runs a command in the worker, or in the current process if no worker is listening
+
+    Args:
+        socket_path (str): Path of the Unix socket of the worker
+        command (str): Name of the command, one of COMMANDS
+        args (List[str]): Command line arguments
+
+    Returns:
+        int: Exit code of the command
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        print(f"No worker listening on {socket_path}, running {command} locally", file=sys.stderr)
+        return run_command(command, args)
+
+    with connection:
+        send_message(connection, {"command": command, "args": args, "cwd": os.getcwd()})
+        for line in connection.makefile("rb"):
+            message = json.loads(line)
+            if "exit_code" in message:
+                return message["exit_code"]
+            stream = sys.stdout if "stdout" in message else sys.stderr
+            stream.write(message.get("stdout", message.get("stderr")))
+            stream.flush()
+
+    print("The worker closed the connection before the job finished", file=sys.stderr)
+    return 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run remove_background.py and analyze.py jobs in a long-lived worker, which keeps NumPy, "
+                    "librosa and the analysis modules loaded between the runs")
+    parser.add_argument("--socket", default=default_socket_path(),
+                        help="Unix socket of the worker (default: %(default)s)")
+    parser.add_argument("command", choices=["serve", *COMMANDS],
+                        help="Start the worker, or run a command in it with the following arguments")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments of the command")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.socket)
+    else:
+        sys.exit(submit(args.socket, args.command, args.args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import audio_controller
 from pathlib import Path
+from threading import Thread
+from timestamp_log import BINARY, LOG_SUFFIXES, TEXT
 import argparse
 
 
@@ -10,20 +12,42 @@ def main():
     )
     parser.add_argument(
         "--timestamps-file",
-        help="File where timestamp values will be written (default: timestamps.log)",
+        help="File where timestamp values will be written "
+        "(default: timestamps-capture.bin, or .log in the text format)",
+    )
+    parser.add_argument(
+        "--timestamps-format",
+        choices=[BINARY, TEXT],
+        default=BINARY,
+        help="Format of the timestamps log: binary with a header per run, "
+        "or text with a timestamp per line (default: binary)",
     )
     parser.add_argument(
         "--duration",
-        help="Length of the capture in seconds (default: max available length)",
+        help="Length of the capture in seconds "
+        "(default: max available length, or until Ctrl+C with --stream)",
     )
     parser.add_argument(
         "--volume",
         help="Volume multiplier (default: 100)",
     )
+    parser.add_argument(
+        "--threaded",
+        action="store_true",
+        help="Write the WAV file in a separate thread while the samples are received",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Receive the samples as they are recorded, without the length limit of the "
+        "device memory, until the --duration is reached or Ctrl+C is pressed",
+    )
     args = parser.parse_args()
+    if args.stream and args.threaded:
+        parser.error("--threaded is not available with --stream")
 
     timestamps_file = (
-        "timestamps-capture.log"
+        "timestamps-capture" + LOG_SUFFIXES[args.timestamps_format]
         if args.timestamps_file is None
         else args.timestamps_file
     )
@@ -32,9 +56,35 @@ def main():
     volume = 100 if args.volume is None else int(args.volume)
 
     ac = audio_controller.AudioController()
-    ac.start_recording(
-        Path(args.file), Path(timestamps_file), volume=volume, duration_s=duration
-    )
+
+    def record():
+        ac.start_recording(
+            Path(args.file),
+            Path(timestamps_file),
+            volume=volume,
+            duration_s=duration,
+            threaded=args.threaded,
+            timestamps_format=args.timestamps_format,
+            stream=args.stream,
+        )
+
+    if not args.stream:
+        record()
+        return
+
+    # The stream is stopped from the main thread, which receives Ctrl+C,
+    # so the recorder still receives the end of the stream and saves the timestamps
+    recorder = Thread(target=record)
+    recorder.start()
+    try:
+        while recorder.is_alive():
+            recorder.join(0.5)
+    except KeyboardInterrupt:
+        print("Stopping the stream")
+        # A stop is ignored until the recorder starts the stream, it is repeated until the recorder returns
+        while recorder.is_alive():
+            ac.stop_recording()
+            recorder.join(0.5)
 
 
 if __name__ == "__main__":
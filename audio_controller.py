@@ -4,23 +4,75 @@ from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
+from typing import Callable
 
+import array
+import queue
+import threading
+import time
 import usb.core
+import usb.util
 import wave
 import struct
 import math
 
+import numpy as np
+
+from timestamp_log import (
+    BINARY,
+    TIMESTAMP_DTYPE,
+    TimestampRun,
+    append_run,
+    decode_timestamps,
+)
+from wav_reader import open_wav
+
 NUMBER_OF_CHANNELS = 8
 NUMBER_OF_ADC_IN_GPIO = 4
 
 CFG_PACKET_MAGIC_HDR = 0x50534341
 TIMESTAMP_PACKET_MAGIC_HDR = 0x50534342
+READY_PACKET_MAGIC_HDR = 0x50534343
+STREAM_PACKET_MAGIC_HDR = 0x50534344
+STREAM_END_PACKET_MAGIC_HDR = 0x50534345
+STOP_PACKET_MAGIC_HDR = 0x50534346
+STREAM_TIMESTAMPS_MAGIC_HDR = 0x50534347
 USB_PACKET_SIZE = 64
+# Largest bulk transfer issued at once, libusb splits it into USB_PACKET_SIZE packets
+USB_TRANSFER_SIZE = 256 * USB_PACKET_SIZE
+USB_TIMEOUT_MS = 5000
+# Number of USB_TRANSFER_SIZE buffers in the ring of the threaded pipelines,
+# 0.5 s of 44.1 kHz stereo audio
+RING_BUFFER_COUNT = 8
 USB_VENDOR_ID = 0xCAFE
 USB_PRODUCT_ID_PLAYBACK = 0x4010
 USB_PRODUCT_ID_CAPTURE = 0x4011
 
 CAPTURE_MAX_SAMPLE_COUNT = 64000
+# Number of samples per timestamped buffer of the firmware
+CAPTURE_SAMPLES_PER_BUFFER = 16
+PLAYBACK_SAMPLES_PER_BUFFER = 32
+# Packets received per transfer while streaming, 32 ms of 16 kHz audio
+STREAM_TRANSFER_PACKETS = 32
+# Layout of the stream_packet_t packets, each carrying a timestamped buffer of capture samples
+STREAM_PACKET_DTYPE = np.dtype(
+    [
+        ("id", "<u4"),
+        ("sequence", "<u4"),
+        ("timestamp", TIMESTAMP_DTYPE),
+        ("samples", "<i2", (CAPTURE_SAMPLES_PER_BUFFER,)),
+        ("padding", "V16"),
+    ]
+)
+# Layout of the stream_timestamps_packet_t packets, sent by the playback device while streaming
+STREAM_PACKET_TIMESTAMPS = 7
+STREAM_TIMESTAMPS_PACKET_DTYPE = np.dtype(
+    [
+        ("id", "<u4"),
+        ("count", "<u4"),
+        ("timestamps", TIMESTAMP_DTYPE, (STREAM_PACKET_TIMESTAMPS,)),
+    ]
+)
 
 
 class FixedArray(object):
@@ -44,6 +96,457 @@ class FixedArray(object):
         self.array[index] = value
 
 
+def read_bulk(endpoint, size: int, timeout: int = USB_TIMEOUT_MS) -> bytearray:
+    """Reads data sent in USB_PACKET_SIZE packets with large multi-packet bulk transfers.
+
+    Args:
+        endpoint: Bulk IN endpoint to read from.
+        size (int): Number of bytes to read, a multiple of USB_PACKET_SIZE.
+        timeout (int): Timeout of each transfer in milliseconds.
+
+    Returns:
+        The received data.
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    # pyusb reads into whole arrays, the transfer buffer is reused and copied into place
+    transfer = array.array("B", bytes(min(size, USB_TRANSFER_SIZE)))
+    for offset in range(0, size, USB_TRANSFER_SIZE):
+        length = min(USB_TRANSFER_SIZE, size - offset)
+        if length != len(transfer):
+            transfer = array.array("B", bytes(length))
+        received = endpoint.read(transfer, timeout=timeout)
+        if received != length:
+            raise RuntimeError(f"Short USB transfer: {received} of {length} bytes")
+        view[offset : offset + length] = transfer
+    return data
+
+
+def write_bulk(endpoint, data, timeout: int = USB_TIMEOUT_MS):
+    """Writes data with large multi-packet bulk transfers.
+
+    The device receives it in USB_PACKET_SIZE packets, the same way as written packet by packet.
+
+    Args:
+        endpoint: Bulk OUT endpoint to write to.
+        data: Buffer with the data to send.
+        timeout (int): Timeout of each transfer in milliseconds.
+    """
+    view = memoryview(data).cast("B")
+    for offset in range(0, len(view), USB_TRANSFER_SIZE):
+        endpoint.write(view[offset : offset + USB_TRANSFER_SIZE], timeout=timeout)
+
+
+def wait_ready(endpoint, timeout: int = USB_TIMEOUT_MS):
+    """Waits for the capture device to confirm it is configured and armed.
+
+    Args:
+        endpoint: Bulk IN endpoint to read from.
+        timeout (int): Timeout in milliseconds.
+    """
+    ready_packet_raw = endpoint.read(USB_PACKET_SIZE, timeout=timeout)
+    (ready_header,) = struct.unpack("I", ready_packet_raw[:4])
+
+    if ready_header != READY_PACKET_MAGIC_HDR:
+        raise RuntimeError("Malformed ready packet header")
+
+
+def read_timestamps(endpoint, timeout: int = USB_TIMEOUT_MS) -> np.ndarray:
+    """Reads the timestamps sent by a device after a run.
+
+    Args:
+        endpoint: Bulk IN endpoint to read from.
+        timeout (int): Timeout of each transfer in milliseconds.
+
+    Returns:
+        Timestamps of the audio buffers in microseconds.
+    """
+    timestamp_packet_raw = endpoint.read(USB_PACKET_SIZE, timeout=timeout)
+    timestamp_header, timestamp_count = struct.unpack("II", timestamp_packet_raw[:8])
+
+    if timestamp_header != TIMESTAMP_PACKET_MAGIC_HDR:
+        raise RuntimeError("Malformed timestamp packet header")
+
+    print(f"Number of timestamps: {timestamp_count}")
+
+    # The timestamps are sent 8 per packet, the last packet padded
+    packet_count = math.ceil(timestamp_count / 8)
+    raw = read_bulk(endpoint, packet_count * USB_PACKET_SIZE, timeout)
+    return decode_timestamps(raw, timestamp_count)
+
+
+def read_stream(
+    endpoint_in,
+    endpoint_out,
+    consume: Callable[[memoryview], None],
+    stop: threading.Event,
+    sample_count: int | None = None,
+    timeout: int = USB_TIMEOUT_MS,
+) -> tuple[np.ndarray, int]:
+    """Receives the samples streamed by the capture device until the stream is stopped.
+
+    Once stopped, a stop packet is sent and the buffers already queued by the device are received
+    up to its end packet.
+
+    Args:
+        endpoint_in: Bulk IN endpoint to read from.
+        endpoint_out: Bulk OUT endpoint receiving the stop packet.
+        consume (Callable): Called with the samples of each transfer, which are only valid during the call.
+        stop (threading.Event): Stops the stream once set, e.g. from another thread.
+        sample_count (int): Number of samples after which the stream is stopped, None streams until `stop` is set.
+        timeout (int): Timeout of each transfer in milliseconds.
+
+    Returns:
+        Timestamps of the received buffers and the number of buffers dropped by the device.
+    """
+    transfer = array.array("B", bytes(STREAM_TRANSFER_PACKETS * USB_PACKET_SIZE))
+    timestamps = []
+    received = 0
+    dropped = 0
+    next_sequence = None
+    stopping = False
+    while True:
+        if not stopping and (
+            stop.is_set() or (sample_count is not None and received >= sample_count)
+        ):
+            endpoint_out.write(struct.pack("I60x", STOP_PACKET_MAGIC_HDR), timeout=timeout)
+            stopping = True
+
+        if stopping:
+            # Read packet by packet, a larger transfer would wait for data after the end packet
+            raw = endpoint_in.read(USB_PACKET_SIZE, timeout=timeout)
+            length = len(raw)
+        else:
+            raw = transfer
+            length = endpoint_in.read(transfer, timeout=timeout)
+
+        packets = np.frombuffer(raw, dtype=STREAM_PACKET_DTYPE, count=length // USB_PACKET_SIZE)
+        if len(packets) == 0:
+            continue
+        if stopping and packets["id"][0] == STREAM_END_PACKET_MAGIC_HDR:
+            break
+        if np.any(packets["id"] != STREAM_PACKET_MAGIC_HDR):
+            raise RuntimeError("Malformed stream packet header")
+
+        # The sequence counts the buffers filled by the microphone, gaps are buffers the device could not send
+        sequence = packets["sequence"].astype(np.int64)
+        if next_sequence is not None:
+            dropped += int(sequence[0] - next_sequence)
+        dropped += int(np.sum(np.diff(sequence) - 1))
+        next_sequence = sequence[-1] + 1
+
+        if sample_count is not None:
+            packets = packets[: -(-(sample_count - received) // CAPTURE_SAMPLES_PER_BUFFER)]
+        samples = packets["samples"].reshape(-1)
+        if sample_count is not None:
+            samples = samples[: sample_count - received]
+        if len(samples):
+            timestamps.append(packets["timestamp"].copy())
+            consume(memoryview(samples).cast("B"))
+            received += len(samples)
+
+    if not timestamps:
+        return np.empty(0, dtype=TIMESTAMP_DTYPE), dropped
+    return np.concatenate(timestamps), dropped
+
+
+def read_stream_timestamps(
+    endpoint, timeout: int = USB_TIMEOUT_MS
+) -> tuple[np.ndarray, int]:
+    """Receives the timestamps sent by the playback device while it plays a stream.
+
+    Args:
+        endpoint: Bulk IN endpoint to read from.
+        timeout (int): Timeout of each transfer in milliseconds.
+
+    Returns:
+        Timestamps of the played buffers and the number of times the device ran out of samples.
+    """
+    timestamps = []
+    while True:
+        raw = endpoint.read(USB_PACKET_SIZE, timeout=timeout)
+        packet = np.frombuffer(raw, dtype=STREAM_TIMESTAMPS_PACKET_DTYPE, count=1)[0]
+        if packet["id"] == STREAM_END_PACKET_MAGIC_HDR:
+            break
+        if packet["id"] != STREAM_TIMESTAMPS_MAGIC_HDR:
+            raise RuntimeError("Malformed stream timestamps packet header")
+        timestamps.append(packet["timestamps"][: packet["count"]].copy())
+
+    underruns = int(packet["count"])
+    if not timestamps:
+        return np.empty(0, dtype=TIMESTAMP_DTYPE), underruns
+    return np.concatenate(timestamps), underruns
+
+
+@dataclass
+class PipelineStats:
+    """Counters of a threaded transfer pipeline."""
+
+    transfers: int = 0
+    bytes: int = 0
+    # Highest number of filled buffers waiting for the consumer
+    max_queue_depth: int = 0
+    # Waits of the producer for a free buffer: the consumer fell behind and the ring was full
+    producer_stalls: int = 0
+    # Waits of the consumer for a filled buffer: the producer fell behind and the ring was empty
+    consumer_stalls: int = 0
+
+    def __str__(self):
+        return (
+            f"{self.transfers} transfers, {self.bytes} bytes, "
+            f"max queue depth {self.max_queue_depth}, "
+            f"{self.producer_stalls} producer stalls, "
+            f"{self.consumer_stalls} consumer stalls"
+        )
+
+
+class BufferRing:
+    """Bounded ring of reusable transfer buffers passed from a producer thread to a consumer thread."""
+
+    def __init__(self, count: int = RING_BUFFER_COUNT, size: int = USB_TRANSFER_SIZE):
+        """Allocates the buffers.
+
+        Args:
+            count (int): Number of buffers, the most data the producer can be ahead of the consumer.
+            size (int): Size of each buffer in bytes.
+        """
+        self.size = size
+        self.stats = PipelineStats()
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for _ in range(count):
+            self._free.put(array.array("B", bytes(size)))
+
+    def queue_depth(self) -> int:
+        """Returns the number of filled buffers waiting for the consumer."""
+        return self._filled.qsize()
+
+    def acquire(self) -> array.array:
+        """Takes a free buffer for the producer, waiting for the consumer if there is none."""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            self.stats.producer_stalls += 1
+            return self._free.get()
+
+    def publish(self, buffer: array.array, length: int):
+        """Passes the first `length` bytes of a filled buffer to the consumer."""
+        self._filled.put((buffer, length))
+        self.stats.transfers += 1
+        self.stats.bytes += length
+        self.stats.max_queue_depth = max(self.stats.max_queue_depth, self._filled.qsize())
+
+    def finish(self):
+        """Tells the consumer that no more buffers follow."""
+        self._filled.put(None)
+
+    def consume(self) -> tuple[array.array, int] | None:
+        """Takes the next filled buffer for the consumer, waiting for the producer if there is none.
+
+        Returns:
+            The buffer and the length of its data, or None once the producer has finished.
+        """
+        try:
+            return self._filled.get_nowait()
+        except queue.Empty:
+            self.stats.consumer_stalls += 1
+            return self._filled.get()
+
+    def release(self, buffer: array.array):
+        """Returns a consumed buffer to the producer."""
+        self._free.put(buffer)
+
+
+def read_threaded(
+    endpoint,
+    size: int,
+    consume: Callable[[memoryview], None],
+    ring: BufferRing | None = None,
+    timeout: int = USB_TIMEOUT_MS,
+) -> PipelineStats:
+    """Reads data with bulk transfers while a separate thread consumes it.
+
+    The calling thread drains the endpoint into the buffers of a ring and a consumer thread
+    passes them to `consume`, so slow file writes do not delay the USB reads until the ring is full.
+
+    Args:
+        endpoint: Bulk IN endpoint to read from.
+        size (int): Number of bytes to read, a multiple of USB_PACKET_SIZE.
+        consume (Callable): Called in the consumer thread with each received chunk,
+            which is only valid during the call.
+        ring (BufferRing): Buffers of the pipeline, None allocates the default ring.
+        timeout (int): Timeout of each transfer in milliseconds.
+
+    Returns:
+        Counters of the pipeline.
+    """
+    ring = ring or BufferRing()
+    errors = []
+
+    def consumer():
+        while (item := ring.consume()) is not None:
+            buffer, length = item
+            # After an error the buffers are still released, so that the producer is not blocked
+            if not errors:
+                try:
+                    consume(memoryview(buffer)[:length])
+                except Exception as e:
+                    errors.append(e)
+            ring.release(buffer)
+
+    thread = threading.Thread(target=consumer, name="capture-consumer")
+    thread.start()
+    try:
+        for offset in range(0, size, ring.size):
+            length = min(ring.size, size - offset)
+            buffer = ring.acquire()
+            # pyusb reads into whole arrays, the last transfer goes through a smaller one
+            target = buffer if length == len(buffer) else array.array("B", bytes(length))
+            received = endpoint.read(target, timeout=timeout)
+            if received != length:
+                raise RuntimeError(f"Short USB transfer: {received} of {length} bytes")
+            if target is not buffer:
+                buffer[:length] = target
+            ring.publish(buffer, length)
+    finally:
+        ring.finish()
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return ring.stats
+
+
+def write_threaded(
+    endpoint, data, ring: BufferRing | None = None, timeout: int = USB_TIMEOUT_MS
+) -> PipelineStats:
+    """Writes data with bulk transfers while a separate thread reads it ahead.
+
+    A producer thread copies the data, e.g. memory-mapped samples paged in from the disk,
+    into the buffers of a ring and the calling thread sends them, so slow file reads do not delay
+    the USB writes until the ring is empty.
+
+    Args:
+        endpoint: Bulk OUT endpoint to write to.
+        data: Buffer with the data to send.
+        ring (BufferRing): Buffers of the pipeline, None allocates the default ring.
+        timeout (int): Timeout of each transfer in milliseconds.
+
+    Returns:
+        Counters of the pipeline.
+    """
+    ring = ring or BufferRing()
+    view = memoryview(data).cast("B")
+    errors = []
+
+    def producer():
+        try:
+            for offset in range(0, len(view), ring.size):
+                chunk = view[offset : offset + ring.size]
+                buffer = ring.acquire()
+                memoryview(buffer)[: len(chunk)] = chunk
+                ring.publish(buffer, len(chunk))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            ring.finish()
+
+    thread = threading.Thread(target=producer, name="playback-producer")
+    thread.start()
+    try:
+        while (item := ring.consume()) is not None:
+            buffer, length = item
+            # After an error the buffers are still released, so that the producer is not blocked
+            if not errors:
+                try:
+                    endpoint.write(memoryview(buffer)[:length], timeout=timeout)
+                except Exception as e:
+                    errors.append(e)
+            ring.release(buffer)
+    finally:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return ring.stats
+
+
+@dataclass
+class UsbDevice:
+    """USB device of the latency tester with the endpoints of its vendor interface."""
+
+    device: usb.core.Device
+    ep_in: usb.core.Endpoint
+    ep_out: usb.core.Endpoint
+
+
+def open_device(product_id: int) -> UsbDevice:
+    """Locates a device of the latency tester and resolves its endpoints.
+
+    Args:
+        product_id (int): USB product ID, USB_PRODUCT_ID_PLAYBACK or USB_PRODUCT_ID_CAPTURE.
+
+    Returns:
+        The located device.
+    """
+    dev = usb.core.find(idVendor=USB_VENDOR_ID, idProduct=product_id)
+    if dev is None:
+        raise ValueError("USB Device not found")
+
+    cfg = dev[0]
+    intf = cfg[(0, 0)]
+    return UsbDevice(dev, intf[1], intf[0])
+
+
+class DeviceSession:
+    """Devices kept open across runs, so back-to-back measurements only send the configuration packet.
+
+    The interfaces are claimed on the first transfer and released by `close`.
+    """
+
+    def __init__(
+        self,
+        product_ids: tuple[int, ...] = (USB_PRODUCT_ID_PLAYBACK, USB_PRODUCT_ID_CAPTURE),
+        devices: dict[int, UsbDevice] | None = None,
+    ):
+        """
+        Args:
+            product_ids (tuple): USB product IDs of the devices to open.
+            devices (dict): Devices to use instead of opening them, e.g. from `device_simulator`,
+                keyed by product ID. They are not released by `close`.
+        """
+        self.devices: dict[int, UsbDevice] = {}
+        if devices is not None:
+            self.devices.update(devices)
+            self._opened = False
+            return
+
+        self._opened = True
+        try:
+            for product_id in product_ids:
+                self.devices[product_id] = open_device(product_id)
+        except Exception:
+            self.close()
+            raise
+
+    def device(self, product_id: int) -> UsbDevice | None:
+        """Returns an open device of the session, None if it was not opened or the session is closed."""
+        return self.devices.get(product_id)
+
+    def close(self):
+        """Releases the interfaces and the handles of the devices."""
+        if self._opened:
+            for device in self.devices.values():
+                usb.util.dispose_resources(device.device)
+        self.devices.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class DeviceShutdownDuration(Enum):
     """Enum class for device shutdown options."""
 
@@ -352,16 +855,57 @@ class AudioController:
 
     adc_controller: ADCController
     amplifier_controller: AmplifierController
+    # Counters of the last threaded capture and playback
+    capture_stats: PipelineStats | None = None
+    playback_stats: PipelineStats | None = None
+    # Devices reused by the runs, None locates the device again in each run
+    session: DeviceSession | None = None
+    # Set by `stop_recording` to end the current streaming recording
+    _stop_stream: threading.Event
+    # Whether a streaming recording is running, guarded by `_stream_lock` along with the stop event
+    _streaming: bool = False
 
     def __init__(
         self,
         adc_controller: ADCController | None = None,
         amplifier_controller: AmplifierController | None = None,
+        session: DeviceSession | None = None,
     ):
         if adc_controller is not None:
             self.adc_controller = adc_controller
         if amplifier_controller is not None:
             self.amplifier_controller = amplifier_controller
+        if session is not None:
+            self.session = session
+        self._stop_stream = threading.Event()
+        self._stream_lock = threading.Lock()
+
+    def open_session(
+        self,
+        product_ids: tuple[int, ...] = (USB_PRODUCT_ID_PLAYBACK, USB_PRODUCT_ID_CAPTURE),
+    ) -> DeviceSession:
+        """Opens the devices once for the following recordings and playbacks.
+
+        Args:
+            product_ids (tuple): USB product IDs of the devices to open.
+
+        Returns:
+            The session, closing it with `close` or a `with` block makes the runs locate the devices again.
+        """
+        self.close_session()
+        self.session = DeviceSession(product_ids)
+        return self.session
+
+    def close_session(self):
+        """Closes the devices opened by `open_session`."""
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def _device(self, product_id: int) -> UsbDevice:
+        """Returns the device of the session, or locates it if it is not open."""
+        device = self.session.device(product_id) if self.session is not None else None
+        return device if device is not None else open_device(product_id)
 
     def start_recording(
         self,
@@ -372,6 +916,12 @@ class AudioController:
         duration_s: float | None = None,
         volume: int = 100,
         use_trigger: bool = False,
+        threaded: bool = False,
+        on_samples: Callable[[memoryview], None] | None = None,
+        on_ready: Callable[[], None] | None = None,
+        timestamps_format: str = BINARY,
+        run_id: int | None = None,
+        stream: bool = False,
     ):
         """Starts recording audio data.
 
@@ -379,79 +929,124 @@ class AudioController:
             filename (str): Name of the file to save the recording to.
             file_format (str): Format of the file to save the recording to.
             override_existing_file (bool): Whether to override existing file with the same name.
-            duration_s (float): Duration of the recording in seconds. If None, recording will continue until `stop_recording` is called.
+            duration_s (float): Duration of the recording in seconds. If None, CAPTURE_MAX_SAMPLE_COUNT samples are recorded,
+                or the stream continues until `stop_recording` is called.
+            threaded (bool): Whether to write the file in a separate thread while the samples are received,
+                the counters of the pipeline are kept in `capture_stats`. Not available while streaming.
+            on_samples (Callable): Called with each chunk of received samples in the threaded and streaming modes,
+                e.g. for analysis.
+            on_ready (Callable): Called once the device is armed, with `use_trigger` it waits for the trigger from then on.
+            timestamps_format (str): Format of the timestamps log, "binary" or "text", see `timestamp_log`.
+            run_id (int): Identifier of the run in the binary timestamps log, None uses the current time in ns.
+            stream (bool): Whether the device sends the samples as they are recorded, without the length limit
+                of its memory. The call returns once the stream is stopped by `stop_recording` or `duration_s`.
         """
+        if stream and threaded:
+            raise ValueError("The threaded pipeline is not available while streaming")
 
         sample_rate = 16000
         sample_depth = 2
         channels_count = 1
 
-        samples_count = CAPTURE_MAX_SAMPLE_COUNT
-
-        if duration_s is not None:
-            samples_count = min(
-                samples_count, int(duration_s * channels_count * sample_rate)
+        if stream:
+            # Stopped by the host, the device does not need to know the length
+            samples_count = (
+                None
+                if duration_s is None
+                else int(duration_s * channels_count * sample_rate)
             )
+        else:
+            samples_count = CAPTURE_MAX_SAMPLE_COUNT
 
-        try:
-            # Locate the USB device
-            dev = usb.core.find(
-                idVendor=USB_VENDOR_ID, idProduct=USB_PRODUCT_ID_CAPTURE
-            )
-            if dev is None:
-                raise ValueError("USB Device not found")
+            if duration_s is not None:
+                samples_count = min(
+                    samples_count, int(duration_s * channels_count * sample_rate)
+                )
+
+        if stream:
+            # Stops requested while no stream was running are discarded
+            with self._stream_lock:
+                self._stop_stream.clear()
+                self._streaming = True
 
-            cfg = dev[0]
-            intf = cfg[(0, 0)]
-            ep_in, ep_out = intf[1], intf[0]
+        try:
+            # Locate the USB device, unless it is kept open by the session
+            device = self._device(USB_PRODUCT_ID_CAPTURE)
+            ep_in, ep_out = device.ep_in, device.ep_out
 
             # Prepare and send configuration packet
             config_data = struct.pack(
-                "IIIIIII",
+                "IIIIIIII",
                 CFG_PACKET_MAGIC_HDR,
-                samples_count,
+                samples_count or 0,
                 sample_rate,
                 sample_depth,
                 channels_count,
                 volume,
                 int(use_trigger),
+                int(stream),
             )
             ep_out.write(config_data)
 
+            wait_ready(ep_in)
+            if on_ready is not None:
+                on_ready()
+
             with wave.open(str(filename), "w") as wavfile:
                 wavfile.setnchannels(1)
                 wavfile.setsampwidth(2)
                 wavfile.setframerate(16000)
 
-                packet_count = math.ceil(
-                    samples_count * sample_depth * channels_count / USB_PACKET_SIZE
-                )
-                for _ in range(packet_count):
-                    samples_raw = ep_in.read(USB_PACKET_SIZE, timeout=5000)
-                    wavfile.writeframes(samples_raw)
-
-            # Read timestamp packet
-            timestamp_packet_raw = ep_in.read(USB_PACKET_SIZE, timeout=5000)
-            timestamp_header, timestamp_count = struct.unpack(
-                "II", timestamp_packet_raw[:8]
+                if stream:
+
+                    def write_stream(chunk: memoryview):
+                        wavfile.writeframes(chunk)
+                        if on_samples is not None:
+                            on_samples(chunk)
+
+                    timestamps, dropped = read_stream(
+                        ep_in, ep_out, write_stream, self._stop_stream, samples_count
+                    )
+                    print(f"Number of timestamps: {len(timestamps)}")
+                    if dropped:
+                        print(f"Warning: {dropped} buffers dropped by the device")
+                else:
+                    # The samples are sent in whole packets, the last one padded
+                    samples_size = samples_count * sample_depth * channels_count
+                    packet_count = math.ceil(samples_size / USB_PACKET_SIZE)
+
+                    if threaded:
+                        written = 0
+
+                        def write_samples(chunk: memoryview):
+                            nonlocal written
+                            chunk = chunk[: samples_size - written]
+                            wavfile.writeframes(chunk)
+                            written += len(chunk)
+                            if on_samples is not None:
+                                on_samples(chunk)
+
+                        self.capture_stats = read_threaded(
+                            ep_in, packet_count * USB_PACKET_SIZE, write_samples
+                        )
+                        print(f"Capture pipeline: {self.capture_stats}")
+                    else:
+                        samples_raw = read_bulk(ep_in, packet_count * USB_PACKET_SIZE)
+                        wavfile.writeframes(memoryview(samples_raw)[:samples_size])
+
+            if not stream:
+                timestamps = read_timestamps(ep_in)
+
+                ep_in.read(USB_PACKET_SIZE)  # Acknowledge final packet
+
+            run = TimestampRun(
+                USB_PRODUCT_ID_CAPTURE,
+                time.time_ns() if run_id is None else run_id,
+                sample_rate,
+                CAPTURE_SAMPLES_PER_BUFFER,
+                timestamps,
             )
-
-            if timestamp_header != TIMESTAMP_PACKET_MAGIC_HDR:
-                raise RuntimeError("Malformed timestamp packet header")
-
-            print(f"Number of timestamps: {timestamp_count}")
-
-            # Read timestamps
-            timestamps = []
-            for _ in range(math.ceil(timestamp_count / 8)):
-                timestamp_raw = ep_in.read(USB_PACKET_SIZE)
-                timestamps.extend(struct.unpack("QQQQQQQQ", timestamp_raw))
-
-            ep_in.read(USB_PACKET_SIZE)  # Acknowledge final packet
-
-            with open(str(timestamps_filename), "a") as f:
-                for ts in timestamps:
-                    f.write(f"{ts}\n")
+            append_run(timestamps_filename, run, timestamps_format)
 
         except usb.core.USBError as e:
             print(f"USB Error: {e}")
@@ -463,10 +1058,21 @@ class AudioController:
             print("Error: Failed to unpack data (possibly malformed packet).")
         except Exception as e:
             print(f"Unexpected error: {e}")
+        finally:
+            if stream:
+                with self._stream_lock:
+                    self._streaming = False
+                    self._stop_stream.clear()
 
     def stop_recording(self):
-        """Stops recording audio data."""
-        pass
+        """Stops a streaming recording, `start_recording` returns once the device ended the stream.
+
+        Can be called from another thread while `start_recording` runs. Does nothing while no stream is running,
+        so the next stream is not affected.
+        """
+        with self._stream_lock:
+            if self._streaming:
+                self._stop_stream.set()
 
     def play_audio(
         self,
@@ -474,76 +1080,105 @@ class AudioController:
         timestamps_filename: Path = "timestamps.log",
         volume: int = 2000,
         use_trigger: bool = True,
+        threaded: bool = False,
+        timestamps_format: str = BINARY,
+        run_id: int | None = None,
+        stream: bool = False,
     ):
-        """Plays audio from a file through a USB device."""
-        try:
-            # Locate the USB device
-            dev = usb.core.find(
-                idVendor=USB_VENDOR_ID, idProduct=USB_PRODUCT_ID_PLAYBACK
-            )
-            if dev is None:
-                raise ValueError("USB Device not found")
-
-            cfg = dev[0]
-            intf = cfg[(0, 0)]
-            ep_in, ep_out = intf[1], intf[0]
-
-            # Open the WAV file
-            with wave.open(str(filename), "rb") as wav_file:
-                channels = wav_file.getnchannels()
-                framerate = wav_file.getframerate()
-                sampwidth = wav_file.getsampwidth()
-                frame_count = wav_file.getnframes()
-
-                print(f"Channels: {channels}")
-                print(f"Sampling Frequency: {framerate} Hz")
-                print(f"Sample Count: {frame_count}")
-                print(f"Depth (bytes per sample): {sampwidth}")
-                print(f"use trigger: {use_trigger}")
-
-                # Prepare and send configuration packet
-                config_data = struct.pack(
-                    "IIIIIII",
-                    CFG_PACKET_MAGIC_HDR,
-                    frame_count,
-                    framerate,
-                    sampwidth,
-                    channels,
-                    volume,
-                    int(use_trigger),
-                )
-                ep_out.write(config_data)
-
-                frames_per_packet = USB_PACKET_SIZE // (sampwidth * channels)
-                print(f"Frames per packet: {frames_per_packet}")
+        """Plays audio from a file through a USB device.
 
-                # Stream audio frames
-                while frames := wav_file.readframes(frames_per_packet):
-                    ep_out.write(frames)
+        Args:
+            filename (Path): WAV file to play.
+            timestamps_filename (Path): Log the timestamps of the played buffers are appended to.
+            volume (int): Volume multiplier.
+            use_trigger (bool): Whether to trigger the capture device when the playback starts.
+            threaded (bool): Whether to read the file in a separate thread while the samples are sent,
+                the counters of the pipeline are kept in `playback_stats`.
+            timestamps_format (str): Format of the timestamps log, "binary" or "text", see `timestamp_log`.
+            run_id (int): Identifier of the run in the binary timestamps log, None uses the current time in ns.
+            stream (bool): Whether the device plays the samples from a ring buffer while they are sent, instead of
+                receiving the whole file first. The file length is then not limited by the memory of the device.
+        """
+        try:
+            # Locate the USB device, unless it is kept open by the session
+            device = self._device(USB_PRODUCT_ID_PLAYBACK)
+            ep_in, ep_out = device.ep_in, device.ep_out
+
+            # Open the WAV file, the samples are memory-mapped
+            wav_file = open_wav(filename)
+            channels = wav_file.channels
+            framerate = wav_file.sample_rate
+            sampwidth = wav_file.sample_width
+            frame_count = wav_file.frame_count
+
+            print(f"Channels: {channels}")
+            print(f"Sampling Frequency: {framerate} Hz")
+            print(f"Sample Count: {frame_count}")
+            print(f"Depth (bytes per sample): {sampwidth}")
+            print(f"use trigger: {use_trigger}")
 
-            # Read timestamp packet
-            timestamp_packet_raw = ep_in.read(USB_PACKET_SIZE, timeout=5000)
-            timestamp_header, timestamp_count = struct.unpack(
-                "II", timestamp_packet_raw[:8]
+            # Prepare and send configuration packet
+            config_data = struct.pack(
+                "IIIIIIII",
+                CFG_PACKET_MAGIC_HDR,
+                frame_count,
+                framerate,
+                sampwidth,
+                channels,
+                volume,
+                int(use_trigger),
+                int(stream),
             )
+            ep_out.write(config_data)
 
-            if timestamp_header != TIMESTAMP_PACKET_MAGIC_HDR:
-                raise RuntimeError("Malformed timestamp packet header")
-
-            print(f"Number of timestamps: {timestamp_count}")
-
-            # Read timestamps
-            timestamps = []
-            for _ in range(math.ceil(timestamp_count / 8)):
-                timestamp_raw = ep_in.read(USB_PACKET_SIZE)
-                timestamps.extend(struct.unpack("QQQQQQQQ", timestamp_raw))
-
-            ep_in.read(USB_PACKET_SIZE)  # Acknowledge final packet
-
-            # Display timestamps
-            with open(str(timestamps_filename), "a") as f:
-                for ts in timestamps:
-                    f.write(f"{ts}\n")
+            frames_per_packet = USB_PACKET_SIZE // (sampwidth * channels)
+            print(f"Frames per packet: {frames_per_packet}")
+
+            if stream:
+                # The device sends the timestamps while it plays, they are received in a separate thread
+                received = {}
+
+                def receive_timestamps():
+                    try:
+                        received["timestamps"] = read_stream_timestamps(ep_in)
+                    except Exception as e:
+                        received["error"] = e
+
+                receiver = threading.Thread(target=receive_timestamps)
+                receiver.start()
+
+            try:
+                # Stream audio frames, the device reads them as a contiguous stream of packets.
+                # While streaming, the writes are held back by the device whenever its ring buffer is full.
+                if threaded:
+                    self.playback_stats = write_threaded(ep_out, wav_file.raw)
+                    print(f"Playback pipeline: {self.playback_stats}")
+                else:
+                    write_bulk(ep_out, wav_file.raw)
+            finally:
+                if stream:
+                    receiver.join()
+
+            if stream:
+                if "error" in received:
+                    raise received["error"]
+                timestamps, underruns = received["timestamps"]
+                print(f"Number of timestamps: {len(timestamps)}")
+                if underruns:
+                    print(f"Warning: the device ran out of samples {underruns} times")
+            else:
+                timestamps = read_timestamps(ep_in)
+
+                ep_in.read(USB_PACKET_SIZE)  # Acknowledge final packet
+
+            run = TimestampRun(
+                USB_PRODUCT_ID_PLAYBACK,
+                time.time_ns() if run_id is None else run_id,
+                framerate,
+                PLAYBACK_SAMPLES_PER_BUFFER,
+                timestamps,
+            )
+            append_run(timestamps_filename, run, timestamps_format)
 
         except usb.core.USBError as e:
             print(f"USB Error: {e}")
@@ -21,6 +21,7 @@
 #define MAX_CHANNEL_COUNT	1
 
 #define SAMPLES_PER_BUFFER	16
+_Static_assert(SAMPLES_PER_BUFFER == STREAM_PACKET_SAMPLES, "a stream packet carries a single buffer");
 
 #define RX_DATA_SIZE		(MAX_SAMPLE_COUNT * MAX_CHANNEL_COUNT * MAX_BYTES_PER_SAMPLE)
 #define TIMESTAMPS_ENTRIES	(MAX_SAMPLE_COUNT / SAMPLES_PER_BUFFER)
@@ -45,11 +46,14 @@ const struct pdm_microphone_config config = {
 
 int16_t sample_buffer[SAMPLES_PER_BUFFER];
 volatile int samples_read = 0;
+// Number of buffers filled by the microphone, gaps in the stream sequence show dropped buffers
+volatile uint32_t buffers_filled = 0;
 
 enum stream_state {
 	IDLE,
 	RECORDING,
 	TRANSFER,
+	STREAMING,
 };
 
 struct stream_desc {
@@ -60,6 +64,7 @@ struct stream_desc {
 	uint32_t channels_count;
 	uint32_t volume_multiplier;
 	uint32_t use_trigger;
+	uint32_t stream;
 
 	enum stream_state state;
 	struct audio_buffer_pool *audio_buffer_pool;
@@ -109,13 +114,46 @@ void wait_for_trigger() {
 		;
 }
 
+static void arm(struct stream_desc *sd)
+{
+	ready_packet_t ready_packet = {
+		.id = READY_PACKET_MAGIC_HDR,
+	};
+
+	// Lets the host start the playback as soon as the capture is armed
+	usb_write((uint8_t *) &ready_packet, sizeof(ready_packet));
+
+	if (sd->use_trigger) {
+		printf("waiting for rising edge on GPIO%d\r\n", GPIO_TRIGGER_PIN);
+		wait_for_trigger();
+	}
+}
+
+static bool stop_requested(void)
+{
+	stop_packet_t stop_packet = {0};
+
+	if (!tud_vendor_available()) {
+		return false;
+	}
+
+	tud_vendor_read(&stop_packet, sizeof(stop_packet));
+	tud_vendor_read_flush();
+
+	if (stop_packet.id != STOP_PACKET_MAGIC_HDR) {
+		printf("expected stop packet!\r\n");
+		return false;
+	}
+	return true;
+}
+
 static void vendor_task(struct stream_desc *sd)
 {
 	switch (sd->state) {
 
 	case IDLE:
 	{
-		cfg_packet_t cfg_packet;
+		cfg_packet_t cfg_packet = {0};
 
 		usb_read(&cfg_packet, sizeof(cfg_packet));
 
@@ -127,8 +165,10 @@ static void vendor_task(struct stream_desc *sd)
 			printf("channels_count: %d\r\n", cfg_packet.channels_count);
 			printf("volume multiplier: 0x%x\r\n", cfg_packet.volume_multiplier);
 			printf("use trigger: %d\r\n", cfg_packet.use_trigger);
+			printf("stream: %d\r\n", cfg_packet.stream);
 
-			if (cfg_packet.sample_count != 0 &&
+			// The length of a stream is not known in advance
+			if ((cfg_packet.stream || cfg_packet.sample_count != 0) &&
 					cfg_packet.sample_rate != 0 &&
 					cfg_packet.sample_depth != 0 &&
 					cfg_packet.channels_count != 0) {
@@ -139,6 +179,7 @@ static void vendor_task(struct stream_desc *sd)
 				sd->channels_count = cfg_packet.channels_count;
 				sd->volume_multiplier = cfg_packet.volume_multiplier;
 				sd->use_trigger = cfg_packet.use_trigger;
+				sd->stream = cfg_packet.stream;
 
 				printf("configuration passed!\r\n");
 
@@ -146,7 +187,7 @@ static void vendor_task(struct stream_desc *sd)
 				memset(timestamps, 0x00, sizeof(timestamps));
         pdm_microphone_set_filter_volume(sd->volume_multiplier);
 
-				sd->state = RECORDING;
+				sd->state = sd->stream ? STREAMING : RECORDING;
 			} else {
 				printf("configuration failed!\r\n");
 			}
@@ -157,10 +198,7 @@ static void vendor_task(struct stream_desc *sd)
 	}
 	case RECORDING:
 	{
-		if (sd->use_trigger) {
-			printf("waiting for rising edge on GPIO%d\r\n", GPIO_TRIGGER_PIN);
-			wait_for_trigger();
-		}
+		arm(sd);
 
 		int buffer_count =  1 + ((sd->sample_count - 1) / (SAMPLES_PER_BUFFER));
 
@@ -220,6 +258,46 @@ static void vendor_task(struct stream_desc *sd)
 		printf("Timestamps transfer finished\r\n");
 
 
+		sd->state = IDLE;
+		break;
+	}
+	case STREAMING:
+	{
+		stream_packet_t packet = {
+			.id = STREAM_PACKET_MAGIC_HDR,
+		};
+		uint32_t sent = 0;
+
+		arm(sd);
+
+		// Each buffer is sent as soon as it is filled, until the host sends a stop packet
+		samples_read = 0;
+		while (!stop_requested()) {
+			while (samples_read == 0) {
+				usb_housekeeping();
+			}
+			packet.timestamp = time_us_64();
+			packet.sequence = buffers_filled;
+
+			for (int i = 0; i < SAMPLES_PER_BUFFER; i++) {
+				packet.samples[i] = sample_buffer[i];
+			}
+
+			samples_read = 0;
+
+			usb_write((uint8_t *) &packet, sizeof(packet));
+			sent++;
+		}
+
+		stream_packet_t end_packet = {
+			.id = STREAM_END_PACKET_MAGIC_HDR,
+			.sequence = sent,
+		};
+
+		usb_write((uint8_t *) &end_packet, sizeof(end_packet));
+
+		printf("Stream finished, buffers sent: %d\r\n", sent);
+
 		sd->state = IDLE;
 		break;
 	}
@@ -233,6 +311,7 @@ static void vendor_task(struct stream_desc *sd)
 
 void on_pdm_samples_ready() {
   samples_read = pdm_microphone_read(sample_buffer, SAMPLES_PER_BUFFER);
+  buffers_filled++;
 }
 
 int main(void)
@@ -24,6 +24,11 @@
 
 #define RX_DATA_SIZE		(MAX_SAMPLE_COUNT * MAX_CHANNEL_COUNT * MAX_BYTES_PER_SAMPLE)
 #define TIMESTAMPS_ENTRIES	(MAX_SAMPLE_COUNT / SAMPLES_PER_BUFFER)
+#define BUFFER_SIZE		(SAMPLES_PER_BUFFER * MAX_CHANNEL_COUNT * MAX_BYTES_PER_SAMPLE)
+
+// While streaming, rx_data is a ring of buffers and the playback starts once a quarter of it is filled,
+// about 0.27 s of 44.1 kHz stereo samples
+#define STREAM_PREFILL_SIZE	(RX_DATA_SIZE / 4)
 
 uint8_t rx_data[RX_DATA_SIZE];
 uint64_t timestamps[TIMESTAMPS_ENTRIES];
@@ -32,6 +37,7 @@ enum stream_state {
 	IDLE,
 	TRANSFER,
 	STREAMING,
+	RING_STREAMING,
 };
 
 struct stream_desc {
@@ -42,6 +48,7 @@ struct stream_desc {
 	uint32_t channels_count;
 	uint32_t volume_multiplier;
 	uint32_t use_trigger;
+	uint32_t stream;
 
 	enum stream_state state;
 	struct audio_buffer_pool *audio_buffer_pool;
@@ -129,6 +136,45 @@ static void trigger_audio_capture()
 	gpio_put(GPIO_TRIGGER_PIN, 1);
 }
 
+/* Scales a buffer of stereo samples into an audio buffer and queues it for playback, returns its timestamp */
+static uint64_t play_buffer(struct stream_desc *sd, struct audio_buffer *buffer,
+			    const int16_t *samples_src, int valid_count)
+{
+	int16_t *samples_dst = (int16_t *)buffer->buffer->bytes;
+
+	buffer->sample_count = SAMPLES_PER_BUFFER;
+	assert(buffer->sample_count);
+	assert(buffer->max_sample_count >= buffer->sample_count);
+
+	for (int i = 0; i < SAMPLES_PER_BUFFER * 2; i++) {
+		samples_dst[i] = i < valid_count
+			? (int16_t) ((samples_src[i] * sd->volume_multiplier) >> 15u)
+			: 0;
+	}
+
+	if (sd->use_trigger) {
+		trigger_audio_capture();
+	}
+	uint64_t timestamp = time_us_64();
+	give_audio_buffer(sd->audio_buffer_pool, buffer);
+
+	return timestamp;
+}
+
+static void send_stream_timestamps(uint32_t first, uint32_t count)
+{
+	stream_timestamps_packet_t packet = {
+		.id = STREAM_TIMESTAMPS_MAGIC_HDR,
+		.count = count,
+	};
+
+	for (uint32_t i = 0; i < count; i++) {
+		packet.timestamps[i] = timestamps[(first + i) % TIMESTAMPS_ENTRIES];
+	}
+
+	usb_write((uint8_t *) &packet, sizeof(packet));
+}
+
 static int configure(cfg_packet_t *cfg_packet, struct stream_desc *sd)
 {
 	if (cfg_packet->id != CFG_PACKET_MAGIC_HDR) {
@@ -142,6 +188,7 @@ static int configure(cfg_packet_t *cfg_packet, struct stream_desc *sd)
 	printf("channels_count: %d\r\n", cfg_packet->channels_count);
 	printf("volume multiplier: 0x%x\r\n", cfg_packet->volume_multiplier);
 	printf("use_trigger: %d\r\n", cfg_packet->use_trigger);
+	printf("stream: %d\r\n", cfg_packet->stream);
 
 	size_t rx_buffer_needed = cfg_packet->sample_count * cfg_packet->sample_depth
 				  * cfg_packet->channels_count;
@@ -155,7 +202,9 @@ static int configure(cfg_packet_t *cfg_packet, struct stream_desc *sd)
 		return -ENOTSUP;
 	}
 
-	if (rx_buffer_needed > RX_DATA_SIZE || timestamps_buffer_needed > TIMESTAMPS_ENTRIES) {
+	// A stream is played from a ring buffer, whatever its length
+	if (!cfg_packet->stream
+			&& (rx_buffer_needed > RX_DATA_SIZE || timestamps_buffer_needed > TIMESTAMPS_ENTRIES)) {
 		return -ENOMEM;
 	}
 
@@ -165,6 +214,7 @@ static int configure(cfg_packet_t *cfg_packet, struct stream_desc *sd)
 	sd->channels_count = cfg_packet->channels_count;
 	sd->volume_multiplier = cfg_packet->volume_multiplier;
 	sd->use_trigger = cfg_packet->use_trigger;
+	sd->stream = cfg_packet->stream;
 
 	// Update sample rate, cast is needed to override const
 	((struct audio_format *) sd->audio_buffer_pool->format)->sample_freq = sd->sample_rate;
@@ -178,7 +228,7 @@ static void vendor_task(struct stream_desc *sd)
 
 	case IDLE:
 	{
-		cfg_packet_t cfg_packet;
+		cfg_packet_t cfg_packet = {0};
 
 		usb_read(&cfg_packet, sizeof(cfg_packet));
 		int configured = configure(&cfg_packet, sd);
@@ -189,7 +239,7 @@ static void vendor_task(struct stream_desc *sd)
 			memset(rx_data, 0x00, sizeof(rx_data));
 			memset(timestamps, 0x00, sizeof(timestamps));
 
-			sd->state = TRANSFER;
+			sd->state = sd->stream ? RING_STREAMING : TRANSFER;
 		}
 		if (configured == -ENOTSUP) {
 			printf("configuration failed!\r\n");
@@ -224,21 +274,8 @@ static void vendor_task(struct stream_desc *sd)
 			struct audio_buffer *buffer = take_audio_buffer(sd->audio_buffer_pool, true);
 
 			int16_t *samples_src = (int16_t *)rx_data + SAMPLES_PER_BUFFER * j * 2;
-			int16_t *samples_dst = (int16_t *)buffer->buffer->bytes;
 
-			buffer->sample_count = SAMPLES_PER_BUFFER;
-			assert(buffer->sample_count);
-			assert(buffer->max_sample_count >= audio_buffer->sample_count);
-
-			for (int i = 0; i < SAMPLES_PER_BUFFER * 2; i++) {
-				samples_dst[i] = (int16_t) ((samples_src[i] * sd->volume_multiplier) >> 15u);
-			}
-
-			if (sd->use_trigger) {
-				trigger_audio_capture();
-			}
-			timestamps[j] = time_us_64();
-			give_audio_buffer(sd->audio_buffer_pool, buffer);
+			timestamps[j] = play_buffer(sd, buffer, samples_src, SAMPLES_PER_BUFFER * 2);
 		}
 
 		timestamp_packet_t ts_packet = {
@@ -259,6 +296,84 @@ static void vendor_task(struct stream_desc *sd)
 		sd->state = IDLE;
 		break;
 	}
+	case RING_STREAMING:
+	{
+		uint32_t rx_len =
+			sd->sample_count *
+			sd->sample_depth *
+			sd->channels_count;
+		uint32_t buffer_count =  1 + ((sd->sample_count - 1) / (SAMPLES_PER_BUFFER));
+
+		// Bytes received into the ring, buffers played from it and timestamps sent to the host
+		uint32_t received = 0;
+		uint32_t played = 0;
+		uint32_t reported = 0;
+		uint32_t underruns = 0;
+		bool playing = false;
+		bool starved = false;
+
+		while (reported < buffer_count) {
+			usb_housekeeping();
+
+			// Packets are only taken while the ring has room for them, until then the host is NAKed
+			while (received < rx_len
+					&& received - played * BUFFER_SIZE + USB_BULK_PACKET_SIZE <= RX_DATA_SIZE
+					&& tud_vendor_available()) {
+				received += tud_vendor_read(&rx_data[received % RX_DATA_SIZE], USB_BULK_PACKET_SIZE);
+				tud_vendor_read_flush();
+			}
+
+			if (!playing && (received >= rx_len || received >= STREAM_PREFILL_SIZE)) {
+				printf("prefill done, starting playback\r\n");
+				playing = true;
+			}
+
+			// The timestamps ring is not overwritten before its entries are sent
+			if (playing && played < buffer_count && played - reported < TIMESTAMPS_ENTRIES) {
+				uint32_t buffer_start = played * BUFFER_SIZE;
+
+				if (received >= buffer_start + BUFFER_SIZE || received >= rx_len) {
+					struct audio_buffer *buffer = take_audio_buffer(sd->audio_buffer_pool, false);
+
+					if (buffer) {
+						int16_t *samples_src = (int16_t *) &rx_data[buffer_start % RX_DATA_SIZE];
+						int valid_count = MIN(BUFFER_SIZE, rx_len - buffer_start) / MAX_BYTES_PER_SAMPLE;
+
+						timestamps[played % TIMESTAMPS_ENTRIES] =
+							play_buffer(sd, buffer, samples_src, valid_count);
+						played++;
+						starved = false;
+					}
+				} else if (!starved) {
+					// The host fell behind the playback
+					underruns++;
+					starved = true;
+				}
+			}
+
+			uint32_t pending = played - reported;
+
+			if ((pending >= STREAM_PACKET_TIMESTAMPS || (played == buffer_count && pending > 0))
+					&& tud_vendor_write_available() >= USB_BULK_PACKET_SIZE) {
+				uint32_t count = MIN(pending, STREAM_PACKET_TIMESTAMPS);
+
+				send_stream_timestamps(reported, count);
+				reported += count;
+			}
+		}
+
+		stream_timestamps_packet_t end_packet = {
+			.id = STREAM_END_PACKET_MAGIC_HDR,
+			.count = underruns,
+		};
+
+		usb_write((uint8_t *) &end_packet, sizeof(end_packet));
+
+		printf("stream finished, underruns: %d, return to idle\r\n", underruns);
+
+		sd->state = IDLE;
+		break;
+	}
 	default:
 
 		printf("unknown state, reverting to idle\r\n");
@@ -1,5 +1,6 @@
 import audio_controller
 from pathlib import Path
+from timestamp_log import BINARY, LOG_SUFFIXES, TEXT
 import argparse
 
 
@@ -7,23 +8,50 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("file", help="Filename of the WAV file to play")
     parser.add_argument(
-        "--timestamps-file", help="File where timestamp values will be written"
+        "--timestamps-file",
+        help="File where timestamp values will be written "
+        "(default: timestamps-playback.bin, or .log in the text format)",
+    )
+    parser.add_argument(
+        "--timestamps-format",
+        choices=[BINARY, TEXT],
+        default=BINARY,
+        help="Format of the timestamps log: binary with a header per run, "
+        "or text with a timestamp per line (default: binary)",
     )
     parser.add_argument(
         "--volume",
         help="Volume multiplier (default: 2000)",
     )
+    parser.add_argument(
+        "--threaded",
+        action="store_true",
+        help="Read the WAV file in a separate thread while the samples are sent",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Start the playback while the file is being sent, without the length "
+        "limit of the device memory",
+    )
     args = parser.parse_args()
 
     timestamps_file = (
-        "timestamps-playback.log"
+        "timestamps-playback" + LOG_SUFFIXES[args.timestamps_format]
         if args.timestamps_file is None
         else args.timestamps_file
     )
     volume = 2000 if args.volume is None else int(args.volume)
 
     ac = audio_controller.AudioController()
-    ac.play_audio(Path(args.file), Path(timestamps_file), volume=volume)
+    ac.play_audio(
+        Path(args.file),
+        Path(timestamps_file),
+        volume=volume,
+        threaded=args.threaded,
+        timestamps_format=args.timestamps_format,
+        stream=args.stream,
+    )
 
 
 if __name__ == "__main__":
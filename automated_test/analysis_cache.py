@@ -0,0 +1,158 @@
+""" On-disk cache of per-file analysis results, keyed by file content and analysis settings """
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# Default upper bound of the total size of the cache entries
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+
+def default_cache_dir():
+    """ Returns the default location of the analysis cache
+
+    Returns:
+        Path: Directory in the user cache directory
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "audio-latency-tester" / "analysis"
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    """ Computes the SHA-256 digest of a file content, reading it in chunks
+
+    Args:
+        file_path (str): Path to the file
+        chunk_size (int): Number of bytes read at once
+
+    Returns:
+        str: Hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """ Directory of JSON analysis results and NumPy arrays with least recently used eviction
+
+    Each entry is stored in its own file, written atomically, so the cache can be shared by
+    concurrent worker processes. Reading an entry marks it as recently used.
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_CACHE_SIZE):
+        """ Initializes the cache
+
+        Args:
+            directory (str): Directory holding the cache entries, created if needed
+            max_size (int): Upper bound of the total size of the entries in bytes
+        """
+        self.directory = Path(directory) if directory is not None else default_cache_dir()
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, digests, settings):
+        """ Builds the cache key of an analysis
+
+        Args:
+            digests (Sequence[str]): Content digests of the analyzed files
+            settings (dict): Parameters affecting the analysis result
+
+        Returns:
+            str: Cache key
+        """
+        description = json.dumps({"files": list(digests), "settings": settings}, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _entry_path(self, key, suffix=".json"):
+        return self.directory / f"{key}{suffix}"
+
+    def _write(self, path, write):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def get(self, key):
+        """ Reads an entry from the cache
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            dict: Stored analysis result or None if it is not cached
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        """ Stores an entry in the cache and evicts the least recently used entries above the size limit
+
+        Args:
+            key (str): Cache key
+            entry (dict): JSON-serializable analysis result
+        """
+        self._write(self._entry_path(key), lambda f: f.write(json.dumps(entry).encode()))
+
+    def get_array(self, key):
+        """ Reads an array from the cache
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            np.ndarray: Stored array, memory-mapped, or None if it is not cached
+        """
+        path = self._entry_path(key, ".npy")
+        try:
+            array = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return array
+
+    def put_array(self, key, array):
+        """ Stores an array in the cache and evicts the least recently used entries above the size limit
+
+        Args:
+            key (str): Cache key
+            array (np.ndarray): Array to be stored
+        """
+        self._write(self._entry_path(key, ".npy"), lambda f: np.save(f, array))
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in its size limit """
+        entries = []
+        for path in [*self.directory.glob("*.json"), *self.directory.glob("*.npy")]:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
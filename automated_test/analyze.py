@@ -1,8 +1,82 @@
 #!/bin/env python3
 
 import click
+import concurrent.futures
+import contextlib
+import functools
+import json
+from dataclasses import dataclass
+import numpy as np
+import os
 import struct
+import sys
 import wave
+from pathlib import Path
+
+# Modules shared with the host scripts are located in the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from wav_reader import open_wav  # noqa: E402
+from automated_test import profiling  # noqa: E402
+from automated_test.analysis_cache import AnalysisCache, DEFAULT_CACHE_SIZE, file_digest  # noqa: E402
+from automated_test.latency_stats import LatencyStats  # noqa: E402
+from automated_test.resampling import FILTER_HALF_WIDTH, KAISER_BETA, resample  # noqa: E402
+from automated_test.results_store import MATCHED, UNMATCHED, ResultsStore  # noqa: E402
+import remove_background  # noqa: E402
+
+# Fraction of the peak sample value above which a sample is treated as sound
+THRESHOLD_RATIO = 0.6
+# Runs of silent samples shorter than this are patched over (adjust this if needed)
+MIN_GAP_SAMPLES = 50
+# Detected sounds shorter than this are discarded
+MIN_SOUND_SAMPLES = 10
+# Number of samples read at once by the streaming detector
+STREAM_BLOCK_SIZE = 1 << 16
+# Channel selections analyzing the samples in file order, the average of the channels and each channel separately
+INTERLEAVED = "interleaved"
+MIX = "mix"
+ALL_CHANNELS = "all"
+# Length of the moving average smoothing the envelope used for cross-correlation
+ENVELOPE_WINDOW_S = 0.001
+# Bin width and smoothing of the event trains correlated to find the expected latency
+EVENT_BIN_S = 0.001
+EVENT_SMOOTHING_S = 0.005
+# STFT parameters of the background removal applied to the test recordings, the defaults of remove_background.py
+CLEAN_N_FFT = 2048
+CLEAN_HOP_LENGTH = 512
+
+
+def echo_wav_info(file_path, num_channels, sample_width, frame_rate, num_frames):
+    """ Prints the basic parameters of a wav file
+
+    Args:
+        file_path (str): Path to the input audio file
+        num_channels (int): Number of channels
+        sample_width (int): Number of bytes per sample
+        frame_rate (int): Number of frames per second
+        num_frames (int): Number of frames in the file
+    """
+    duration = num_frames / float(frame_rate)
+
+    click.echo(f"Processing {file_path}:")
+    click.echo(f"  Channels: {num_channels}")
+    click.echo(f"  Sample Width: {sample_width} bytes")
+    click.echo(f"  Frame Rate: {frame_rate} Hz")
+    click.echo(f"  Duration: {duration:.2f} seconds")
+
+
+def open_wav_file(file_path):
+    """ Opens a wav file as a memory map and prints its basic parameters
+
+    Args:
+        file_path (str): Path to the input audio file
+
+    Returns:
+        WavFile: Memory-mapped wav file
+    """
+    wav = open_wav(file_path)
+    echo_wav_info(file_path, wav.channels, wav.sample_width, wav.sample_rate, wav.frame_count)
+    return wav
+
 
 def read_wav(file_path):
     """ Reads wav file from the provided path. Extracts the audio samples and the time resolution
@@ -19,13 +93,8 @@ def read_wav(file_path):
             sample_width = wav_file.getsampwidth()
             frame_rate = wav_file.getframerate()
             num_frames = wav_file.getnframes()
-            duration = num_frames / float(frame_rate)
 
-            click.echo(f"Processing {file_path}:")
-            click.echo(f"  Channels: {num_channels}")
-            click.echo(f"  Sample Width: {sample_width} bytes")
-            click.echo(f"  Frame Rate: {frame_rate} Hz")
-            click.echo(f"  Duration: {duration:.2f} seconds")
+            echo_wav_info(file_path, num_channels, sample_width, frame_rate, num_frames)
 
             raw_data = wav_file.readframes(num_frames)
             # Format string for unpacking
@@ -39,6 +108,40 @@ def read_wav(file_path):
         click.echo(f"Error processing {file_path}: {e}")
 
 
+def read_wav_frames(file_path):
+    """ Reads wav file from the provided path into a NumPy array of frames. Extracts the audio samples and the frame rate
+
+    The samples are memory-mapped rather than loaded, unless they are 24-bit.
+    Unlike `read_wav`, 3-byte samples are decoded as signed 24-bit integers.
+
+    Args:
+        file_path (str): Path to the input audio file
+
+    Returns:
+        Tuple[np.ndarray, int]: A tuple containing the audio samples with one row per frame and the frame rate
+    """
+    try:
+        wav = open_wav_file(file_path)
+        return wav.samples(), wav.sample_rate
+    except wave.Error as e:
+        click.echo(f"Error processing {file_path}: {e}")
+
+
+def read_wav_array(file_path):
+    """ Reads wav file from the provided path into a NumPy array. Extracts the audio samples and the time resolution
+
+    Args:
+        file_path (str): Path to the input audio file
+
+    Returns:
+        Tuple[np.ndarray, float]: A tuple containing the interleaved audio samples and the time steps
+    """
+    wav_data = read_wav_frames(file_path)
+    if wav_data is not None:
+        frames, frame_rate = wav_data
+        return frames.reshape(-1), 1/(frames.shape[1] * frame_rate)
+
+
 def count_leading_zeros(data):
     """ Count leading zeros in the provided data
 
@@ -67,7 +170,7 @@ def sine_to_const(data):
         Tuple[int, ...]: Binarized samples
     """
 
-    threshold = 0.6 * max(data)
+    threshold = THRESHOLD_RATIO * max(data)
     new_data = []
 
     for value in data[:-1]:
@@ -86,8 +189,7 @@ def sine_to_const(data):
 
         zeros = count_leading_zeros(new_data[id:])
         # Patch short runs of zeros with the threshold value
-        # adjust this if needed
-        if zeros < 50:
+        if zeros < MIN_GAP_SAMPLES:
             for i in range(id, id + zeros):
                 new_data[i] = threshold
         else:
@@ -137,33 +239,572 @@ def find_sound_end(data):
     return res
 
 
-def process_wav(wav_file):
+def fill_short_gaps(mask, min_gap=MIN_GAP_SAMPLES):
+    """ Mark runs of False shorter than `min_gap` samples as True, along the last axis
+
+    Args:
+        mask (np.ndarray): Boolean array marking the samples above the threshold, one row per signal
+        min_gap (int): Shortest run of False values which is left untouched
+
+    Returns:
+        np.ndarray: Boolean array with the short gaps filled
+    """
+    rows = mask.reshape(-1, mask.shape[-1])
+
+    # Pad with True on both sides, so that every gap has both a start and an end edge
+    padded = np.pad(rows, ((0, 0), (1, 1)), constant_values=True)
+    edge_rows, edges = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    gap_rows, gap_starts, gap_ends = edge_rows[0::2], edges[0::2], edges[1::2]
+
+    short = (gap_ends - gap_starts) < min_gap
+    fill = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.int8)
+    fill[gap_rows[short], gap_starts[short]] += 1
+    fill[gap_rows[short], gap_ends[short]] -= 1
+
+    filled = rows | (np.cumsum(fill[:, :-1], axis=1, dtype=np.int8) > 0)
+    return filled.reshape(mask.shape)
+
+
+def sine_to_const_np(data):
+    """ Binarize the samples, vectorized equivalent of `sine_to_const`
+
+    Args:
+        data (np.ndarray): Data to be analyzed, 2D arrays are processed row by row
+
+    Returns:
+        np.ndarray: Binarized samples
+    """
+    data = np.asarray(data)
+    threshold = THRESHOLD_RATIO * data.max(axis=-1, keepdims=True).astype(np.float64)
+
+    # The last sample is not thresholded, it repeats the value of the previous one
+    core = data[..., :-1]
+    active = fill_short_gaps((core > threshold) | (core < -threshold))
+    active = np.concatenate((active, active[..., -1:]), axis=-1)
+
+    return np.where(active, threshold, 0.0)
+
+
+def split_rows(rows, positions, row_count):
+    """ Splits positions of elements in a 2D array into one array per row
+
+    Args:
+        rows (np.ndarray): Sorted row numbers of the elements
+        positions (np.ndarray): Positions of the elements within their rows
+        row_count (int): Number of rows in the array
+
+    Returns:
+        List[np.ndarray]: Positions of the elements in each row
+    """
+    bounds = np.searchsorted(rows, np.arange(row_count + 1))
+    return [positions[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def find_sound_start_np(data):
+    """ Find the start of each time sound is detected, vectorized equivalent of `find_sound_start`
+
+    Args:
+        data (np.ndarray): Data to be analyzed, 2D arrays are processed row by row
+
+    Returns:
+        np.ndarray: The sample numbers where the start of each sound is detected, a list of them for 2D data
+    """
+    active = np.atleast_2d(np.asarray(data) != 0)
+
+    rising = np.empty_like(active)
+    rising[:, 0] = active[:, 0]
+    rising[:, 1:] = ~active[:, :-1] & active[:, 1:]
+
+    rows, starts = np.nonzero(rising)
+    return starts if np.ndim(data) == 1 else split_rows(rows, starts, len(active))
+
+
+def find_sound_end_np(data):
+    """ Find the end of each time sound is detected, vectorized equivalent of `find_sound_end`
+
+    Args:
+        data (np.ndarray): Data to be analyzed, 2D arrays are processed row by row
+
+    Returns:
+        np.ndarray: The sample numbers where the end of each sound is detected, a list of them for 2D data
+    """
+    active = np.atleast_2d(np.asarray(data) != 0)
+
+    falling = np.empty_like(active)
+    falling[:, 0] = False
+    falling[:, 1:] = active[:, :-1] & ~active[:, 1:]
+    falling[:, -1] |= active[:, -1]
+
+    rows, stops = np.nonzero(falling)
+    return stops if np.ndim(data) == 1 else split_rows(rows, stops, len(active))
+
+
+def filter_sounds(starts, stops):
+    """ Drops the sounds shorter than MIN_SOUND_SAMPLES samples
+
+    Args:
+        starts (np.ndarray): The sample numbers where the start of each sound is detected
+        stops (np.ndarray): The sample numbers where the end of each sound is detected
+
+    Returns:
+        Tuple[List[int], List[int]]: Start and stop sample numbers of the remaining sounds
+    """
+    count = min(len(starts), len(stops))
+    starts, stops = starts[:count], stops[:count]
+    keep = stops - starts >= MIN_SOUND_SAMPLES
+
+    return starts[keep].tolist(), stops[keep].tolist()
+
+
+def select_channels(frames, channel):
+    """ Picks the signals analyzed in a wav file
+
+    Mono files are analyzed as they are, whichever channel number is requested.
+
+    Args:
+        frames (np.ndarray): Audio samples with one row per frame
+        channel (str): "mix" for the average of all the channels, "all" for each channel separately or a channel number
+
+    Returns:
+        np.ndarray: Analyzed signals, one per row
+    """
+    if channel == ALL_CHANNELS or frames.shape[1] == 1:
+        return frames.T
+    if channel == MIX:
+        return frames.mean(axis=1)[np.newaxis]
+
+    index = int(channel)
+    if index >= frames.shape[1]:
+        raise ValueError(f"Channel {index} requested, but the file has {frames.shape[1]} channels")
+    return frames[:, index][np.newaxis]
+
+
+def iter_wav_blocks(file_path, block_size=STREAM_BLOCK_SIZE, channel=INTERLEAVED):
+    """ Reads wav file from the provided path in fixed-size blocks
+
+    Args:
+        file_path (str): Path to the input audio file
+        block_size (int): Number of samples in a block, rounded down to whole frames
+        channel (str): Analyzed signals, "interleaved" for all the samples in the file order
+                       or a `select_channels` channel selection
+
+    Yields:
+        np.ndarray: Consecutive blocks of the analyzed signals, one per row
+    """
+    wav = open_wav(file_path)
+    frames_per_block = max(1, block_size // wav.channels)
+
+    for start in range(0, wav.frame_count, frames_per_block):
+        frames = wav.samples(start, start + frames_per_block)
+        if channel == INTERLEAVED:
+            yield frames.reshape(1, -1)
+        else:
+            yield select_channels(frames, channel)
+
+
+def signal_blocks(blocks, index):
+    """ Picks a single signal from blocks of signals
+
+    Args:
+        blocks (Iterable[np.ndarray]): Blocks of signals, one per row
+        index (int): Row of the picked signal
+
+    Yields:
+        np.ndarray: Consecutive blocks of the picked signal
+    """
+    for block in blocks:
+        yield block[index]
+
+
+def iter_sound_segments(blocks, threshold, min_gap=MIN_GAP_SAMPLES, min_sound=MIN_SOUND_SAMPLES):
+    """ Detects sound segments in a stream of sample blocks, equivalent of thresholding the whole data with `sine_to_const_np`
+
+    A sound ends only at a run of at least `min_gap` silent samples, so the state carried between
+    the blocks is limited to the currently open sound, the run of silent samples at the end of
+    the processed data and the last sample, which is held back as the final sample of the data
+    is not thresholded.
+
+    Args:
+        blocks (Iterable[np.ndarray]): Consecutive blocks of audio samples
+        threshold (float): Sample value above which a sample is treated as sound
+        min_gap (int): Shortest run of silent samples ending a sound
+        min_sound (int): Shortest sound which is reported
+
+    Yields:
+        Tuple[int, int]: Sample numbers of the start and the stop of each detected sound
+    """
+    position = 0        # sample number of the first thresholded sample in the current block
+    held = None         # last sample received so far
+    gap_start = None    # start of the silence reaching the end of the processed data
+    sound_start = 0     # start of the currently open sound
+
+    # Binarized sounds take the threshold value, so nothing can be detected with a zero threshold
+    if threshold == 0:
+        return
+
+    def close_sound(stop):
+        nonlocal sound_start
+        start, sound_start = sound_start, None
+        if start is not None and stop > start and stop - start >= min_sound:
+            return start, stop
+
+    for block in blocks:
+        data = block if held is None else np.concatenate((held, block))
+        core, held = data[:-1], data[-1:]
+        if len(core) == 0:
+            continue
+
+        silent = ~((core > threshold) | (core < -threshold))
+        end = position + len(core)
+
+        # Pad with False on both sides, so that every silence has both a start and an end edge
+        padded = np.concatenate(([False], silent, [False]))
+        gaps = (np.flatnonzero(padded[1:] != padded[:-1]) + position).reshape(-1, 2)
+
+        if gap_start is not None:
+            if len(gaps) and gaps[0, 0] == position:
+                gaps[0, 0] = gap_start
+            else:
+                gaps = np.concatenate(([[gap_start, position]], gaps))
+            gap_start = None
+
+        # A silence reaching the end of the block may continue in the next one
+        if len(gaps) and gaps[-1, 1] == end:
+            gap_start = int(gaps[-1, 0])
+            gaps = gaps[:-1]
+
+        for gap_begin, gap_end in gaps[gaps[:, 1] - gaps[:, 0] >= min_gap].tolist():
+            if (sound := close_sound(gap_begin)) is not None:
+                yield sound
+            sound_start = gap_end
+
+        position = end
+
+    # The final sample repeats the state of the previous one
+    if gap_start is not None and position - gap_start >= min_gap:
+        stop = gap_start
+    else:
+        stop = position
+    if (sound := close_sound(stop)) is not None:
+        yield sound
+
+
+def process_wav_streaming(wav_file, block_size=STREAM_BLOCK_SIZE, channel=INTERLEAVED):
+    """ Process given wav file block by block to identify significant audio segments with bounded memory
+
+    The file is read first to find the peak values determining the thresholds, then once for each analyzed signal.
+
+    Args:
+        wav_file (str): Path to the WAV file
+        block_size (int): Number of samples read at once
+        channel (str): Analyzed signals, "interleaved" for all the samples in the file order
+                       or a `select_channels` channel selection
+
+    Returns:
+        Tuple[float, List[Iterator[Tuple[int, int]]]]: Time step between the samples and, for each analyzed signal,
+        an iterator yielding the sample numbers of the start and the stop of each detected sound
+    """
+    wav = open_wav_file(wav_file)
+    if channel == INTERLEAVED:
+        time_delta = 1/(wav.channels * wav.sample_rate)
+    else:
+        time_delta = 1/wav.sample_rate
+
+    peaks = None
+    for block in iter_wav_blocks(wav_file, block_size, channel):
+        if block.shape[1]:
+            block_peaks = block.max(axis=1).astype(np.float64)
+            peaks = block_peaks if peaks is None else np.maximum(peaks, block_peaks)
+    if peaks is None:
+        return time_delta, []
+
+    return time_delta, [
+        iter_sound_segments(signal_blocks(iter_wav_blocks(wav_file, block_size, channel), index),
+                            THRESHOLD_RATIO * peak)
+        for index, peak in enumerate(peaks.tolist())
+    ]
+
+
+def process_wav(wav_file, backend="numpy", channel=INTERLEAVED):
     """ Process given wav file to identify significant audio segments
 
     Args:
         wav_file (str): Path to the WAV file
+        backend (str): Implementation used for the analysis, either "numpy", "python" or "stream"
+        channel (str): Analyzed signals, "interleaved" for all the samples in the file order
+                       or a `select_channels` channel selection
 
     Returns:
-         Tuple[ Tuple[int, ...], float,  Tuple[List[int, ...], List[int, ...]] ]: 
-         - Raw audio samples from the wav file
+         Tuple[ Sequence[int], float,  List[Tuple[List[int, ...], List[int, ...]]] ]: 
+         - Raw audio samples from the wav file, None for the "stream" backend
          - Time step between the samples
-         - A tuple: 
+         - A list with a tuple for each analyzed signal (one, unless all the channels are analyzed separately):
              - list containing the sample numbers of detected sound start segments 
              - list containing the sample numbers of detected sound stop segments 
     """
-    audio, time_delta = read_wav(wav_file)
-    threshed = sine_to_const(audio)
+    if backend == "python":
+        with profiling.stage("read", wav_file) as read_stage:
+            if channel == INTERLEAVED:
+                audio, time_delta = read_wav(wav_file)
+                signals = [audio]
+            else:
+                audio, frame_rate = read_wav_frames(wav_file)
+                time_delta = 1/frame_rate
+                signals = [tuple(signal.tolist()) for signal in select_channels(audio, channel)]
+        sample_count = sum(len(signal) for signal in signals)
+        profiling.set_samples(read_stage, sample_count)
+
+        sounds = []
+        for signal in signals:
+            with profiling.stage("sine_to_const", wav_file, len(signal)):
+                threshed = sine_to_const(signal)
+
+            with profiling.stage("find_sound_edges", wav_file, len(signal)):
+                starts = find_sound_start(threshed)
+                stops = find_sound_end(threshed)
+
+            # Filter indices where the duration is at least MIN_SOUND_SAMPLES samples
+            with profiling.stage("filter_sounds", wav_file):
+                filtered = [(s, e) for s, e in zip(starts, stops) if e - s >= MIN_SOUND_SAMPLES]
+
+            filtered_starts = [s for s, _ in filtered]
+            filtered_stops = [e for _, e in filtered]
+            sounds.append((filtered_starts, filtered_stops))
+
+        return (audio, time_delta, sounds)
+
+    if backend == "stream":
+        with profiling.stage("stream_detection", wav_file) as detection_stage:
+            time_delta, segments = process_wav_streaming(wav_file, channel=channel)
+
+            sounds = []
+            for signal_segments in segments:
+                filtered = list(signal_segments)
+
+                filtered_starts = [s for s, _ in filtered]
+                filtered_stops = [e for _, e in filtered]
+                sounds.append((filtered_starts, filtered_stops))
+
+        wav = open_wav(wav_file)
+        profiling.set_samples(detection_stage, wav.frame_count * wav.channels)
+        return (None, time_delta, sounds)
+
+    with profiling.stage("read", wav_file) as read_stage:
+        if channel == INTERLEAVED:
+            audio, time_delta = read_wav_array(wav_file)
+            signals = audio[np.newaxis]
+        else:
+            audio, frame_rate = read_wav_frames(wav_file)
+            time_delta = 1/frame_rate
+            signals = select_channels(audio, channel)
+    profiling.set_samples(read_stage, signals.size)
+
+    return (audio, time_delta, detect_sounds(signals, wav_file))
+
+
+def detect_sounds(signals, wav_file=None):
+    """ Detects sound segments in signals held in memory, with the vectorized threshold detector
+
+    Args:
+        signals (np.ndarray): Analyzed signals, one per row
+        wav_file (str): Path to the WAV file the signals come from, for the profiling
+
+    Returns:
+        List[Tuple[List[int], List[int]]]: Sample numbers of the sound starts and stops of each signal
+    """
+    # All the signals are analyzed at once, one per row
+    with profiling.stage("sine_to_const", wav_file, signals.size):
+        threshed = sine_to_const_np(signals)
+
+    with profiling.stage("find_sound_edges", wav_file, signals.size):
+        starts = find_sound_start_np(threshed)
+        stops = find_sound_end_np(threshed)
+
+    with profiling.stage("filter_sounds", wav_file):
+        return [filter_sounds(s, e) for s, e in zip(starts, stops)]
+
+
+def compute_envelope(frames, frame_rate, window_s=ENVELOPE_WINDOW_S):
+    """ Computes the amplitude envelope of the audio samples
+
+    The envelope is the mean absolute value of all channels, smoothed with a centered moving average.
+
+    Args:
+        frames (np.ndarray): Audio samples with one row per frame
+        frame_rate (int): Frame rate of the audio samples
+        window_s (float): Length of the moving average window in seconds
+
+    Returns:
+        np.ndarray: Envelope with one value per frame
+    """
+    samples = frames.astype(np.float64)
+    if frames.dtype == np.uint8:
+        # 8-bit samples are unsigned, centered around 128
+        samples -= 128
+    rectified = np.abs(samples).mean(axis=1)
+
+    window = max(1, int(round(window_s * frame_rate)))
+    padded = np.pad(rectified, (window // 2, window - 1 - window // 2))
+    cumsum = np.concatenate(([0.0], np.cumsum(padded)))
+    return (cumsum[window:] - cumsum[:-window]) / window
+
+
+def estimate_latency(test_envelope, ref_envelope, rate, max_latency=None):
+    """ Estimates the delay of the test envelope relative to the reference one using FFT cross-correlation
+
+    The position of the correlation peak is refined to a fraction of a sample with parabolic interpolation.
+
+    Args:
+        test_envelope (np.ndarray): Envelope of the recorded audio
+        ref_envelope (np.ndarray): Envelope of the reference audio, sampled with the same rate
+        rate (int): Rate of both envelopes
+        max_latency (float): Longest delay to look for in seconds, None searches the whole recording
+
+    Returns:
+        Tuple[float, float]: Latency in seconds and the normalized correlation (confidence) at the peak
+    """
+    test = test_envelope - test_envelope.mean()
+    ref = ref_envelope - ref_envelope.mean()
+
+    # Zero-pad to a power of two at least as long as the full linear correlation
+    size = len(test) + len(ref) - 1
+    nfft = 1 << (size - 1).bit_length()
+    corr = np.fft.irfft(np.fft.rfft(test, nfft) * np.conj(np.fft.rfft(ref, nfft)), nfft)
+
+    # Only non-negative lags are considered, the recording cannot precede the reference
+    max_lag = len(test) - 1
+    if max_latency is not None:
+        max_lag = min(max_lag, int(max_latency * rate))
+    corr = corr[:max_lag + 1]
+
+    peak = int(np.argmax(corr))
+    lag = float(peak)
+    if 0 < peak < len(corr) - 1:
+        y0, y1, y2 = corr[peak - 1:peak + 2]
+        curvature = y0 - 2 * y1 + y2
+        if curvature != 0:
+            lag += 0.5 * (y0 - y2) / curvature
+
+    norm = np.linalg.norm(test) * np.linalg.norm(ref)
+    confidence = float(corr[peak] / norm) if norm else 0.0
+
+    return lag / rate, confidence
+
+
+@dataclass
+class EventMatches:
+    """ Result of matching test events with reference events """
+
+    # Test event timestamps and the latencies relative to their matching reference events, in seconds
+    timestamps: list
+    latencies: list
+    # Test events with no reference event in the matching window, e.g. spurious detections
+    unmatched: list
+    # Reference events with no test event in the matching window, e.g. missed detections
+    missed: list
+    # Normalized correlation at the peak, for latencies estimated by cross-correlation
+    confidence: float = None
+
+
+def estimate_event_latency(timestamps, ref_timestamps, max_latency=None):
+    """ Estimates the delay between two event trains by cross-correlating their smoothed histograms
+
+    Args:
+        timestamps (Sequence[float]): Sorted timestamps of the test events in seconds
+        ref_timestamps (Sequence[float]): Sorted timestamps of the reference events in seconds
+        max_latency (float): Longest delay to look for in seconds, None searches the whole recording
+
+    Returns:
+        float: Estimated delay in seconds
+    """
+    if len(timestamps) == 0 or len(ref_timestamps) == 0:
+        return 0.0
+
+    bin_count = int(max(timestamps[-1], ref_timestamps[-1]) / EVENT_BIN_S) + 2
+    window = np.ones(max(1, int(round(EVENT_SMOOTHING_S / EVENT_BIN_S))))
+
+    def event_train(events):
+        counts = np.bincount((np.asarray(events) / EVENT_BIN_S).astype(np.int64), minlength=bin_count)
+        return np.convolve(counts.astype(np.float64), window, mode='same')
+
+    latency, _ = estimate_latency(event_train(timestamps), event_train(ref_timestamps), 1 / EVENT_BIN_S, max_latency)
+    return latency
+
+
+def nearest(sorted_values, queries):
+    """ Finds the nearest element of a sorted array for each query
+
+    Args:
+        sorted_values (np.ndarray): Sorted, non-empty array
+        queries (np.ndarray): Values to look for
+
+    Returns:
+        np.ndarray: Index of the nearest element for each query
+    """
+    right = np.clip(np.searchsorted(sorted_values, queries), 1, len(sorted_values) - 1)
+    left = right - 1
+    if len(sorted_values) == 1:
+        return np.zeros(len(queries), dtype=np.int64)
 
-    starts = find_sound_start(threshed)
-    stops = find_sound_end(threshed)
+    take_right = np.abs(sorted_values[right] - queries) < np.abs(queries - sorted_values[left])
+    return np.where(take_right, right, left)
 
-    # Filter indices where the duration is at least 10 samples
-    filtered = [(s, e) for s, e in zip(starts, stops) if e - s >= 10]
 
-    filtered_starts = [s for s, _ in filtered]
-    filtered_stops = [e for _, e in filtered]
+def match_events(timestamps, ref_timestamps, expected_latency, window=None):
+    """ Matches test events with reference events delayed by the expected latency
 
-    return (audio, time_delta, (filtered_starts, filtered_stops))
+    A pair is formed when both events are each other's nearest neighbours and their distance from
+    the expected latency is within the window. Nearest neighbours are found with binary search on
+    the sorted timestamps, so the matching takes O(n log n) time.
+
+    Args:
+        timestamps (Sequence[float]): Sorted timestamps of the test events in seconds
+        ref_timestamps (Sequence[float]): Sorted timestamps of the reference events in seconds
+        expected_latency (float): Expected delay of the test events in seconds
+        window (float): Largest accepted deviation from the expected latency in seconds,
+                        None uses half of the shortest interval between the reference events
+
+    Returns:
+        EventMatches: Matched latencies and the events which were not matched
+    """
+    times = np.asarray(timestamps, dtype=np.float64)
+    ref_times = np.asarray(ref_timestamps, dtype=np.float64)
+
+    if len(times) == 0 or len(ref_times) == 0:
+        return EventMatches([], [], times.tolist(), ref_times.tolist())
+
+    if window is None:
+        window = np.diff(ref_times).min() / 2 if len(ref_times) > 1 else np.inf
+
+    shifted = times - expected_latency
+    nearest_ref = nearest(ref_times, shifted)
+    nearest_test = nearest(shifted, ref_times)
+
+    test_indices = np.arange(len(times))
+    matched = (nearest_test[nearest_ref] == test_indices) & (np.abs(shifted - ref_times[nearest_ref]) <= window)
+    ref_matched = np.zeros(len(ref_times), dtype=bool)
+    ref_matched[nearest_ref[matched]] = True
+
+    return EventMatches(
+        timestamps=times[matched].tolist(),
+        latencies=(times[matched] - ref_times[nearest_ref[matched]]).tolist(),
+        unmatched=times[~matched].tolist(),
+        missed=ref_times[~ref_matched].tolist(),
+    )
+
+
+def report_matches(name, kind, matches):
+    """ Prints the events which could not be matched
+
+    Args:
+        name (str): Name of the analyzed signal
+        kind (str): Kind of the events, e.g. "start"
+        matches (EventMatches): Result of the matching
+    """
+    if matches.unmatched:
+        print(f"{name}: no reference sound {kind} matches the sound {kind} at {matches.unmatched} s")
+    if matches.missed:
+        print(f"{name}: no sound {kind} matches the reference sound {kind} at {matches.missed} s")
 
 
 def indices_to_timestamps(data, delta_time_per_sample):
@@ -194,78 +835,689 @@ def csv_entry(filename, timestamps_start, timestamps_end):
     return f"{filename}; {event_timestamps}\n"
 
 
-@click.command()
-@click.argument('wav_files', nargs=-1, type=click.Path(exists=True))
-def main(wav_files):
-    """Calculate delay between the first wav file and any number of test wav files."""
-    if not wav_files or len(wav_files) < 2:
-        click.echo("Provide a reference wav file and at least one test wav file")
-        return
+# Reference analysis and background removal shared with the worker processes, set by `init_worker`
+_reference = None
+_background = None
 
-    sounds_detected = []
-    time_deltas = []
-    audio_samples = []
 
-    for wav_file in wav_files:
-        if wav_file.lower().endswith('.wav'):
+def init_worker(reference, background=None):
+    """ Shares the reference file analysis with the current (worker) process
+
+    Args:
+        reference (tuple): Analysis of the reference file, its contents depend on the analysis mode
+        background (dict): Background removed from the test files, as returned by `prepare_background`,
+                           None analyzes the test files as they are
+    """
+    global _reference, _background
+    _reference = reference
+    _background = background
+
+
+def prepare_background(background_wav, test_files, aligned=False, clean_suffix=None, cache=None):
+    """ Computes the background spectra removed from the test files, once for each of their sample rates
+
+    Args:
+        background_wav (str): Path to the WAV file with only the bleeding audio
+        test_files (List[str]): Paths to the test WAV files
+        aligned (bool): Whether to subtract the background frame by frame while it lasts
+        clean_suffix (str): Suffix of the saved cleaned test files, None keeps them only in memory
+        cache (AnalysisCache): Cache of analysis results, None disables caching
+
+    Returns:
+        dict: Background spectra for each sample rate, cleaning settings and the suffix of the saved files
+    """
+    rates = {open_wav(test_file).sample_rate for test_file in test_files}
+    spectra = {
+        rate: remove_background.background_spectra(background_wav, rate, aligned, CLEAN_N_FFT, CLEAN_HOP_LENGTH,
+                                                   STREAM_BLOCK_SIZE, cache)
+        for rate in rates
+    }
+    settings = {
+        "background": file_digest(background_wav),
+        "aligned": aligned,
+        "n_fft": CLEAN_N_FFT,
+        "hop_length": CLEAN_HOP_LENGTH,
+    }
+    return {"spectra": spectra, "settings": settings, "suffix": clean_suffix}
+
+
+def clean_recording(wav_file):
+    """ Removes the shared background from a test wav file, keeping the result in memory
+
+    The cleaned recording is also saved if a suffix was given for the cleaned files.
+
+    Args:
+        wav_file (str): Path to the test WAV file
+
+    Returns:
+        Tuple[np.ndarray, int]: Cleaned mono samples and their sample rate
+    """
+    with profiling.stage("clean", wav_file) as clean_stage:
+        wav = open_wav_file(wav_file)
+        profile, spectrogram = _background["spectra"][wav.sample_rate]
+        samples, rate = remove_background.clean_samples(
+            wav_file, remove_background.iter_spectra(profile, spectrogram), CLEAN_N_FFT, CLEAN_HOP_LENGTH)
+    profiling.set_samples(clean_stage, wav.frame_count * wav.channels)
+
+    if _background["suffix"] is not None:
+        with profiling.stage("save_clean", wav_file):
+            remove_background.save_samples(cleaned_path(wav_file), samples, rate)
+    return samples, rate
+
+
+def cleaned_path(wav_file):
+    """ Names the saved cleaned version of a test wav file
+
+    Args:
+        wav_file (str): Path to the test WAV file
+
+    Returns:
+        str: Path next to the test file, with the suffix of the cleaned files
+    """
+    return remove_background.output_path(wav_file, None, _background["suffix"])
+
+
+def cached_cleaning(wav_file, cache):
+    """ Tells whether the cached analysis of a cleaned test file can be used
 
-            audio_sample, time_delta, samples = process_wav(wav_file)
+    Args:
+        wav_file (str): Path to the test WAV file
+        cache (AnalysisCache): Cache of analysis results, None disables caching
+
+    Returns:
+        bool: True unless caching is disabled or the cleaned file has to be saved and is missing
+    """
+    return cache is not None and (_background["suffix"] is None or os.path.exists(cleaned_path(wav_file)))
+
+
+def analyze_cleaned(wav_file, cache=None):
+    """ Removes the shared background from a test wav file and detects sound segments in the result, in memory
+
+    The cleaned recording is a mix of the channels, analyzed with the "numpy" backend.
+
+    Args:
+        wav_file (str): Path to the test WAV file
+        cache (AnalysisCache): Cache of analysis results, None disables caching
+
+    Returns:
+        Tuple[float, List[Tuple[List[int], List[int]]]]: Time step between the samples and detected sound segments
+        of the cleaned signal
+    """
+    settings = {**detector_settings(MIX), "cleaning": _background["settings"]}
+    if cache is not None:
+        with profiling.stage("cache", wav_file):
+            key = cache.key([file_digest(wav_file)], settings)
+            entry = cache.get(key) if cached_cleaning(wav_file, cache) else None
+        if entry is not None:
+            click.echo(f"Using cached analysis of {wav_file}")
+            return entry["time_delta"], [tuple(sounds) for sounds in entry["sounds"]]
 
-            audio_samples.append(audio_sample)
-            sounds_detected.append(samples)
-            time_deltas.append(time_delta)
+    samples, rate = clean_recording(wav_file)
+    time_delta, sounds = 1/rate, detect_sounds(samples[np.newaxis], wav_file)
 
+    if cache is not None:
+        with profiling.stage("cache", wav_file):
+            cache.put(key, {"time_delta": time_delta, "sounds": sounds, "settings": settings})
+    return time_delta, sounds
+
+
+def detector_settings(channel=INTERLEAVED, backend="numpy"):
+    """ Returns the parameters of the threshold sound detector, cached results depend on them
+
+    Args:
+        channel (str): Analyzed signals
+        backend (str): Implementation used for the analysis, the "python" one decodes the samples on its own
+
+    Returns:
+        dict: Detector parameters
+    """
+    return {
+        "detector": "threshold",
+        # The "python" backend stays an independent reference, its results are not shared with the others
+        "decoder": "struct" if backend == "python" else "wav_reader",
+        "channel": channel,
+        "threshold_ratio": THRESHOLD_RATIO,
+        "min_gap_samples": MIN_GAP_SAMPLES,
+        "min_sound_samples": MIN_SOUND_SAMPLES,
+    }
+
+
+def analyze_file(wav_file, backend="numpy", cache=None, channel=INTERLEAVED):
+    """ Detects sound segments in a wav file, dropping the raw samples
+
+    Args:
+        wav_file (str): Path to the WAV file
+        backend (str): Implementation used for the analysis, either "numpy", "python" or "stream"
+        cache (AnalysisCache): Cache of analysis results, None disables caching
+        channel (str): Analyzed signals, "interleaved" for all the samples in the file order
+                       or a `select_channels` channel selection
+
+    Returns:
+        Tuple[float, List[Tuple[List[int], List[int]]]]: Time step between the samples and detected sound segments
+        of each analyzed signal
+    """
+    if cache is not None:
+        settings = detector_settings(channel, backend)
+        with profiling.stage("cache", wav_file):
+            key = cache.key([file_digest(wav_file)], settings)
+            entry = cache.get(key)
+        if entry is not None:
+            click.echo(f"Using cached analysis of {wav_file}")
+            return entry["time_delta"], [tuple(sounds) for sounds in entry["sounds"]]
+
+    _, time_delta, sounds = process_wav(wav_file, backend, channel)
+
+    if cache is not None:
+        with profiling.stage("cache", wav_file):
+            cache.put(key, {"time_delta": time_delta, "sounds": sounds, "settings": settings})
+    return time_delta, sounds
+
+
+def signal_name(wav_file, index, signal_count):
+    """ Names an analyzed signal in the results
+
+    Args:
+        wav_file (str): Path to the WAV file
+        index (int): Number of the signal
+        signal_count (int): Number of signals analyzed in the file
+
+    Returns:
+        str: File name, followed by the channel number if the channels are analyzed separately
+    """
+    return wav_file if signal_count == 1 else f"{wav_file}[{index}]"
+
+
+def compare_to_reference(wav_file, backend="numpy", cache=None, channel=INTERLEAVED,
+                         expected_latency=None, match_window=None, max_latency=None):
+    """ Analyzes a test wav file and compares it with the shared reference analysis
+
+    Each analyzed signal is compared with the reference signal with the same number,
+    or with the first reference signal if the reference has fewer of them.
+
+    Args:
+        wav_file (str): Path to the test WAV file
+        backend (str): Implementation used for the analysis, either "numpy", "python" or "stream"
+        cache (AnalysisCache): Cache of analysis results, None disables caching
+        channel (str): Analyzed signals, "interleaved" for all the samples in the file order
+                       or a `select_channels` channel selection
+        expected_latency (float): Expected latency in seconds used to match the events,
+                                  None estimates it from the events
+        match_window (float): Largest accepted deviation from the expected latency in seconds,
+                              None uses half of the shortest interval between the reference events
+        max_latency (float): Longest latency in seconds considered when estimating it, None searches the whole recording
+
+    Returns:
+        dict: Matches of the sound starts and ends of each analyzed signal
+    """
+    with profiling.stage("analyze", wav_file):
+        time_delta_ref, ref_sounds = _reference
+        if _background is not None:
+            time_delta, sounds = analyze_cleaned(wav_file, cache)
         else:
-            click.echo(f"Skipping {wav_file}: Not a WAV file.")
+            time_delta, sounds = analyze_file(wav_file, backend, cache, channel)
 
-    (ref_start, ref_end) = sounds_detected[0]
-    ref_audio_samples = audio_samples[0]
-    time_delta_ref = time_deltas[0]
-    test_names = wav_files[1:]
-    test_data = sounds_detected[1:]
-    time_deltas_test = time_deltas[1:]
-    test_audio_samples = audio_samples[1:]
+        signals = {}
+        for index, (start, end) in enumerate(sounds):
+            ref_start, ref_end = ref_sounds[index] if index < len(ref_sounds) else ref_sounds[0]
+            name = signal_name(wav_file, index, len(sounds))
 
-    ref_start_timestamps = indices_to_timestamps(ref_start, time_delta_ref)
-    ref_end_timestamps = indices_to_timestamps(ref_end, time_delta_ref)
+            start_timestamps = indices_to_timestamps(start, time_delta)
+            end_timestamps = indices_to_timestamps(end, time_delta)
+            ref_start_timestamps = indices_to_timestamps(ref_start, time_delta_ref)
+            ref_end_timestamps = indices_to_timestamps(ref_end, time_delta_ref)
 
-    csv_data = []
-    csv_data.append("filename; event timestamps\n")
-    csv_data.append(csv_entry(wav_files[0], ref_start_timestamps, ref_end_timestamps))
+            with profiling.stage("event_matching", wav_file):
+                latency = expected_latency
+                if latency is None:
+                    latency = estimate_event_latency(sorted(start_timestamps + end_timestamps),
+                                                     sorted(ref_start_timestamps + ref_end_timestamps), max_latency)
 
-    # iterate over arrays with indices of events in wav data
-    for (i, (start, end)) in enumerate(test_data):
-        if len(start) != len(ref_start) or len(end) != len(ref_end):
-            print(f"reference file: sound started {len(ref_start)} times, ended {len(ref_end)} times")
-            print(f"{wav_files[i+1]} file: sound started {len(start)} times, ended {len(end)} times")
+                start_matches = match_events(start_timestamps, ref_start_timestamps, latency, match_window)
+                end_matches = match_events(end_timestamps, ref_end_timestamps, latency, match_window)
+            report_matches(name, "start", start_matches)
+            report_matches(name, "end", end_matches)
 
-        start_diffs = []
-        end_diffs = []
+            signals[name] = {"start": start_matches, "end": end_matches}
 
-        start_timestamps = indices_to_timestamps(start, time_deltas_test[i])
-        end_timestamps = indices_to_timestamps(end, time_deltas_test[i])
-        csv_data.append(csv_entry(test_names[i], start_timestamps, end_timestamps))
+        return signals
 
-        for j, (st, ref_st) in enumerate(zip(start, ref_start)):
-            # convert array index to time
-            test_start_time = st * time_deltas_test[i]
 
-            ref_start_time = ref_st * time_delta_ref
+def read_aligned(wav_file, rate, channel=MIX):
+    """ Reads a wav file as a floating-point signal with the common rate and channel layout
 
-            diff = test_start_time - ref_start_time
-            start_diffs.append(diff)
+    Args:
+        wav_file (str): Path to the WAV file
+        rate (int): Common sample rate
+        channel (str): Channel number to use only a single channel, otherwise the channels are mixed
+
+    Returns:
+        np.ndarray: Samples in the [-1, 1) range resampled to `rate`, with one row per frame and a single column
+    """
+    with profiling.stage("read", wav_file) as read_stage:
+        wav = open_wav_file(wav_file)
+        signal = select_channels(wav.to_float(), channel if channel.isdigit() else MIX).T
+    profiling.set_samples(read_stage, wav.frame_count * wav.channels)
+
+    with profiling.stage("resample", wav_file, len(signal)):
+        return resample(signal, wav.sample_rate, rate)
+
+
+def resampled_reference(ref_file, rate, channel=MIX, cache=None):
+    """ Reads the reference wav file with the common rate and channel layout, reusing the cached result
+
+    Args:
+        ref_file (str): Path to the reference WAV file
+        rate (int): Common sample rate
+        channel (str): Channel number to use only a single channel, otherwise the channels are mixed
+        cache (AnalysisCache): Cache of analysis results, None disables caching
+
+    Returns:
+        Tuple[np.ndarray, str]: Resampled reference signal and the digest of the file, None without the cache
+    """
+    if cache is None:
+        return read_aligned(ref_file, rate, channel), None
+
+    ref_digest = file_digest(ref_file)
+    settings = {
+        "resampled": rate,
+        "channel": channel if channel.isdigit() else MIX,
+        "filter_half_width": FILTER_HALF_WIDTH,
+        "kaiser_beta": KAISER_BETA,
+    }
+    key = cache.key([ref_digest], settings)
+    if (signal := cache.get_array(key)) is not None:
+        click.echo(f"Using cached resampled {ref_file}")
+        return signal, ref_digest
+
+    signal = read_aligned(ref_file, rate, channel)
+    cache.put_array(key, signal)
+    return signal, ref_digest
+
+
+def correlate_with_reference(wav_file, max_latency=None, cache=None, channel=MIX):
+    """ Estimates the latency of a test wav file by cross-correlating it with the shared reference envelope
+
+    The test file is resampled to the common rate of the reference envelope if needed,
+    after removing the shared background from it, if there is one.
+
+    Args:
+        wav_file (str): Path to the test WAV file
+        max_latency (float): Longest delay to look for in seconds, None searches the whole recording
+        cache (AnalysisCache): Cache of analysis results, None disables caching
+        channel (str): Channel number to use only a single channel, otherwise the channels are mixed
+
+    Returns:
+        dict: Estimated latency of the test file, as the match of its start with the reference start
+    """
+    with profiling.stage("correlate", wav_file):
+        ref_envelope, ref_rate, ref_digest = _reference
+
+        if cache is not None:
+            settings = xcorr_settings(channel, max_latency, ref_rate)
+            if _background is not None:
+                settings["cleaning"] = _background["settings"]
+            with profiling.stage("cache", wav_file):
+                key = cache.key([file_digest(wav_file), ref_digest], settings)
+                use_cache = _background is None or cached_cleaning(wav_file, cache)
+                entry = cache.get(key) if use_cache else None
+            if entry is not None:
+                click.echo(f"Using cached analysis of {wav_file}")
+                return correlation_matches(wav_file, entry['latency'], entry['confidence'])
+
+        if _background is not None:
+            samples, rate = clean_recording(wav_file)
+            with profiling.stage("resample", wav_file, len(samples)):
+                signal = resample(samples[:, np.newaxis], rate, ref_rate)
+        else:
+            signal = read_aligned(wav_file, ref_rate, channel)
+        with profiling.stage("envelope", wav_file, len(signal)):
+            envelope = compute_envelope(signal, ref_rate)
+        with profiling.stage("xcorr", wav_file, len(envelope)):
+            latency, confidence = estimate_latency(envelope, ref_envelope, ref_rate, max_latency)
+
+        if cache is not None:
+            with profiling.stage("cache", wav_file):
+                cache.put(key, {"latency": latency, "confidence": confidence, "settings": settings})
+        return correlation_matches(wav_file, latency, confidence)
+
+
+def xcorr_settings(channel, max_latency, rate):
+    """ Returns the parameters of the cross-correlation latency estimation, cached results depend on them
+
+    Args:
+        channel (str): Analyzed signals
+        max_latency (float): Longest delay to look for in seconds
+        rate (int): Common sample rate
+
+    Returns:
+        dict: Estimation parameters
+    """
+    return {
+        "detector": "xcorr",
+        "channel": channel if channel.isdigit() else MIX,
+        "envelope_window_s": ENVELOPE_WINDOW_S,
+        "max_latency": max_latency,
+        "rate": rate,
+    }
+
+
+def correlation_matches(wav_file, latency, confidence):
+    """ Represents the cross-correlation result of a test wav file as a match of the recording start
+
+    Args:
+        wav_file (str): Path to the test WAV file
+        latency (float): Estimated latency in seconds
+        confidence (float): Normalized correlation at the peak
+
+    Returns:
+        dict: Match of the test file, under the "xcorr" kind of events
+    """
+    return {wav_file: {"xcorr": EventMatches([0.0], [latency], [], [], confidence)}}
+
+
+def signal_entries(signals):
+    """ Creates the CSV-formatted entries of the analyzed signals
+
+    Args:
+        signals (dict): Event matches of each analyzed signal, by kind of events
+
+    Returns:
+        str: Event timestamps of each signal, or the latency and confidence for cross-correlation
+    """
+    entries = []
+    for name, matches in signals.items():
+        if "xcorr" in matches:
+            entries.append(f"{name}; {matches['xcorr'].latencies[0]}; {matches['xcorr'].confidence}\n")
+        else:
+            start, end = matches["start"], matches["end"]
+            entries.append(csv_entry(name, start.timestamps + start.unmatched, end.timestamps + end.unmatched))
+    return "".join(entries)
 
-        for j, (_end, _ref_end) in enumerate(zip(end, ref_end)):
-            # convert array index to time
-            test_end_time = _end * time_deltas_test[i]
 
-            ref_end_time = _ref_end * time_delta_ref
+def signal_stats(signals):
+    """ Computes the latency statistics of the analyzed signals
 
-            diff = test_end_time - ref_end_time
-            end_diffs.append(diff)
+    Args:
+        signals (dict): Event matches of each analyzed signal, by kind of events
+
+    Returns:
+        dict: Statistics of each analyzed signal, by kind of latency
+    """
+    file_stats = {}
+    for name, matches in signals.items():
+        file_stats[name] = {}
+        for kind, kind_matches in matches.items():
+            file_stats[name][kind] = LatencyStats()
+            file_stats[name][kind].add(kind_matches.latencies)
+    return file_stats
+
+
+def stored_matches(stored_signals):
+    """ Converts the events read from the results store back into event matches
+
+    Args:
+        stored_signals (dict): Events of each analyzed signal, by kind of events, as returned by `ResultsStore.load`
+
+    Returns:
+        dict: Event matches of each analyzed signal, by kind of events
+    """
+    signals = {}
+    for name, kinds in stored_signals.items():
+        signals[name] = {}
+        for kind, events in kinds.items():
+            matches = EventMatches([], [], [], [])
+            for status, timestamp, latency, confidence in events:
+                if status == MATCHED:
+                    matches.timestamps.append(timestamp)
+                    matches.latencies.append(latency)
+                    matches.confidence = confidence
+                elif status == UNMATCHED:
+                    matches.unmatched.append(timestamp)
+                else:
+                    matches.missed.append(timestamp)
+            signals[name][kind] = matches
+    return signals
+
+
+def recording_metadata(wav_file, digest):
+    """ Collects the capture metadata of a recording stored in the results store
+
+    Args:
+        wav_file (str): Path to the WAV file
+        digest (str): Content digest of the file
+
+    Returns:
+        dict: Path, digest, modification time and format of the recording
+    """
+    wav = open_wav(wav_file)
+    return {
+        "path": str(Path(wav_file).resolve()),
+        "digest": digest,
+        "recorded_at": os.path.getmtime(wav_file),
+        "sample_rate": wav.sample_rate,
+        "channels": wav.channels,
+        "sample_width": wav.sample_width,
+        "duration": wav.duration,
+    }
+
+
+def write_summary(path, reference, file_stats):
+    """ Writes the per-file and per-campaign latency statistics to a JSON file
+
+    Args:
+        path (str): Path to the summary file
+        reference (str): Path to the reference WAV file
+        file_stats (dict): Statistics of each analyzed signal, by kind of latency
+
+    Returns:
+        dict: Statistics of the whole campaign, by kind of latency
+    """
+    campaign = {}
+    for stats in file_stats.values():
+        for kind, kind_stats in stats.items():
+            campaign.setdefault(kind, LatencyStats()).merge(kind_stats)
 
-    with open('results.csv', 'w') as _csv:
-        _csv.writelines(csv_data)
+    summary = {
+        "reference": reference,
+        "files": {name: {kind: s.summary() for kind, s in stats.items()} for name, stats in file_stats.items()},
+        "campaign": {kind: s.summary() for kind, s in campaign.items()},
+    }
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    return campaign
+
+
+def validate_channel(ctx, param, value):
+    """ Checks the --channel option value """
+    if value in (INTERLEAVED, MIX, ALL_CHANNELS) or value.isdigit():
+        return value
+    raise click.BadParameter(f"expected '{MIX}', '{ALL_CHANNELS}', '{INTERLEAVED}' or a channel number")
+
+
+@click.command()
+@click.argument('wav_files', nargs=-1, type=click.Path(exists=True))
+@click.option('--mode', type=click.Choice(['threshold', 'xcorr']), default='threshold', show_default=True,
+              help="Latency estimation method: threshold crossing timestamps or envelope cross-correlation")
+@click.option('--backend', type=click.Choice(['numpy', 'python', 'stream']), default='numpy', show_default=True,
+              help="Implementation used for sound detection, 'stream' processes the files block by block")
+@click.option('--channel', default=MIX, show_default=True, callback=validate_channel,
+              help="Analyzed signal: 'mix' (average of the channels), 'all' (each channel separately), "
+                   "a channel number or 'interleaved' (all the samples in file order)")
+@click.option('--jobs', '-j', type=click.IntRange(min=0), default=1, show_default=True,
+              help="Number of worker processes analyzing the test files, 0 uses all CPU cores")
+@click.option('--max-latency', type=click.FloatRange(min=0), default=None,
+              help="Longest latency in seconds considered when estimating it (default: recording length)")
+@click.option('--rate', type=click.IntRange(min=1), default=None,
+              help="Common sample rate in Hz the recordings are resampled to in the xcorr mode "
+                   "(default: rate of the first test file)")
+@click.option('--expected-latency', type=click.FloatRange(min=0), default=None,
+              help="Expected latency in seconds used to match the test events with the reference events "
+                   "(default: estimated from the events)")
+@click.option('--match-window', type=click.FloatRange(min=0), default=None,
+              help="Largest accepted deviation from the expected latency in seconds "
+                   "(default: half of the shortest interval between the reference events)")
+@click.option('--background', type=click.Path(exists=True, dir_okay=False), default=None,
+              help="WAV file with only the bleeding audio, removed from the test files in memory before the analysis")
+@click.option('--aligned', is_flag=True,
+              help="Subtract the --background frame by frame while it lasts, rather than its average spectrum")
+@click.option('--clean-suffix', default=None,
+              help="Also save the test files cleaned with --background next to them, with this suffix, e.g. -clean")
+@click.option('--store', 'store_path', type=click.Path(dir_okay=False), default=None,
+              help="SQLite database accumulating the results, recordings already stored in it are not analyzed again")
+@click.option('--campaign', default=None,
+              help="Name of the measurement campaign in the results store (default: directory of the first test file)")
+@click.option('--device', default=None, help="Name of the device under test recorded in the results store")
+@click.option('--profile', is_flag=True,
+              help="Measure the wall time, peak memory and throughput of each analysis stage and file")
+@click.option('--profile-output', type=click.Path(dir_okay=False), default=None,
+              help="File receiving cProfile statistics of the main process, e.g. for snakeviz or pstats")
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help="Directory of the analysis results cache (default: ~/.cache/audio-latency-tester/analysis)")
+@click.option('--cache-size', type=click.FloatRange(min=0), default=DEFAULT_CACHE_SIZE / 2**20, show_default=True,
+              help="Size limit of the analysis results cache in MiB")
+@click.option('--no-cache', is_flag=True, help="Analyze all the files, without reading or updating the cache")
+def main(wav_files, mode, backend, channel, jobs, max_latency, rate, expected_latency, match_window,
+         background, aligned, clean_suffix, store_path, campaign, device, profile, profile_output, cache_dir, cache_size, no_cache):
+    """Calculate delay between the first wav file and any number of test wav files."""
+    if not wav_files or len(wav_files) < 2:
+        click.echo("Provide a reference wav file and at least one test wav file")
+        return
+
+    for wav_file in wav_files:
+        if not wav_file.lower().endswith('.wav'):
+            click.echo(f"Skipping {wav_file}: Not a WAV file.")
+    wav_files = [wav_file for wav_file in wav_files if wav_file.lower().endswith('.wav')]
+
+    if len(wav_files) < 2:
+        click.echo("Provide a reference wav file and at least one test wav file")
+        return
+
+    ref_name, test_names = wav_files[0], wav_files[1:]
+
+    if profile:
+        profiling.enable()
+    if profile_output is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    cache = None if no_cache else AnalysisCache(cache_dir, int(cache_size * 2**20))
+
+    # The background spectra are computed once and shared with all the workers, like the reference
+    cleaning = None
+    if background is not None:
+        with profiling.stage("background", background):
+            cleaning = prepare_background(background, test_names, aligned, clean_suffix, cache)
+
+    # The reference is analyzed only once and shared with all the workers
+    csv_data = []
+    if mode == 'xcorr':
+        # The reference is resampled to the common rate once, the captures usually already have it
+        rate = rate or open_wav(test_names[0]).sample_rate
+        with profiling.stage("reference", ref_name):
+            ref_signal, ref_digest = resampled_reference(ref_name, rate, channel, cache)
+            reference = (compute_envelope(ref_signal, rate), rate, ref_digest)
+
+        csv_data.append("filename; latency [s]; confidence\n")
+        settings = xcorr_settings(channel, max_latency, rate)
+        if cleaning is not None:
+            settings["cleaning"] = cleaning["settings"]
+        compare = functools.partial(correlate_with_reference, max_latency=max_latency, cache=cache, channel=channel)
+    else:
+        with profiling.stage("reference", ref_name):
+            reference = analyze_file(ref_name, backend, cache, channel)
+        time_delta_ref, ref_sounds = reference
+
+        csv_data.append("filename; event timestamps\n")
+        for index, (ref_start, ref_end) in enumerate(ref_sounds):
+            ref_start_timestamps = indices_to_timestamps(ref_start, time_delta_ref)
+            ref_end_timestamps = indices_to_timestamps(ref_end, time_delta_ref)
+            csv_data.append(csv_entry(signal_name(ref_name, index, len(ref_sounds)),
+                                      ref_start_timestamps, ref_end_timestamps))
+        settings = {
+            **detector_settings(channel, backend),
+            "expected_latency": expected_latency,
+            "match_window": match_window,
+            "max_latency": max_latency,
+        }
+        if cleaning is not None:
+            settings["cleaning"] = cleaning["settings"]
+        compare = functools.partial(compare_to_reference, backend=backend, cache=cache, channel=channel,
+                                    expected_latency=expected_latency, match_window=match_window,
+                                    max_latency=max_latency)
+
+    # Recordings already in the results store are read back instead of being analyzed again
+    signals = {}
+    pending = test_names
+    # The store is closed even if the analysis fails, leaving no transaction open
+    with contextlib.ExitStack() as resources:
+        if store_path is not None:
+            with profiling.stage("results_store"):
+                store = resources.enter_context(ResultsStore(store_path))
+                campaign = campaign or Path(test_names[0]).resolve().parent.name
+                ref_digest = file_digest(ref_name)
+                digests = {name: file_digest(name) for name in test_names}
+                pending = []
+                for name in test_names:
+                    recording_id = store.find(campaign, digests[name], ref_digest, settings)
+                    if recording_id is None:
+                        pending.append(name)
+                    else:
+                        click.echo(f"Using stored results of {name}")
+                        signals[name] = stored_matches(store.load(recording_id))
+
+        jobs = jobs or os.cpu_count()
+
+        if jobs == 1 or len(pending) <= 1:
+            init_worker(reference, cleaning)
+            results = list(map(compare, pending))
+        else:
+            if profile:
+                # The workers send their measurements back along with the results
+                compare = functools.partial(profiling.call_profiled, compare)
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(jobs, len(pending)), initializer=init_worker, initargs=(reference, cleaning)
+            ) as executor:
+                # map() yields the results in the order of the test files
+                results = list(executor.map(compare, pending))
+            if profile:
+                results, worker_records = zip(*results) if results else ((), ())
+                for stage_records in worker_records:
+                    profiling.records().extend(stage_records)
+
+        signals.update(zip(pending, results))
+
+        if store_path is not None:
+            with profiling.stage("results_store"):
+                for name, result in zip(pending, results):
+                    store.add(campaign, device, recording_metadata(name, digests[name]),
+                              {"path": str(Path(ref_name).resolve()), "digest": ref_digest}, settings, result)
+
+    with profiling.stage("output"):
+        file_stats = {}
+        for name in test_names:
+            csv_data.append(signal_entries(signals[name]))
+            file_stats.update(signal_stats(signals[name]))
+
+        with open('results.csv', 'w') as _csv:
+            _csv.writelines(csv_data)
+
+        campaign_stats = write_summary('summary.json', ref_name, file_stats)
+
+    if profile_output is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_output)
+        click.echo(f"Profile of the main process saved to {profile_output}")
+    if profile:
+        click.echo()
+        profiling.print_summary(profiling.records())
+        click.echo()
+        profiling.disable()
+    for kind, stats in campaign_stats.items():
+        if stats.count:
+            click.echo(f"{kind.capitalize()} latency: mean {stats.mean * 1000:.2f} ms, "
+                       f"median {stats.percentile(50) * 1000:.2f} ms, jitter {stats.std * 1000:.2f} ms "
+                       f"over {stats.count} events")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,381 @@
+#!/bin/env python3
+
+import click
+import contextlib
+import io
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from pathlib import Path
+
+import analyze
+
+# Synthetic recordings: tone bursts of BURST_S seconds repeated every PERIOD_S seconds
+TONE_HZ = 1000
+BURST_S = 0.2
+PERIOD_S = 0.5
+# Peak amplitudes of the reference bursts, the delayed bursts and the noise in the test recording
+REFERENCE_AMPLITUDE = 16000
+TEST_AMPLITUDE = 12000
+NOISE_AMPLITUDE = 300
+# Largest accepted difference between the recovered and the inserted latency, in seconds
+LATENCY_TOLERANCE = 0.001
+# Stages faster than this are too noisy to be reported as regressions, in seconds
+MIN_COMPARED_S = 0.01
+# Volume of the simulated playback and length of the simulated capture after its end, in seconds
+LOOPBACK_VOLUME = 4000
+LOOPBACK_TAIL_S = 1.0
+
+
+def tone_bursts(duration, rate, channels, amplitude, delay=0.0, noise=0, seed=0):
+    """ Generates a recording of tone bursts
+
+    Args:
+        duration (float): Length of the recording in seconds
+        rate (int): Sample rate
+        channels (int): Number of channels, all of them carry the same signal
+        amplitude (int): Peak amplitude of the bursts
+        delay (float): Delay of the first burst in seconds
+        noise (int): Peak amplitude of the uniform noise added to the recording
+        seed (int): Seed of the noise generator
+
+    Returns:
+        np.ndarray: 16-bit samples with one row per frame
+    """
+    period = int(round(PERIOD_S * rate))
+    t = np.arange(period) / rate
+    pattern = np.where(t < BURST_S, amplitude * np.sin(2 * np.pi * TONE_HZ * t), 0).astype(np.int16)
+
+    frame_count = int(round(duration * rate))
+    offset = int(round(delay * rate))
+    signal = np.zeros(frame_count, dtype=np.int16)
+    if offset < frame_count:
+        repeats = -(-(frame_count - offset) // period)
+        signal[offset:] = np.tile(pattern, repeats)[:frame_count - offset]
+
+    if noise:
+        rng = np.random.default_rng(seed)
+        signal += rng.integers(-noise, noise + 1, frame_count, dtype=np.int16)
+
+    return np.repeat(signal[:, np.newaxis], channels, axis=1)
+
+
+def write_wav(path, frames, rate):
+    """ Saves 16-bit samples to a wav file
+
+    Args:
+        path (str): Path to the output WAV file
+        frames (np.ndarray): Samples with one row per frame
+        rate (int): Sample rate
+    """
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(frames.shape[1])
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(frames.astype('<i2').tobytes())
+
+
+def timed(stages, name, function, *args, **kwargs):
+    """ Calls a function, recording its wall time
+
+    Args:
+        stages (dict): Wall times of the stages in seconds, updated with the measured one
+        name (str): Name of the stage
+        function (Callable): Function to be called
+
+    Returns:
+        Result of the function
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    stages[name] = time.perf_counter() - start
+    return result
+
+
+def time_stages(wav_file, backend, channel):
+    """ Times the stages of `analyze.process_wav` for one backend
+
+    Args:
+        wav_file (str): Path to the WAV file
+        backend (str): Implementation used for the analysis, either "numpy", "python" or "stream"
+        channel (str): Analyzed signals
+
+    Returns:
+        dict: Wall time of each stage in seconds
+    """
+    stages = {}
+    if backend == "numpy":
+        frames, _ = timed(stages, "read", analyze.read_wav_frames, wav_file)
+        signals = timed(stages, "select_channels", analyze.select_channels, frames, channel)
+        threshed = timed(stages, "sine_to_const", analyze.sine_to_const_np, signals)
+        starts = timed(stages, "find_sound_start", analyze.find_sound_start_np, threshed)
+        stops = timed(stages, "find_sound_end", analyze.find_sound_end_np, threshed)
+        timed(stages, "filter_sounds", lambda: [analyze.filter_sounds(s, e) for s, e in zip(starts, stops)])
+    elif backend == "python":
+        frames, _ = timed(stages, "read", analyze.read_wav_frames, wav_file)
+        signal = timed(stages, "select_channels",
+                       lambda: tuple(analyze.select_channels(frames, channel)[0].tolist()))
+        threshed = timed(stages, "sine_to_const", analyze.sine_to_const, signal)
+        timed(stages, "find_sound_start", analyze.find_sound_start, threshed)
+        timed(stages, "find_sound_end", analyze.find_sound_end, threshed)
+
+    timed(stages, "process_wav", analyze.process_wav, wav_file, backend, channel)
+    return stages
+
+
+def time_main(ref_file, test_file, backend, workdir):
+    """ Times the whole analysis flow of `analyze.main` and reads the recovered latency
+
+    Args:
+        ref_file (str): Path to the reference WAV file
+        test_file (str): Path to the test WAV file
+        backend (str): Implementation used for the analysis
+        workdir (str): Directory receiving the results of the analysis
+
+    Returns:
+        Tuple[float, float]: Wall time in seconds and the mean start latency, None if no events were matched
+    """
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            analyze.main([ref_file, test_file, "--backend", backend, "--no-cache"], standalone_mode=False)
+        elapsed = time.perf_counter() - start
+
+        with open("summary.json") as f:
+            summary = json.load(f)
+    finally:
+        os.chdir(cwd)
+
+    return elapsed, summary["campaign"].get("start", {}).get("mean")
+
+
+def time_loopback(ref_file, duration, delay, workdir):
+    """ Plays a recording through simulated devices and times the host side of the measurement
+
+    Both devices stream, so the length of the recording is not limited by the memory of the boards.
+
+    Args:
+        ref_file (str): Path to the played WAV file
+        duration (float): Length of the played recording in seconds
+        delay (float): Delay between the simulated playback and capture in seconds
+        workdir (str): Directory receiving the capture and the timestamps
+
+    Returns:
+        Tuple[float, str]: Wall time of the playback and capture in seconds, and the path to the captured WAV file
+    """
+    # The USB stack is only needed by this mode
+    from audio_controller import AudioController
+    from device_simulator import LoopbackSimulator
+
+    capture_file = os.path.join(workdir, "capture.wav")
+    with LoopbackSimulator(delay_s=delay, seed=0) as simulator:
+        controller = AudioController(session=simulator.session())
+        armed = threading.Event()
+        recorder = threading.Thread(
+            target=controller.start_recording,
+            args=(capture_file, os.path.join(workdir, "capture.bin")),
+            kwargs={"duration_s": duration + LOOPBACK_TAIL_S, "use_trigger": True, "on_ready": armed.set,
+                    "stream": True})
+
+        start = time.perf_counter()
+        recorder.start()
+        # The playback triggers the capture once the capture device is armed
+        while not armed.wait(0.1):
+            if not recorder.is_alive():
+                raise click.ClickException("The simulated capture failed before it was armed")
+        controller.play_audio(ref_file, os.path.join(workdir, "play.bin"), volume=LOOPBACK_VOLUME, stream=True)
+        recorder.join()
+        elapsed = time.perf_counter() - start
+
+    return elapsed, capture_file
+
+
+def git_commit():
+    """ Identifies the benchmarked version of the repository
+
+    Returns:
+        str: Hash of the current commit, with a "-dirty" suffix for uncommitted changes, None outside of git
+    """
+    repo = Path(__file__).resolve().parent.parent
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+
+def compare_results(results, baseline, max_slowdown):
+    """ Prints the timings relative to a baseline run
+
+    Args:
+        results (dict): Current benchmark results
+        baseline (dict): Earlier benchmark results
+        max_slowdown (float): Ratio of the wall times above which a stage is reported as a regression,
+                              unless it took less than MIN_COMPARED_S in the baseline
+
+    Returns:
+        List[str]: Descriptions of the regressions
+    """
+    def case_key(case):
+        return (case["duration"], case["rate"], case["channels"], case["backend"])
+
+    baseline_cases = {case_key(case): case for case in baseline["cases"]}
+    regressions = []
+    click.echo(f"Compared with {baseline.get('commit')}:")
+    for case in results["cases"]:
+        old = baseline_cases.get(case_key(case))
+        if old is None:
+            continue
+        for stage, seconds in case["stages"].items():
+            if stage not in old["stages"] or old["stages"][stage] == 0:
+                continue
+            ratio = seconds / old["stages"][stage]
+            name = "{}s {}Hz {}ch {}: {}".format(*case_key(case), stage)
+            click.echo(f"  {name:<50} {ratio:6.2f}x")
+            if ratio > max_slowdown and old["stages"][stage] >= MIN_COMPARED_S:
+                regressions.append(name)
+    return regressions
+
+
+@click.command()
+@click.option('--durations', default="1,10,60,600", show_default=True,
+              help="Comma-separated lengths of the synthetic recordings in seconds")
+@click.option('--rates', default="16000,44100", show_default=True, help="Comma-separated sample rates")
+@click.option('--channels', 'channel_counts', default="1,2", show_default=True,
+              help="Comma-separated numbers of channels")
+@click.option('--backends', default="numpy,stream", show_default=True,
+              help="Comma-separated analysis backends, the python backend is slow for long recordings")
+@click.option('--latency', type=click.FloatRange(min=0, max=PERIOD_S - BURST_S), default=0.25, show_default=True,
+              help="Latency in seconds inserted into the test recordings")
+@click.option('--repeat', type=click.IntRange(min=1), default=3, show_default=True,
+              help="Number of runs of each case, the fastest one is reported")
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help="JSON file receiving the results (default: benchmark-<commit>.json)")
+@click.option('--compare', 'baseline_file', type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Results of an earlier run to compare with")
+@click.option('--max-slowdown', type=click.FloatRange(min=1), default=1.5, show_default=True,
+              help="Slowdown relative to the compared results reported as a regression")
+@click.option('--loopback', is_flag=True,
+              help="Also play the reference recordings through simulated devices, timing the host capture and "
+                   "playback and checking the latency recovered from the captures")
+@click.option('--loopback-delay', type=click.FloatRange(min=0, max=PERIOD_S - BURST_S), default=0.1,
+              show_default=True, help="Delay in seconds between the simulated playback and capture")
+def main(durations, rates, channel_counts, backends, latency, repeat, output, baseline_file, max_slowdown,
+         loopback, loopback_delay):
+    """Benchmark the analysis pipeline on synthetic tone burst recordings with a known latency."""
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "time": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "latency": latency,
+        "loopback_delay": loopback_delay if loopback else None,
+        "cases": [],
+    }
+
+    failures = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for duration in (float(d) for d in durations.split(",")):
+            for rate in (int(r) for r in rates.split(",")):
+                for channels in (int(c) for c in channel_counts.split(",")):
+                    ref_file = os.path.join(workdir, "reference.wav")
+                    test_file = os.path.join(workdir, "test.wav")
+                    write_wav(ref_file, tone_bursts(duration, rate, channels, REFERENCE_AMPLITUDE), rate)
+                    write_wav(test_file, tone_bursts(duration, rate, channels, TEST_AMPLITUDE, latency,
+                                                     NOISE_AMPLITUDE), rate)
+
+                    for backend in backends.split(","):
+                        runs = []
+                        for _ in range(repeat):
+                            with contextlib.redirect_stdout(io.StringIO()):
+                                stages = time_stages(test_file, backend, analyze.MIX)
+                            stages["main"], recovered = time_main(ref_file, test_file, backend, workdir)
+                            runs.append(stages)
+                        stages = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+
+                        error = None if recovered is None else recovered - latency
+                        if error is None or abs(error) > LATENCY_TOLERANCE:
+                            failures.append(f"{duration}s {rate}Hz {channels}ch {backend}: latency error {error}")
+
+                        samples = int(round(duration * rate)) * channels
+                        results["cases"].append({
+                            "duration": duration,
+                            "rate": rate,
+                            "channels": channels,
+                            "backend": backend,
+                            "stages": stages,
+                            "samples_per_second": samples / stages["process_wav"],
+                            "recovered_latency": recovered,
+                            "latency_error": error,
+                        })
+                        click.echo(f"{duration:6g} s {rate:5d} Hz {channels} ch {backend:<6} "
+                                   f"process_wav {stages['process_wav']:8.4f} s, main {stages['main']:8.4f} s, "
+                                   f"{samples / stages['process_wav'] / 1e6:7.2f} Msamples/s, "
+                                   f"latency error {error}")
+
+                    if loopback:
+                        runs = []
+                        for _ in range(repeat):
+                            stages = {}
+                            with contextlib.redirect_stdout(io.StringIO()):
+                                stages["loopback"], capture_file = time_loopback(ref_file, duration,
+                                                                                 loopback_delay, workdir)
+                            stages["main"], recovered = time_main(ref_file, capture_file, "numpy", workdir)
+                            runs.append(stages)
+                        stages = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+
+                        error = None if recovered is None else recovered - loopback_delay
+                        if error is None or abs(error) > LATENCY_TOLERANCE:
+                            failures.append(f"{duration}s {rate}Hz {channels}ch loopback: latency error {error}")
+
+                        samples = int(round(duration * rate)) * channels
+                        results["cases"].append({
+                            "duration": duration,
+                            "rate": rate,
+                            "channels": channels,
+                            "backend": "loopback",
+                            "stages": stages,
+                            "samples_per_second": samples / stages["loopback"],
+                            "recovered_latency": recovered,
+                            "latency_error": error,
+                        })
+                        click.echo(f"{duration:6g} s {rate:5d} Hz {channels} ch {'loopback':<6} "
+                                   f"loopback {stages['loopback']:8.4f} s, main {stages['main']:8.4f} s, "
+                                   f"{samples / stages['loopback'] / 1e6:7.2f} Msamples/s, "
+                                   f"latency error {error}")
+
+    output = output or f"benchmark-{(commit or 'unknown')[:12]}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    click.echo(f"Results saved to {output}")
+
+    for failure in failures:
+        click.echo(f"Wrong latency recovered: {failure}")
+
+    regressions = []
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            regressions = compare_results(results, json.load(f), max_slowdown)
+        for regression in regressions:
+            click.echo(f"Regression: {regression}")
+
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+""" Single-pass accumulators of latency statistics """
+
+import math
+from collections import Counter
+
+import numpy as np
+
+# Width of the histogram bins used to estimate the percentiles, in seconds
+HISTOGRAM_RESOLUTION = 1e-4
+# Percentiles included in the summaries
+PERCENTILES = (5, 50, 95, 99)
+
+
+class LatencyStats:
+    """ Running count, mean, variance, extremes and histogram of latency values
+
+    The values are seen only once: the moments are updated with Welford's algorithm and the
+    percentiles are read from a sparse histogram, exact up to its resolution. Accumulators of
+    separate files can be merged into the statistics of a whole campaign.
+    """
+
+    def __init__(self, resolution=HISTOGRAM_RESOLUTION):
+        """ Initializes an empty accumulator
+
+        Args:
+            resolution (float): Width of the histogram bins in seconds
+        """
+        self.resolution = resolution
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.histogram = Counter()
+
+    def add(self, values):
+        """ Adds a batch of latency values
+
+        Args:
+            values (Sequence[float]): Latencies in seconds
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+
+        batch = LatencyStats(self.resolution)
+        batch.count = len(values)
+        batch.mean = float(values.mean())
+        batch.m2 = float(((values - batch.mean) ** 2).sum())
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+        bins, counts = np.unique(np.rint(values / self.resolution).astype(np.int64), return_counts=True)
+        batch.histogram = Counter(dict(zip(bins.tolist(), counts.tolist())))
+        self.merge(batch)
+
+    def merge(self, other):
+        """ Adds the values of another accumulator
+
+        Args:
+            other (LatencyStats): Accumulator with the same resolution
+        """
+        if other.count == 0:
+            return
+        if other.resolution != self.resolution:
+            raise ValueError("Cannot merge latency statistics with different resolutions")
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram.update(other.histogram)
+
+    @property
+    def std(self):
+        """ Sample standard deviation (jitter) of the latencies """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def percentile(self, q):
+        """ Estimates a percentile from the histogram, interpolating linearly between the ranks
+
+        Args:
+            q (float): Percentile between 0 and 100
+
+        Returns:
+            float: Latency in seconds, None if no values were added
+        """
+        if self.count == 0:
+            return None
+
+        bins = sorted(self.histogram)
+        cumulative = np.cumsum([self.histogram[b] for b in bins])
+        rank = q / 100 * (self.count - 1)
+
+        def value(k):
+            return bins[int(np.searchsorted(cumulative, k, side='right'))] * self.resolution
+
+        lower, upper = value(math.floor(rank)), value(math.ceil(rank))
+        estimate = lower + (upper - lower) * (rank - math.floor(rank))
+        # The extremes are tracked exactly
+        return float(min(max(estimate, self.min), self.max))
+
+    def summary(self):
+        """ Returns the statistics in a JSON-serializable form
+
+        Returns:
+            dict: Count, mean, median, percentiles, standard deviation and extremes in seconds,
+                  all but the count are None if no values were added
+        """
+        if self.count == 0:
+            stats = dict.fromkeys(["mean", "median", *(f"p{q}" for q in PERCENTILES if q != 50),
+                                   "std", "min", "max"])
+            return {"count": 0, **stats}
+
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "median": self.percentile(50),
+            **{f"p{q}": self.percentile(q) for q in PERCENTILES if q != 50},
+            "std": self.std,
+            "min": self.min,
+            "max": self.max,
+        }
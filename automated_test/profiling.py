@@ -0,0 +1,189 @@
+""" Opt-in instrumentation of the analysis stages: wall time, peak memory and sample throughput """
+
+import contextlib
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+import click
+
+# Active profiler of the current process, None while profiling is disabled
+_profiler = None
+# Returned by `stage` while profiling is disabled, so instrumented code costs a single function call
+_DISABLED = contextlib.nullcontext()
+# Stages measuring the whole processing of a file and stages counting all of its samples
+FILE_STAGES = ("analyze", "correlate")
+READ_STAGES = ("read", "stream_detection")
+
+
+@dataclass
+class StageRecord:
+    """ Measurements of a single execution of a pipeline stage """
+
+    stage: str
+    file: str
+    seconds: float
+    # Peak of the memory allocated by Python and NumPy during the stage, above the amount allocated before it
+    peak_bytes: int
+    samples: int
+
+
+class Profiler:
+    """ Collects the measurements of the stages executed in the current process """
+
+    def __init__(self):
+        self.records = []
+        # Highest memory peak seen by each of the stages in progress, innermost last
+        self._peaks = []
+
+    @contextlib.contextmanager
+    def stage(self, name, file=None, samples=0):
+        """ Measures the enclosed code as a pipeline stage
+
+        Args:
+            name (str): Name of the stage
+            file (str): Processed file, None for stages not bound to a file
+            samples (int): Number of processed samples, can be updated with `set_samples`
+
+        Yields:
+            StageRecord: Measurements of the stage, filled in when it ends
+        """
+        record = StageRecord(name, file, 0.0, 0, samples)
+        current, peak = tracemalloc.get_traced_memory()
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        self._peaks.append(current)
+        # The tracemalloc peak is global, the peaks of the enclosing stages are kept in `_peaks`
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            stage_peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], stage_peak)
+            record.peak_bytes = stage_peak - current
+            self.records.append(record)
+
+
+def enable():
+    """ Starts profiling the stages executed in the current process """
+    global _profiler
+    _profiler = Profiler()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """ Stops profiling and discards the collected measurements, e.g. between the jobs of a long-lived process """
+    global _profiler
+    _profiler = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def stage(name, file=None, samples=0):
+    """ Returns a context manager measuring the enclosed code as a pipeline stage, if profiling is enabled
+
+    Args:
+        name (str): Name of the stage
+        file (str): Processed file, None for stages not bound to a file
+        samples (int): Number of processed samples
+
+    Returns:
+        ContextManager: Stage measurement yielding its `StageRecord`, or a no-op yielding None
+                        while profiling is disabled
+    """
+    if _profiler is None:
+        return _DISABLED
+    return _profiler.stage(name, file, samples)
+
+
+def set_samples(record, samples):
+    """ Sets the number of samples processed in a stage, once it is known
+
+    Args:
+        record (StageRecord): Measurements of the stage, None while profiling is disabled
+        samples (int): Number of processed samples
+    """
+    if record is not None:
+        record.samples = samples
+
+
+def records():
+    """ Returns the measurements collected in the current process
+
+    Returns:
+        List[StageRecord]: Measurements in the order of completion of the stages
+    """
+    return _profiler.records if _profiler is not None else []
+
+
+def call_profiled(function, *args):
+    """ Calls a function with profiling enabled, e.g. in a worker process
+
+    Args:
+        function (Callable): Function to be called
+
+    Returns:
+        Tuple: Result of the function and the measurements of the stages it executed
+    """
+    if _profiler is None:
+        enable()
+    first = len(_profiler.records)
+    result = function(*args)
+    return result, _profiler.records[first:]
+
+
+def aggregate(stage_records, key):
+    """ Sums up the measurements sharing a key
+
+    Args:
+        stage_records (List[StageRecord]): Measurements to be aggregated
+        key (Callable): Returns the aggregation key of a measurement
+
+    Returns:
+        dict: Number of calls, total time, highest peak memory and total samples for each key
+    """
+    totals = {}
+    for record in stage_records:
+        calls, seconds, peak, samples = totals.get(key(record), (0, 0.0, 0, 0))
+        totals[key(record)] = (calls + 1, seconds + record.seconds, max(peak, record.peak_bytes),
+                               samples + record.samples)
+    return totals
+
+
+def echo_table(title, totals):
+    """ Prints aggregated measurements as a table
+
+    Args:
+        title (str): Header of the first column
+        totals (dict): Aggregated measurements, as returned by `aggregate`
+    """
+    width = max([len(title), *(len(str(name)) for name in totals)])
+    click.echo(f"{title:<{width}} {'calls':>6} {'time [s]':>10} {'peak [MiB]':>11} {'Msamples/s':>11}")
+    for name, (calls, seconds, peak, samples) in totals.items():
+        throughput = f"{samples / seconds / 1e6:11.2f}" if samples and seconds else f"{'-':>11}"
+        click.echo(f"{name:<{width}} {calls:>6} {seconds:>10.4f} {peak / 2**20:>11.2f} {throughput}")
+
+
+def print_summary(stage_records):
+    """ Prints the measurements aggregated per stage and per file
+
+    The time and memory of a file are taken from its top-level stages (FILE_STAGES), which include
+    the nested ones, and its samples from its READ_STAGES.
+
+    Args:
+        stage_records (List[StageRecord]): Measurements to be summarized
+    """
+    echo_table("Stage", aggregate(stage_records, lambda record: record.stage))
+
+    file_totals = aggregate([r for r in stage_records if r.file is not None and r.stage in FILE_STAGES],
+                            lambda record: record.file)
+    samples = aggregate([r for r in stage_records if r.stage in READ_STAGES], lambda record: record.file)
+    for name, (calls, seconds, peak, _) in file_totals.items():
+        file_totals[name] = (calls, seconds, peak, samples.get(name, (0, 0.0, 0, 0))[3])
+
+    click.echo()
+    echo_table("File", file_totals)
@@ -0,0 +1,100 @@
+""" Polyphase resampling of audio signals to a common rate """
+
+import math
+
+import numpy as np
+
+# Half-length of the anti-aliasing filter, in samples of the slower of the two rates
+FILTER_HALF_WIDTH = 10
+# Shape of the Kaiser window applied to the filter
+KAISER_BETA = 5.0
+
+
+def design_filter(up, down):
+    """ Designs the low-pass filter applied to the upsampled signal
+
+    The filter is a Kaiser-windowed sinc with the cutoff at the lower of the two Nyquist frequencies,
+    scaled by `up` to preserve the signal amplitude after the zeros are inserted.
+
+    Args:
+        up (int): Upsampling factor
+        down (int): Downsampling factor
+
+    Returns:
+        np.ndarray: Filter taps, an odd number of them, centered on the middle tap
+    """
+    max_rate = max(up, down)
+    half_length = FILTER_HALF_WIDTH * max_rate
+    n = np.arange(-half_length, half_length + 1)
+    taps = np.sinc(n / max_rate) * np.kaiser(len(n), KAISER_BETA)
+    return taps * (up / taps.sum())
+
+
+def resample_poly(signal, up, down):
+    """ Resamples a signal by a rational factor with a polyphase filter
+
+    Equivalent to inserting `up - 1` zeros between the samples, low-pass filtering and keeping
+    every `down`-th sample, but only the filter taps hitting non-zero samples are evaluated.
+    The filter delay is compensated, so the output is aligned with the input.
+
+    Args:
+        signal (np.ndarray): Samples along the first axis, e.g. one row per frame
+        up (int): Upsampling factor
+        down (int): Downsampling factor
+
+    Returns:
+        np.ndarray: float64 signal with `ceil(len(signal) * up / down)` samples
+    """
+    divisor = math.gcd(up, down)
+    up, down = up // divisor, down // divisor
+    signal = np.asarray(signal, dtype=np.float64)
+    if up == down:
+        return signal
+
+    taps = design_filter(up, down)
+    half_length = len(taps) // 2
+    # Polyphase components: phase p holds the taps p, p + up, p + 2 * up, ...
+    phase_taps = -(-len(taps) // up)
+    phases = np.zeros(phase_taps * up)
+    phases[:len(taps)] = taps
+    phases = phases.reshape(phase_taps, up).T
+
+    out_count = -(-len(signal) * up // down)
+    output = np.zeros((out_count,) + signal.shape[1:])
+    if out_count == 0:
+        return output
+
+    # Output sample m lies at m * down + half_length in the upsampled signal, after the filter delay.
+    # The outputs m = r, r + up, r + 2 * up, ... use the same filter phase and input samples
+    # `down` apart, so each of these sequences is a dot product with strided windows of the input.
+    last_base = ((out_count - 1) * down + half_length) // up
+    padded = np.concatenate([
+        np.zeros((phase_taps - 1,) + signal.shape[1:]),
+        signal,
+        np.zeros((max(0, last_base + 1 - len(signal)),) + signal.shape[1:]),
+    ])
+    # Window i holds the padded samples i ... i + phase_taps - 1, ending at input sample i
+    windows = np.lib.stride_tricks.sliding_window_view(padded, phase_taps, axis=0)
+
+    for first in range(min(up, out_count)):
+        position = first * down + half_length
+        phase, base = position % up, position // up
+        outputs = output[first::up]
+        outputs[...] = windows[base::down][:len(outputs)] @ phases[phase, ::-1]
+    return output
+
+
+def resample(signal, rate_from, rate_to):
+    """ Resamples a signal to a different rate
+
+    Args:
+        signal (np.ndarray): Samples along the first axis, e.g. one row per frame
+        rate_from (int): Rate of the provided signal
+        rate_to (int): Requested rate
+
+    Returns:
+        np.ndarray: Signal sampled with `rate_to`, the input itself if the rates are equal
+    """
+    if rate_from == rate_to:
+        return signal
+    return resample_poly(signal, int(rate_to), int(rate_from))
@@ -0,0 +1,166 @@
+""" SQLite store of analysis results, accumulating the recordings of measurement campaigns """
+
+import json
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY,
+    campaign TEXT NOT NULL,
+    device TEXT,
+    path TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    reference TEXT NOT NULL,
+    reference_digest TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    recorded_at REAL,
+    analyzed_at REAL NOT NULL,
+    sample_rate INTEGER,
+    channels INTEGER,
+    sample_width INTEGER,
+    duration REAL,
+    UNIQUE (campaign, digest, reference_digest, settings)
+);
+CREATE INDEX IF NOT EXISTS recordings_campaign ON recordings (campaign, recorded_at);
+CREATE INDEX IF NOT EXISTS recordings_device ON recordings (device, recorded_at);
+CREATE INDEX IF NOT EXISTS recordings_recorded_at ON recordings (recorded_at);
+
+CREATE TABLE IF NOT EXISTS events (
+    recording_id INTEGER NOT NULL REFERENCES recordings (id) ON DELETE CASCADE,
+    signal TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    timestamp REAL,
+    latency REAL,
+    confidence REAL
+);
+CREATE INDEX IF NOT EXISTS events_recording ON events (recording_id, signal, kind);
+"""
+
+# Status of the stored events: paired with a reference event, spurious in the recording or missing from it
+MATCHED = "matched"
+UNMATCHED = "unmatched"
+MISSED = "missed"
+
+
+class ResultsStore:
+    """ SQLite database of the analyzed recordings and their events
+
+    Each recording is stored once per campaign, reference and analysis settings, identified by the
+    content digests of the files, so repeated runs only append the recordings which are new.
+    """
+
+    def __init__(self, path):
+        """ Opens the database, creating it if needed
+
+        Args:
+            path (str): Path to the SQLite database file
+        """
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        """ Closes the database """
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def find(self, campaign, digest, reference_digest, settings):
+        """ Looks up a stored recording
+
+        Args:
+            campaign (str): Name of the measurement campaign
+            digest (str): Content digest of the recording
+            reference_digest (str): Content digest of the reference file
+            settings (dict): Analysis settings
+
+        Returns:
+            int: Identifier of the recording, None if it is not stored
+        """
+        row = self.connection.execute(
+            "SELECT id FROM recordings WHERE campaign = ? AND digest = ? AND reference_digest = ? AND settings = ?",
+            (campaign, digest, reference_digest, json.dumps(settings, sort_keys=True)),
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def add(self, campaign, device, recording, reference, settings, signals):
+        """ Appends an analyzed recording
+
+        Args:
+            campaign (str): Name of the measurement campaign
+            device (str): Name of the device under test, may be None
+            recording (dict): Path, digest, recorded_at time and capture metadata of the recording:
+                              sample_rate, channels, sample_width and duration
+            reference (dict): Path and digest of the reference file
+            settings (dict): Analysis settings
+            signals (dict): Event matches of each analyzed signal, by kind of events
+
+        Returns:
+            int: Identifier of the recording
+        """
+        with self.connection:
+            # Analyzing a stored recording again replaces its events
+            self.connection.execute(
+                "DELETE FROM recordings WHERE campaign = ? AND digest = ? AND reference_digest = ? AND settings = ?",
+                (campaign, recording["digest"], reference["digest"], json.dumps(settings, sort_keys=True)),
+            )
+            cursor = self.connection.execute(
+                "INSERT INTO recordings (campaign, device, path, digest, reference, reference_digest, "
+                "settings, recorded_at, analyzed_at, sample_rate, channels, sample_width, duration) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (campaign, device, recording["path"], recording["digest"], reference["path"], reference["digest"],
+                 json.dumps(settings, sort_keys=True), recording.get("recorded_at"), time.time(),
+                 recording.get("sample_rate"), recording.get("channels"), recording.get("sample_width"),
+                 recording.get("duration")),
+            )
+            recording_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO events (recording_id, signal, kind, status, timestamp, latency, confidence) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(recording_id, *event) for event in event_rows(signals)],
+            )
+        return recording_id
+
+    def load(self, recording_id):
+        """ Reads the events of a stored recording
+
+        Args:
+            recording_id (int): Identifier of the recording
+
+        Returns:
+            dict: Events of each analyzed signal, by kind of events, as (status, timestamp, latency, confidence) tuples
+        """
+        signals = {}
+        rows = self.connection.execute(
+            "SELECT signal, kind, status, timestamp, latency, confidence FROM events "
+            "WHERE recording_id = ? ORDER BY rowid",
+            (recording_id,),
+        )
+        for signal, kind, *event in rows:
+            signals.setdefault(signal, {}).setdefault(kind, []).append(tuple(event))
+        return signals
+
+
+def event_rows(signals):
+    """ Flattens the event matches into database rows
+
+    Args:
+        signals (dict): Event matches of each analyzed signal, by kind of events
+
+    Returns:
+        List[tuple]: Signal, kind, status, timestamp, latency and confidence of each event
+    """
+    rows = []
+    for signal, kinds in signals.items():
+        for kind, matches in kinds.items():
+            rows.extend((signal, kind, MATCHED, timestamp, latency, matches.confidence)
+                        for timestamp, latency in zip(matches.timestamps, matches.latencies))
+            rows.extend((signal, kind, UNMATCHED, timestamp, None, None) for timestamp in matches.unmatched)
+            rows.extend((signal, kind, MISSED, timestamp, None, None) for timestamp in matches.missed)
+    return rows
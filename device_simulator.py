@@ -0,0 +1,561 @@
+"""Software loopback of the playback and capture devices, speaking their USB packet protocol.
+
+The simulated devices are injected into `AudioController` through a `DeviceSession`, so the host pipeline runs
+unchanged without the boards, e.g. for benchmarks and regression tests. The capture device records what the
+playback device plays, with a configurable delay, noise and clock drift.
+"""
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+import array
+import math
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+import usb.core
+
+from audio_controller import (
+    CAPTURE_SAMPLES_PER_BUFFER,
+    CFG_PACKET_MAGIC_HDR,
+    PLAYBACK_SAMPLES_PER_BUFFER,
+    READY_PACKET_MAGIC_HDR,
+    STOP_PACKET_MAGIC_HDR,
+    STREAM_END_PACKET_MAGIC_HDR,
+    STREAM_PACKET_DTYPE,
+    STREAM_PACKET_MAGIC_HDR,
+    STREAM_PACKET_TIMESTAMPS,
+    STREAM_TIMESTAMPS_MAGIC_HDR,
+    STREAM_TIMESTAMPS_PACKET_DTYPE,
+    TIMESTAMP_PACKET_MAGIC_HDR,
+    USB_PACKET_SIZE,
+    USB_PRODUCT_ID_CAPTURE,
+    USB_PRODUCT_ID_PLAYBACK,
+    DeviceSession,
+    UsbDevice,
+)
+from timestamp_log import TIMESTAMP_DTYPE
+
+# Sample rate of the microphone of the capture device, whatever the configuration packet asks for
+CAPTURE_SAMPLE_RATE = 16000
+# Memory of the playback firmware in 16-bit stereo frames, larger runs are only accepted while streaming
+PLAYBACK_MAX_FRAME_COUNT = 48000
+# The playback firmware starts a stream once a quarter of its memory is filled
+PLAYBACK_STREAM_PREFILL_SIZE = PLAYBACK_MAX_FRAME_COUNT * 2 * 2 // 4
+# Packets queued by an endpoint before the writing side is held back, like a NAKed USB transfer
+ENDPOINT_QUEUE_PACKETS = 256
+# Timeout of the pyusb transfers called without one, in milliseconds
+USB_DEFAULT_TIMEOUT_MS = 1000
+# Interval at which blocked firmware threads check whether the simulator was closed, in seconds
+POLL_INTERVAL_S = 0.1
+# Buffers generated at once by a streaming capture
+STREAM_GENERATED_BUFFERS = 32
+
+
+class DeviceClosed(usb.core.USBError):
+    """Raised by the endpoints of a closed simulator, ending the firmware threads."""
+
+    def __init__(self):
+        super().__init__("No such device (the simulator was closed)")
+
+
+@dataclass
+class SimulatedConfig:
+    """Fields of a configuration packet received by a simulated device."""
+
+    sample_count: int
+    sample_rate: int
+    sample_depth: int
+    channels_count: int
+    volume: int
+    use_trigger: bool
+    stream: bool
+
+
+class SimulatedEndpoint:
+    """Bulk endpoint of a simulated device, a queue of packets between the host and the firmware.
+
+    The host side follows the pyusb `read` and `write` calls used by `audio_controller`, the firmware
+    side exchanges single packets.
+    """
+
+    def __init__(self, address: int, depth: int = ENDPOINT_QUEUE_PACKETS):
+        """
+        Args:
+            address: Endpoint address, with bit 7 set for IN endpoints.
+            depth: Number of packets queued before the writer is held back.
+        """
+        self.bEndpointAddress = address
+        self._packets = queue.Queue(depth)
+        self._closed = threading.Event()
+
+    def close(self):
+        """Makes the pending and following transfers fail with DeviceClosed."""
+        self._closed.set()
+
+    def put(self, packet: bytes, timeout: float | None = None):
+        """Queues a packet, waiting while the queue is full.
+
+        Args:
+            packet: Packet of at most USB_PACKET_SIZE bytes, a zero-length packet ends a transfer.
+            timeout: Timeout in seconds, None waits until the simulator is closed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._closed.is_set():
+                raise DeviceClosed()
+            wait = POLL_INTERVAL_S if deadline is None else min(POLL_INTERVAL_S, deadline - time.monotonic())
+            try:
+                self._packets.put(packet, timeout=max(wait, 0))
+                return
+            except queue.Full:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise usb.core.USBTimeoutError("Operation timed out")
+
+    def get(self, timeout: float | None = None) -> bytes:
+        """Takes the next packet, waiting until one is queued.
+
+        Args:
+            timeout: Timeout in seconds, None waits until the simulator is closed.
+
+        Returns:
+            The packet.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._closed.is_set():
+                raise DeviceClosed()
+            wait = POLL_INTERVAL_S if deadline is None else min(POLL_INTERVAL_S, deadline - time.monotonic())
+            try:
+                return self._packets.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise usb.core.USBTimeoutError("Operation timed out")
+
+    def poll(self) -> bytes | None:
+        """Takes the next packet if there is one, without waiting."""
+        try:
+            return self._packets.get_nowait()
+        except queue.Empty:
+            return None
+
+    def write(self, data, timeout: int | None = None) -> int:
+        """Sends data from the host in USB_PACKET_SIZE packets, like `usb.core.Endpoint.write`."""
+        view = memoryview(data).cast("B")
+        deadline = time.monotonic() + _timeout_s(timeout)
+        for offset in range(0, len(view), USB_PACKET_SIZE):
+            self.put(bytes(view[offset : offset + USB_PACKET_SIZE]), max(deadline - time.monotonic(), 0))
+        return len(view)
+
+    def read(self, size_or_buffer, timeout: int | None = None):
+        """Receives data on the host, like `usb.core.Endpoint.read`.
+
+        The transfer ends once the requested size is received or after a short packet.
+
+        Args:
+            size_or_buffer: Number of bytes to read, or an array.array to read into.
+            timeout: Timeout of the whole transfer in milliseconds, None uses the pyusb default.
+
+        Returns:
+            The received data, or the number of bytes read into the buffer.
+        """
+        buffer = None if isinstance(size_or_buffer, int) else size_or_buffer
+        size = size_or_buffer if buffer is None else len(buffer) * buffer.itemsize
+        deadline = time.monotonic() + _timeout_s(timeout)
+
+        data = bytearray()
+        while len(data) < size:
+            packet = self.get(max(deadline - time.monotonic(), 0))
+            if len(data) + len(packet) > size:
+                raise usb.core.USBError("Overflow")
+            data += packet
+            if len(packet) < USB_PACKET_SIZE:
+                break
+
+        if buffer is None:
+            return array.array("B", data)
+        memoryview(buffer).cast("B")[: len(data)] = data
+        return len(data)
+
+
+def _timeout_s(timeout: int | None) -> float:
+    """Converts a pyusb timeout in milliseconds to seconds."""
+    return (USB_DEFAULT_TIMEOUT_MS if timeout is None else timeout) / 1000
+
+
+class SimulatedDevice(ABC):
+    """Firmware of a simulated device, serving the runs requested by the host in a thread."""
+
+    product_id: int
+
+    def __init__(self, loopback: "LoopbackSimulator"):
+        self.loopback = loopback
+        self.ep_out = SimulatedEndpoint(0x01)
+        self.ep_in = SimulatedEndpoint(0x81)
+        self._thread = threading.Thread(target=self._serve, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the firmware thread."""
+        self.ep_out.close()
+        self.ep_in.close()
+        self._thread.join()
+
+    def _serve(self):
+        try:
+            while True:
+                cfg = self._receive_config()
+                if cfg is not None:
+                    self._run(cfg)
+        except DeviceClosed:
+            pass
+
+    @abstractmethod
+    def _run(self, cfg: SimulatedConfig):
+        """Serves a run configured by the host."""
+        pass
+
+    def _receive_config(self) -> SimulatedConfig | None:
+        """Waits for a configuration packet, returns None for any other packet, like the firmware."""
+        packet = self.ep_out.get().ljust(32, b"\0")
+        magic, *fields = struct.unpack_from("<8I", packet)
+        if magic != CFG_PACKET_MAGIC_HDR:
+            return None
+        sample_count, sample_rate, sample_depth, channels_count, volume, use_trigger, stream = fields
+        return SimulatedConfig(
+            sample_count, sample_rate, sample_depth, channels_count, volume, bool(use_trigger), bool(stream)
+        )
+
+    def _receive(self, size: int) -> bytes:
+        """Receives the given number of bytes sent by the host in USB_PACKET_SIZE packets."""
+        packets = [self.ep_out.get() for _ in range(math.ceil(size / USB_PACKET_SIZE))]
+        return b"".join(packets)[:size]
+
+    def _send(self, data: bytes):
+        """Sends data to the host in whole USB_PACKET_SIZE packets, the last one padded."""
+        view = memoryview(data)
+        for offset in range(0, len(view), USB_PACKET_SIZE):
+            self.ep_in.put(bytes(view[offset : offset + USB_PACKET_SIZE]).ljust(USB_PACKET_SIZE, b"\0"))
+
+    def _send_final_packet(self):
+        """Sends the zero-length packet ending a run, which the host acknowledges."""
+        self.ep_in.put(b"")
+
+
+class SimulatedCaptureDevice(SimulatedDevice):
+    """Capture device recording the signal of the simulated acoustic path."""
+
+    product_id = USB_PRODUCT_ID_CAPTURE
+
+    def _run(self, cfg: SimulatedConfig):
+        if not cfg.stream and cfg.sample_count == 0:
+            return
+
+        self._send(struct.pack("<I60x", READY_PACKET_MAGIC_HDR))
+        start, playback = self.loopback.wait_trigger() if cfg.use_trigger else (self.loopback.now(), None)
+        # The timestamps are taken by the device clock at the end of each buffer
+        first_timestamp = self.loopback.capture_clock_us(start) + self.loopback.capture_buffer_us
+
+        if cfg.stream:
+            self._stream(playback, first_timestamp)
+        else:
+            self._record(cfg.sample_count, playback, first_timestamp)
+
+    def _record(self, sample_count: int, playback: int | None, first_timestamp: int):
+        samples = self.loopback.captured(0, sample_count, playback)
+        self._send(samples.astype("<i2").tobytes())
+
+        buffer_count = math.ceil(sample_count / CAPTURE_SAMPLES_PER_BUFFER)
+        timestamps = first_timestamp + np.arange(buffer_count, dtype=np.int64) * self.loopback.capture_buffer_us
+        self._send(struct.pack("<II56x", TIMESTAMP_PACKET_MAGIC_HDR, buffer_count))
+        self._send(timestamps.astype(TIMESTAMP_DTYPE).tobytes())
+        self._send_final_packet()
+
+    def _stream(self, playback: int | None, first_timestamp: int):
+        packets = np.zeros(STREAM_GENERATED_BUFFERS, dtype=STREAM_PACKET_DTYPE)
+        packets["id"] = STREAM_PACKET_MAGIC_HDR
+        sequence = 0
+        while not self._stop_requested():
+            index = sequence % STREAM_GENERATED_BUFFERS
+            if index == 0:
+                samples = self.loopback.captured(
+                    sequence * CAPTURE_SAMPLES_PER_BUFFER,
+                    STREAM_GENERATED_BUFFERS * CAPTURE_SAMPLES_PER_BUFFER,
+                    playback,
+                )
+                packets["samples"] = samples.reshape(STREAM_GENERATED_BUFFERS, CAPTURE_SAMPLES_PER_BUFFER)
+                packets["sequence"] = sequence + np.arange(STREAM_GENERATED_BUFFERS)
+                packets["timestamp"] = (
+                    first_timestamp + packets["sequence"].astype(np.int64) * self.loopback.capture_buffer_us
+                )
+            self._send(packets[index].tobytes())
+            sequence += 1
+
+        end_packet = np.zeros(1, dtype=STREAM_PACKET_DTYPE)
+        end_packet["id"] = STREAM_END_PACKET_MAGIC_HDR
+        end_packet["sequence"] = sequence
+        self._send(end_packet.tobytes())
+
+    def _stop_requested(self) -> bool:
+        packet = self.ep_out.poll()
+        return packet is not None and struct.unpack_from("<I", packet.ljust(4, b"\0"))[0] == STOP_PACKET_MAGIC_HDR
+
+
+class SimulatedPlaybackDevice(SimulatedDevice):
+    """Playback device feeding the simulated acoustic path."""
+
+    product_id = USB_PRODUCT_ID_PLAYBACK
+
+    def _run(self, cfg: SimulatedConfig):
+        # The firmware plays 16-bit samples and rejects runs which do not fit its memory
+        if cfg.sample_count == 0 or cfg.sample_rate == 0 or cfg.sample_depth != 2 or cfg.channels_count == 0:
+            return
+        if not cfg.stream and cfg.sample_count > PLAYBACK_MAX_FRAME_COUNT:
+            return
+
+        size = cfg.sample_count * cfg.sample_depth * cfg.channels_count
+        buffer_count = math.ceil(cfg.sample_count / PLAYBACK_SAMPLES_PER_BUFFER)
+        if cfg.stream:
+            self._stream(cfg, size, buffer_count)
+        else:
+            self._play(cfg, self._receive(size), buffer_count)
+
+    def _timestamps(self, start: float, cfg: SimulatedConfig, first: int, count: int) -> np.ndarray:
+        """Returns the device clock at the start of the given buffers."""
+        buffers = np.arange(first, first + count)
+        return np.round((start + buffers * PLAYBACK_SAMPLES_PER_BUFFER / cfg.sample_rate) * 1e6).astype(TIMESTAMP_DTYPE)
+
+    def _play(self, cfg: SimulatedConfig, data: bytes, buffer_count: int):
+        start = self.loopback.start_playback(cfg.sample_rate, cfg.use_trigger)
+        if cfg.use_trigger:
+            self.loopback.play(self._scale(cfg, data))
+            self.loopback.finish_playback()
+
+        self._send(struct.pack("<II56x", TIMESTAMP_PACKET_MAGIC_HDR, buffer_count))
+        self._send(self._timestamps(start, cfg, 0, buffer_count).tobytes())
+        self._send_final_packet()
+
+    def _stream(self, cfg: SimulatedConfig, size: int, buffer_count: int):
+        buffer_size = PLAYBACK_SAMPLES_PER_BUFFER * cfg.sample_depth * cfg.channels_count
+        pending = bytearray()
+        received = 0
+        played = 0
+        reported = 0
+        start = None
+        while reported < buffer_count:
+            if received < size:
+                packet = self.ep_out.get()
+                pending += packet
+                received += len(packet)
+
+            if start is None and (received >= size or received >= PLAYBACK_STREAM_PREFILL_SIZE):
+                start = self.loopback.start_playback(cfg.sample_rate, cfg.use_trigger)
+            if start is None:
+                continue
+
+            # Whole buffers are played as they arrive, the last one once the stream is received
+            playable = len(pending) if received >= size else len(pending) - len(pending) % buffer_size
+            if playable:
+                if cfg.use_trigger:
+                    self.loopback.play(self._scale(cfg, bytes(pending[:playable])))
+                del pending[:playable]
+                played = min(math.ceil((received - len(pending)) / buffer_size), buffer_count)
+
+            while played - reported >= STREAM_PACKET_TIMESTAMPS or (played == buffer_count and reported < played):
+                count = min(played - reported, STREAM_PACKET_TIMESTAMPS)
+                packet = np.zeros(1, dtype=STREAM_TIMESTAMPS_PACKET_DTYPE)
+                packet["id"] = STREAM_TIMESTAMPS_MAGIC_HDR
+                packet["count"] = count
+                packet["timestamps"][0, :count] = self._timestamps(start, cfg, reported, count)
+                self._send(packet.tobytes())
+                reported += count
+
+        if cfg.use_trigger:
+            self.loopback.finish_playback()
+        # The simulated host is never late, the ring buffer does not run empty
+        self._send(struct.pack("<II56x", STREAM_END_PACKET_MAGIC_HDR, 0))
+
+    @staticmethod
+    def _scale(cfg: SimulatedConfig, data: bytes) -> np.ndarray:
+        """Applies the volume multiplier like the firmware and mixes the channels down."""
+        samples = np.frombuffer(data, dtype="<i2")
+        samples = samples[: len(samples) - len(samples) % cfg.channels_count].reshape(-1, cfg.channels_count)
+        # The firmware truncates the scaled samples to 16 bits
+        scaled = ((samples.astype(np.int64) * cfg.volume) >> 15).astype(np.int16)
+        return scaled.mean(axis=1)
+
+
+class LoopbackSimulator:
+    """Playback and capture devices connected by a simulated acoustic path and trigger line.
+
+    Time runs as fast as the host exchanges the packets, the device clocks follow the played and recorded
+    samples instead of the wall clock. A triggered capture records the signal of the playback that triggered it.
+    """
+
+    def __init__(
+        self,
+        delay_s: float = 0.1,
+        noise: float = 50.0,
+        drift_ppm: float = 0.0,
+        gain: float = 1.0,
+        seed: int | None = None,
+    ):
+        """
+        Args:
+            delay_s: Delay between the playback and the capture of a sound, in seconds.
+            noise: Standard deviation of the white noise added to the capture, in 16-bit sample units.
+            drift_ppm: Clock drift of the capture device relative to the playback device, in parts per million.
+            gain: Gain of the acoustic path.
+            seed: Seed of the noise generator.
+        """
+        if delay_s < 0:
+            raise ValueError("The delay cannot be negative")
+        self.delay_s = delay_s
+        self.noise = noise
+        self.drift_ppm = drift_ppm
+        self.gain = gain
+        # Microseconds between the ends of two capture buffers, on the capture clock
+        self.capture_buffer_us = CAPTURE_SAMPLES_PER_BUFFER * 1_000_000 // CAPTURE_SAMPLE_RATE
+
+        self._rng = np.random.default_rng(seed)
+        self._boot = time.perf_counter()
+        self._condition = threading.Condition()
+        self._closed = False
+        # Mono signal of the last triggering playback, the number of its valid samples and its sample rate
+        self._signal = np.zeros(0)
+        self._played = 0
+        self._play_rate = 0
+        self._finished = True
+        self._playbacks = 0
+        self._trigger_time = 0.0
+
+        self.playback = SimulatedPlaybackDevice(self)
+        self.capture = SimulatedCaptureDevice(self)
+
+    def devices(self) -> dict[int, UsbDevice]:
+        """Returns the simulated devices, keyed by their USB product IDs."""
+        return {
+            device.product_id: UsbDevice(device, device.ep_in, device.ep_out)
+            for device in (self.playback, self.capture)
+        }
+
+    def session(self) -> DeviceSession:
+        """Returns a session of the simulated devices, to be passed to `AudioController`."""
+        return DeviceSession(devices=self.devices())
+
+    def close(self):
+        """Stops the simulated devices."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.playback.close()
+        self.capture.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def now(self) -> float:
+        """Returns the time since the devices were started, in seconds."""
+        return time.perf_counter() - self._boot
+
+    def capture_clock_us(self, seconds: float) -> int:
+        """Converts a time to the clock of the capture device, in microseconds."""
+        return int(round(seconds * (1 + self.drift_ppm * 1e-6) * 1e6))
+
+    def start_playback(self, sample_rate: int, trigger: bool) -> float:
+        """Starts a playback, triggering the capture device if requested.
+
+        Only the triggering playbacks are heard by the capture device, with `play` and `finish_playback`.
+
+        Returns:
+            Start of the playback, in seconds.
+        """
+        start = self.now()
+        if not trigger:
+            return start
+        with self._condition:
+            self._signal = np.zeros(sample_rate)
+            self._played = 0
+            self._play_rate = sample_rate
+            self._finished = False
+            self._playbacks += 1
+            self._trigger_time = start
+            self._condition.notify_all()
+        return start
+
+    def play(self, samples: np.ndarray):
+        """Appends played samples to the signal of the triggering playback."""
+        with self._condition:
+            if self._finished:
+                return
+            if self._played + len(samples) > len(self._signal):
+                signal = np.zeros(max(2 * len(self._signal), self._played + len(samples)))
+                signal[: self._played] = self._signal[: self._played]
+                self._signal = signal
+            self._signal[self._played : self._played + len(samples)] = samples
+            self._played += len(samples)
+            self._condition.notify_all()
+
+    def finish_playback(self):
+        """Ends the signal of the triggering playback, the capture records silence after it."""
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+
+    def wait_trigger(self) -> tuple[float, int]:
+        """Waits for the next triggering playback.
+
+        Returns:
+            Time of the trigger in seconds and the number of the playback.
+        """
+        with self._condition:
+            playback = self._playbacks
+            self._condition.wait_for(lambda: self._closed or self._playbacks != playback)
+            if self._closed:
+                raise DeviceClosed()
+            return self._trigger_time, self._playbacks
+
+    def captured(self, first: int, count: int, playback: int | None) -> np.ndarray:
+        """Returns the samples recorded by the capture device, waiting until the playback produced them.
+
+        Args:
+            first: Index of the first sample since the trigger.
+            count: Number of samples.
+            playback: Number of the playback that triggered the capture, None records only noise.
+
+        Returns:
+            16-bit samples.
+        """
+        signal = np.zeros(count)
+        if playback is not None:
+            # The capture clock runs faster than the playback clock by the drift
+            times = (first + np.arange(count)) / (CAPTURE_SAMPLE_RATE * (1 + self.drift_ppm * 1e-6))
+            with self._condition:
+                positions = (times - self.delay_s) * self._play_rate
+                needed = int(math.ceil(positions[-1])) + 1 if count else 0
+                self._condition.wait_for(
+                    lambda: self._closed or self._finished or self._playbacks != playback or self._played > needed
+                )
+                if self._closed:
+                    raise DeviceClosed()
+                if self._playbacks == playback:
+                    signal = self.gain * _interpolate(self._signal[: self._played], positions)
+
+        signal += self._rng.normal(0, self.noise, count) if self.noise else 0
+        return np.clip(np.round(signal), -32768, 32767).astype(np.int16)
+
+
+def _interpolate(signal: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Linearly interpolates a signal at fractional sample positions, zero outside of it."""
+    index = np.floor(positions).astype(np.int64)
+    fraction = positions - index
+    valid = (index >= 0) & (index < len(signal) - 1)
+    result = np.zeros(len(positions))
+    result[valid] = signal[index[valid]] * (1 - fraction[valid]) + signal[index[valid] + 1] * fraction[valid]
+    return result
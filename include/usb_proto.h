@@ -12,7 +12,8 @@ typedef struct __attribute__((packed)) {
 	uint32_t channels_count;
 	uint32_t volume_multiplier;
 	uint32_t use_trigger;
-	uint32_t padding[10];
+	uint32_t stream;
+	uint32_t padding[9];
 } cfg_packet_t;
 
 typedef struct __attribute__((packed)) {
@@ -21,7 +22,45 @@ typedef struct __attribute__((packed)) {
 	uint32_t padding[14];
 } timestamp_packet_t;
 
+/* Sent by the capture device once it is configured, right before it waits for the trigger */
+typedef struct __attribute__((packed)) {
+	uint32_t id;
+	uint32_t padding[15];
+} ready_packet_t;
+
+#define STREAM_PACKET_SAMPLES	16
+
+/* Buffer of samples sent by the capture device while streaming, the end packet carries the number of sent buffers */
+typedef struct __attribute__((packed)) {
+	uint32_t id;
+	uint32_t sequence;
+	uint64_t timestamp;
+	int16_t samples[STREAM_PACKET_SAMPLES];
+	uint32_t padding[4];
+} stream_packet_t;
+
+#define STREAM_PACKET_TIMESTAMPS	7
+
+/* Timestamps of the buffers played by the playback device while streaming, the end packet carries the number of
+ * ring buffer underruns in count */
+typedef struct __attribute__((packed)) {
+	uint32_t id;
+	uint32_t count;
+	uint64_t timestamps[STREAM_PACKET_TIMESTAMPS];
+} stream_timestamps_packet_t;
+
+/* Sent by the host to end a stream */
+typedef struct __attribute__((packed)) {
+	uint32_t id;
+	uint32_t padding[15];
+} stop_packet_t;
+
 #define CFG_PACKET_MAGIC_HDR 		0x50534341
 #define TIMESTAMP_PACKET_MAGIC_HDR 	0x50534342
+#define READY_PACKET_MAGIC_HDR 		0x50534343
+#define STREAM_PACKET_MAGIC_HDR 	0x50534344
+#define STREAM_END_PACKET_MAGIC_HDR 	0x50534345
+#define STOP_PACKET_MAGIC_HDR 		0x50534346
+#define STREAM_TIMESTAMPS_MAGIC_HDR 	0x50534347
 
 #endif
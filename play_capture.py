@@ -1,8 +1,12 @@
-import audio_controller
 from pathlib import Path
 import argparse
+import contextlib
+import sys
 import time
-from multiprocessing import Process
+from threading import Event, Thread
+
+# Length of a streamed capture after the end of the played file, in seconds
+STREAM_CAPTURE_TAIL_S = 1.0
 
 
 def main():
@@ -15,13 +19,20 @@ def main():
     )
     parser.add_argument(
         "--timestamps-file-play",
-        default="timestamps_play.log",
-        help="File where timestamp values will be written (play)",
+        help="File where timestamp values will be written "
+        "(play, default: timestamps_play.bin, or .log in the text format)",
     )
     parser.add_argument(
         "--timestamps-file-capture",
-        default="timestamps_capture.log",
-        help="File where timestamp values will be written (capture)",
+        help="File where timestamp values will be written "
+        "(capture, default: timestamps_capture.bin, or .log in the text format)",
+    )
+    parser.add_argument(
+        "--timestamps-format",
+        choices=["binary", "text"],
+        default="binary",
+        help="Format of the timestamps logs: binary with a header per run, "
+        "or text with a timestamp per line (default: binary)",
     )
     parser.add_argument(
         "--volume-play",
@@ -39,41 +50,152 @@ def main():
         "--duration",
         default=None,
         type=float,
-        help="Length of the capture in seconds (default: max available length)",
+        help="Length of the capture in seconds (default: max available length, "
+        "or the length of the file and 1 s more with --stream)",
+    )
+    parser.add_argument(
+        "--threaded",
+        action="store_true",
+        help="Overlap the USB transfers with the WAV file reads and writes in separate threads",
+    )
+    parser.add_argument(
+        "--repeat",
+        default=1,
+        type=int,
+        help="Number of measurements run back to back, the recordings are numbered "
+        "when greater than 1, e.g. out_001.wav (default: 1)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream both the playback and the capture, without the length limits of the device memory",
+    )
+    parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="Run the measurements against simulated devices instead of the boards",
+    )
+    parser.add_argument(
+        "--simulated-delay",
+        default=0.1,
+        type=float,
+        help="Delay between the simulated playback and capture in seconds (default: 0.1)",
+    )
+    parser.add_argument(
+        "--simulated-noise",
+        default=50.0,
+        type=float,
+        help="Standard deviation of the noise added to the simulated capture (default: 50)",
+    )
+    parser.add_argument(
+        "--simulated-drift-ppm",
+        default=0.0,
+        type=float,
+        help="Clock drift of the simulated capture device in ppm (default: 0)",
     )
     args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    # Imported after parsing the arguments, so --help and usage errors do not wait for
+    # the USB and NumPy stacks.
+    import audio_controller
+    from timestamp_log import LOG_SUFFIXES
+
+    suffix = LOG_SUFFIXES[args.timestamps_format]
+    timestamps_file_play = args.timestamps_file_play or "timestamps_play" + suffix
+    timestamps_file_capture = args.timestamps_file_capture or "timestamps_capture" + suffix
+
+    duration = args.duration
+    if args.stream and duration is None:
+        from wav_reader import WavFormatError, open_wav
 
-    def run_player():
-        """ Initializes the audio playback controller with arguments provided by argparse
+        try:
+            wav_file = open_wav(args.file)
+        except (OSError, WavFormatError) as e:
+            sys.exit(f"Error: {e}")
+        # The capture goes on after the end of the playback, to receive the delayed sounds
+        duration = wav_file.frame_count / wav_file.sample_rate + STREAM_CAPTURE_TAIL_S
+
+    def run_player(run_id):
+        """ Plays the file with arguments provided by argparse
         """
-        ac = audio_controller.AudioController()
         ac.play_audio(
-            Path(args.file), Path(args.timestamps_file_play), volume=args.volume_play
+            Path(args.file),
+            Path(timestamps_file_play),
+            volume=args.volume_play,
+            threaded=args.threaded,
+            timestamps_format=args.timestamps_format,
+            run_id=run_id,
+            stream=args.stream,
         )
 
-    def run_recorder():
-        """ Initializes the audio record controller with arguments provided by argparse
+    def run_recorder(out_wav, run_id, armed, ready):
+        """ Records the audio with arguments provided by argparse, setting `armed` once the device waits for
+        the trigger and `ready` once it is armed or the recording failed
         """
-        ac = audio_controller.AudioController()
-        ac.start_recording(
-            args.out_wav,
-            Path(args.timestamps_file_capture),
-            volume=args.volume_play,
-            duration_s=args.duration,
-            use_trigger=1,
-        )
+        def on_ready():
+            armed.set()
+            ready.set()
+
+        try:
+            ac.start_recording(
+                out_wav,
+                Path(timestamps_file_capture),
+                volume=args.volume_play,
+                duration_s=duration,
+                use_trigger=1,
+                # A streamed capture is written as it arrives, --threaded only applies to the playback then
+                threaded=args.threaded and not args.stream,
+                on_ready=on_ready,
+                timestamps_format=args.timestamps_format,
+                run_id=run_id,
+                stream=args.stream,
+            )
+        finally:
+            ready.set()
+
+    # Both devices are opened once and reused by all the measurements. The USB transfers release the GIL,
+    # so the recorder runs in a thread of this process while the player runs in the main thread.
+    with contextlib.ExitStack() as resources:
+        if args.simulate:
+            from device_simulator import LoopbackSimulator
+
+            # Closed after the session, like the boards outlive it
+            simulator = resources.enter_context(LoopbackSimulator(
+                delay_s=args.simulated_delay,
+                noise=args.simulated_noise,
+                drift_ppm=args.simulated_drift_ppm,
+            ))
+            ac = audio_controller.AudioController(session=simulator.session())
+            session = ac.session
+        else:
+            ac = audio_controller.AudioController()
+            try:
+                session = ac.open_session()
+            except ValueError as e:
+                sys.exit(f"Error: {e}")
+        resources.enter_context(session)
 
-    recorder = Process(target=run_recorder)
-    recorder.start()
+        for index in range(args.repeat):
+            out_wav = Path(args.out_wav)
+            if args.repeat > 1:
+                out_wav = out_wav.with_name(f"{out_wav.stem}_{index + 1:03d}{out_wav.suffix}")
+            # Both logs identify the measurement with the same run ID
+            run_id = time.time_ns()
 
-    # The recorder needs to be configured and start waiting for trigger before the player is started.
-    time.sleep(2)
+            armed, ready = Event(), Event()
+            recorder = Thread(target=run_recorder, args=(out_wav, run_id, armed, ready))
+            recorder.start()
 
-    player = Process(target=run_player)
-    player.start()
+            # The player starts as soon as the capture device confirms it waits for the trigger
+            ready.wait()
+            if not armed.is_set():
+                print(f"Recorder failed before it was armed, skipping measurement {index + 1}")
+                continue
 
-    player.join()
-    recorder.join()
+            run_player(run_id)
+            recorder.join()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,34 @@
-import librosa
+import concurrent.futures
+import functools
+import itertools
 import numpy as np
-import soundfile as sf
+import os
+from pathlib import Path
+
+from automated_test.analysis_cache import AnalysisCache, file_digest
+from wav_reader import open_wav
+
+# Smallest window normalization applied in the overlap-add, as in librosa.istft
+TINY = np.finfo(np.float32).tiny
+
+def load_mono(wav_path, sampling_rate=None):
+    """
+    Loads an audio file as mono float samples, memory-mapping the file instead of decoding it
+
+    Args:
+        wav_path (str): Path to the WAV file
+        sampling_rate (int): Sampling rate to resample the audio to, None keeps the original rate
+
+    Returns:
+        Tuple[np.ndarray, int]: Samples scaled to [-1, 1) and their sampling rate
+    """
+    wav = open_wav(wav_path)
+    samples = wav.to_float(mono=True)
+
+    if sampling_rate is None or sampling_rate == wav.sample_rate:
+        return samples, wav.sample_rate
+    import librosa
+    return librosa.resample(samples, orig_sr=wav.sample_rate, target_sr=sampling_rate), sampling_rate
 
 def remove_background(input_wav, background_wav, output_wav):
     """
@@ -14,10 +42,13 @@ def remove_background(input_wav, background_wav, output_wav):
     Returns:
         None
     """
-     
+    # librosa and soundfile take long to load, they are only imported by the modes using them
+    import librosa
+    import soundfile as sf
+
     # Load audio files 
-    samples_input, sampling_rate_input = librosa.load(input_wav, sr=None, mono=True)
-    samples_background, sampling_rate_background = librosa.load(background_wav, sr=sampling_rate_input, mono=True)
+    samples_input, sampling_rate_input = load_mono(input_wav)
+    samples_background, sampling_rate_background = load_mono(background_wav, sampling_rate_input)
 
     # Short-time Fourier transform
     input_spectogram = librosa.stft(samples_input)
@@ -40,12 +71,462 @@ def remove_background(input_wav, background_wav, output_wav):
     sf.write(output_wav, y_clean, sampling_rate_input)
     print(f"Saved audio to {output_wav}")
 
-if __name__ == "__main__":
+def iter_blocks(wav_path, sampling_rate, block_size):
+    """
+    Reads an audio file block by block as mono float samples
+
+    Files with a different sampling rate are loaded and resampled at once, so they should be short.
+
+    Args:
+        wav_path (str): Path to the WAV file
+        sampling_rate (int): Sampling rate of the returned samples
+        block_size (int): Number of samples per block
+
+    Yields:
+        np.ndarray: Consecutive blocks of samples scaled to [-1, 1)
+    """
+    wav = open_wav(wav_path)
+    if wav.sample_rate != sampling_rate:
+        samples, _ = load_mono(wav_path, sampling_rate)
+        for start in range(0, len(samples), block_size):
+            yield samples[start:start + block_size]
+        return
+
+    for start in range(0, wav.frame_count, block_size):
+        yield wav.to_float(start, start + block_size, mono=True)
+
+def iter_frames(blocks, n_fft, hop_length):
+    """
+    Splits a stream of samples into the frames of a centered short-time Fourier transform
+
+    The stream is padded with n_fft // 2 zeros on both sides, as in librosa.stft.
+
+    Args:
+        blocks (Iterable[np.ndarray]): Consecutive blocks of samples
+        n_fft (int): Length of the frames
+        hop_length (int): Number of samples between the frames
+
+    Yields:
+        np.ndarray: Batches of consecutive frames, one per row
+    """
+    padding = np.zeros(n_fft // 2, dtype=np.float32)
+    buffer = padding
+    for block in itertools.chain(blocks, [padding]):
+        buffer = np.concatenate([buffer, block])
+        count = (len(buffer) - n_fft) // hop_length + 1
+        if count <= 0:
+            continue
+        yield np.lib.stride_tricks.sliding_window_view(buffer, n_fft)[::hop_length][:count]
+        buffer = buffer[count * hop_length:]
+
+def magnitudes(frames, window):
+    """
+    Computes the magnitude spectra of the frames
+
+    Args:
+        frames (np.ndarray): Frames, one per row
+        window (np.ndarray): Analysis window
+
+    Returns:
+        np.ndarray: Magnitude spectrum of each frame, one per row
+    """
+    return np.abs(np.fft.rfft(frames * window, axis=1))
+
+def noise_profile(blocks, n_fft, hop_length):
+    """
+    Computes the average magnitude spectrum of the background noise, reading it block by block
+
+    Args:
+        blocks (Iterable[np.ndarray]): Consecutive blocks of background samples
+        n_fft (int): Length of the frames
+        hop_length (int): Number of samples between the frames
+
+    Returns:
+        np.ndarray: Average magnitude of each frequency bin
+    """
+    window = np.hanning(n_fft + 1)[:-1]
+    total = np.zeros(n_fft // 2 + 1)
+    count = 0
+    for frames in iter_frames(blocks, n_fft, hop_length):
+        total += magnitudes(frames, window).sum(axis=0)
+        count += len(frames)
+    return total / max(count, 1)
+
+def iter_background_magnitudes(blocks, profile, n_fft, hop_length):
+    """
+    Yields the magnitude spectra of the background frames, then the fixed profile once the background ends
+
+    Args:
+        blocks (Iterable[np.ndarray]): Consecutive blocks of background samples
+        profile (np.ndarray): Average magnitude spectrum used after the end of the background
+        n_fft (int): Length of the frames
+        hop_length (int): Number of samples between the frames
+
+    Yields:
+        np.ndarray: Magnitude spectrum of each background frame
+    """
+    window = np.hanning(n_fft + 1)[:-1]
+    for frames in iter_frames(blocks, n_fft, hop_length):
+        yield from magnitudes(frames, window)
+    while True:
+        yield profile
+
+def subtract_streaming(blocks, background_magnitudes, length, n_fft=2048, hop_length=512):
+    """
+    Applies spectral subtraction to a stream of samples with overlap-add resynthesis
+
+    The frames are processed in batches as the samples arrive, only the overlapping tail of the
+    previous batch is kept in memory.
+
+    Args:
+        blocks (Iterable[np.ndarray]): Consecutive blocks of input samples
+        background_magnitudes (Iterator[np.ndarray]): Magnitude spectrum subtracted from each consecutive frame
+        length (int): Number of input samples
+        n_fft (int): Length of the frames
+        hop_length (int): Number of samples between the frames
+
+    Yields:
+        np.ndarray: Consecutive blocks of the cleaned samples, `length` samples in total
+    """
+    window = np.hanning(n_fft + 1)[:-1]
+    # Frames are zero-padded to a whole number of hops, so the overlap-add is a sum of shifted slices
+    hops_per_frame = -(-n_fft // hop_length)
+    frame_span = hops_per_frame * hop_length
+    window_squares = np.pad(window ** 2, (0, frame_span - n_fft))
+
+    # Overlapping tail of the previous batch and the sum of the squared windows over it
+    output = np.zeros(frame_span - hop_length)
+    normalization = np.zeros(frame_span - hop_length)
+    # The first n_fft // 2 output samples belong to the padding added before the input
+    skip = n_fft // 2
+    remaining = length
+
+    for frames in iter_frames(blocks, n_fft, hop_length):
+        count = len(frames)
+        spectrum = np.fft.rfft(frames * window, axis=1)
+        background = np.stack([next(background_magnitudes) for _ in range(count)])
+
+        # Subtract background magnitude, clamp the result to 0 to avoid negative values
+        mag_clean = np.maximum(np.abs(spectrum) - background, 0)
+        cleaned = np.fft.irfft(mag_clean * np.exp(1j * np.angle(spectrum)), n=n_fft, axis=1) * window
+        cleaned = np.pad(cleaned, ((0, 0), (0, frame_span - n_fft)))
+
+        done = count * hop_length
+        batch_output = np.concatenate([output, np.zeros(done)])
+        batch_normalization = np.concatenate([normalization, np.zeros(done)])
+        for hop in range(hops_per_frame):
+            start = hop * hop_length
+            batch_output[start:start + done] += cleaned[:, start:start + hop_length].reshape(-1)
+            batch_normalization[start:start + done] += np.tile(window_squares[start:start + hop_length], count)
+
+        # Samples before the start of the next frame are complete
+        finished = normalize(batch_output[:done], batch_normalization[:done])[skip:remaining + skip]
+        output, normalization = batch_output[done:], batch_normalization[done:]
+        skip = max(0, skip - done)
+        remaining -= len(finished)
+        if len(finished):
+            yield finished
+
+    if remaining > 0:
+        tail = normalize(output, normalization)[skip:skip + remaining]
+        yield np.concatenate([tail, np.zeros(remaining - len(tail))])
+
+def normalize(samples, normalization):
+    """
+    Divides overlap-added samples by the sum of the squared windows, where it is not negligible
+
+    Args:
+        samples (np.ndarray): Overlap-added samples
+        normalization (np.ndarray): Sum of the squared windows at each sample
+
+    Returns:
+        np.ndarray: Normalized samples
+    """
+    return np.where(normalization > TINY, samples / np.maximum(normalization, TINY), samples)
+
+def remove_background_streaming(input_wav, background_wav, output_wav, aligned=False, n_fft=2048, hop_length=512,
+                                block_frames=256):
+    """
+    Removes background noise from an audio file using spectral subtraction, processing it block by block
+
+    Memory usage does not depend on the length of the recordings, which do not need to have the same length.
+
+    Args:
+        input_wav (str): Path to the input audio file containing the signal + noise
+        background_wav (str): Path to an audio file containing only the background noise
+        output_wav (str): Path to save the output audio file with the background removed
+        aligned (bool): Whether to subtract the background frame by frame, like `remove_background`,
+                        rather than its average spectrum; the average is used after the end of the background
+        n_fft (int): Length of the STFT frames
+        hop_length (int): Number of samples between the STFT frames
+        block_frames (int): Number of STFT frames processed at once
+
+    Returns:
+        None
+    """
+    wav = open_wav(input_wav)
+    sampling_rate = wav.sample_rate
+    block_size = block_frames * hop_length
+
+    profile = noise_profile(iter_blocks(background_wav, sampling_rate, block_size), n_fft, hop_length)
+    if aligned:
+        background_magnitudes = iter_background_magnitudes(
+            iter_blocks(background_wav, sampling_rate, block_size), profile, n_fft, hop_length)
+    else:
+        background_magnitudes = itertools.repeat(profile)
+
+    clean_streaming(input_wav, output_wav, background_magnitudes, n_fft, hop_length, block_frames)
+
+def clean_streaming(input_wav, output_wav, background_magnitudes, n_fft=2048, hop_length=512, block_frames=256):
+    """
+    Applies spectral subtraction to an audio file block by block and saves the result
+
+    Args:
+        input_wav (str): Path to the input audio file containing the signal + noise
+        output_wav (str): Path to save the output audio file with the background removed
+        background_magnitudes (Iterator[np.ndarray]): Magnitude spectrum subtracted from each consecutive frame
+        n_fft (int): Length of the STFT frames
+        hop_length (int): Number of samples between the STFT frames
+        block_frames (int): Number of STFT frames processed at once
+
+    Returns:
+        None
+    """
+    import soundfile as sf
+
+    wav = open_wav(input_wav)
+    blocks = iter_blocks(input_wav, wav.sample_rate, block_frames * hop_length)
+    with sf.SoundFile(output_wav, "w", samplerate=wav.sample_rate, channels=1, subtype="PCM_16") as output:
+        for cleaned in subtract_streaming(blocks, background_magnitudes, wav.frame_count, n_fft, hop_length):
+            output.write(cleaned)
+    print(f"Saved audio to {output_wav}")
+
+def background_spectra(background_wav, sampling_rate, aligned, n_fft, hop_length, block_size, cache=None):
+    """
+    Computes the average magnitude spectrum of the background and, if needed, its magnitude spectrogram
+
+    The results are cached on disk, keyed by the content of the background file and the STFT parameters.
+
+    Args:
+        background_wav (str): Path to an audio file containing only the background noise
+        sampling_rate (int): Sampling rate of the processed inputs
+        aligned (bool): Whether the spectrogram is needed
+        n_fft (int): Length of the STFT frames
+        hop_length (int): Number of samples between the STFT frames
+        block_size (int): Number of samples read at once
+        cache (AnalysisCache): Cache of the spectra, None disables caching
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Average magnitude of each frequency bin and the magnitude spectrum
+        of each background frame, one per row, None unless `aligned` is set
+    """
+    settings = {"sampling_rate": sampling_rate, "n_fft": n_fft, "hop_length": hop_length, "window": "hann"}
+    if cache is not None:
+        digest = file_digest(background_wav)
+        profile_key = cache.key([digest], {**settings, "spectrum": "average"})
+        spectrogram_key = cache.key([digest], {**settings, "spectrum": "spectrogram"})
+        profile = cache.get_array(profile_key)
+        spectrogram = cache.get_array(spectrogram_key) if aligned else None
+        if profile is not None and (spectrogram is not None or not aligned):
+            print(f"Using cached spectrum of {background_wav}")
+            return profile, spectrogram
+
+    profile = noise_profile(iter_blocks(background_wav, sampling_rate, block_size), n_fft, hop_length)
+    spectrogram = None
+    if aligned:
+        window = np.hanning(n_fft + 1)[:-1]
+        spectrogram = np.concatenate([
+            magnitudes(frames, window).astype(np.float32)
+            for frames in iter_frames(iter_blocks(background_wav, sampling_rate, block_size), n_fft, hop_length)
+        ])
+
+    if cache is not None:
+        cache.put_array(profile_key, profile)
+        if aligned:
+            cache.put_array(spectrogram_key, spectrogram)
+    return profile, spectrogram
+
+def iter_spectra(profile, spectrogram=None):
+    """
+    Returns the background magnitude spectra subtracted from consecutive frames
+
+    Args:
+        profile (np.ndarray): Average magnitude of each frequency bin
+        spectrogram (np.ndarray): Magnitude spectrum of each background frame, subtracted before the average one,
+                                  None subtracts only the average
+
+    Returns:
+        Iterator[np.ndarray]: Magnitude spectrum subtracted from each consecutive frame
+    """
+    background_magnitudes = itertools.repeat(profile)
+    if spectrogram is not None:
+        background_magnitudes = itertools.chain(spectrogram, background_magnitudes)
+    return background_magnitudes
+
+def clean_samples(input_wav, background_magnitudes, n_fft=2048, hop_length=512, block_frames=256):
+    """
+    Applies spectral subtraction to an audio file block by block, keeping the result in memory
+
+    Args:
+        input_wav (str): Path to the input audio file containing the signal + noise
+        background_magnitudes (Iterator[np.ndarray]): Magnitude spectrum subtracted from each consecutive frame
+        n_fft (int): Length of the STFT frames
+        hop_length (int): Number of samples between the STFT frames
+        block_frames (int): Number of STFT frames processed at once
+
+    Returns:
+        Tuple[np.ndarray, int]: Cleaned mono samples and their sampling rate
+    """
+    wav = open_wav(input_wav)
+    blocks = iter_blocks(input_wav, wav.sample_rate, block_frames * hop_length)
+    cleaned = subtract_streaming(blocks, background_magnitudes, wav.frame_count, n_fft, hop_length)
+    return np.concatenate([np.zeros(0), *cleaned]), wav.sample_rate
+
+def save_samples(output_wav, samples, sampling_rate):
+    """
+    Saves cleaned samples as a 16-bit WAV file, like the other modes
+
+    Args:
+        output_wav (str): Path to save the output audio file
+        samples (np.ndarray): Mono samples in the [-1, 1) range
+        sampling_rate (int): Sampling rate of the samples
+    """
+    import soundfile as sf
+
+    sf.write(output_wav, samples, sampling_rate, subtype="PCM_16")
+    print(f"Saved audio to {output_wav}")
+
+# Background spectra shared with the worker processes, by sampling rate, set by `init_worker`
+_backgrounds = None
+
+def init_worker(backgrounds):
+    """
+    Shares the background spectra with the current (worker) process
+
+    Args:
+        backgrounds (dict): Average spectrum and spectrogram of the background for each sampling rate
+    """
+    global _backgrounds
+    _backgrounds = backgrounds
+
+def clean_with_background(input_wav, output_wav, n_fft, hop_length, block_frames):
+    """
+    Applies spectral subtraction to an audio file with the shared background spectra
+
+    Args:
+        input_wav (str): Path to the input audio file containing the signal + noise
+        output_wav (str): Path to save the output audio file with the background removed
+        n_fft (int): Length of the STFT frames
+        hop_length (int): Number of samples between the STFT frames
+        block_frames (int): Number of STFT frames processed at once
+    """
+    background_magnitudes = iter_spectra(*_backgrounds[open_wav(input_wav).sample_rate])
+    clean_streaming(input_wav, output_wav, background_magnitudes, n_fft, hop_length, block_frames)
+
+def remove_background_batch(input_wavs, background_wav, output_wavs, aligned=False, n_fft=2048, hop_length=512,
+                            block_frames=256, jobs=1, cache=None):
+    """
+    Removes the same background from many audio files, processing them in parallel
+
+    The background spectra are computed once for each sampling rate of the inputs, or read from the cache.
+
+    Args:
+        input_wavs (List[str]): Paths to the input audio files containing the signal + noise
+        background_wav (str): Path to an audio file containing only the background noise
+        output_wavs (List[str]): Paths to save the output audio files with the background removed
+        aligned (bool): Whether to subtract the background frame by frame while it lasts
+        n_fft (int): Length of the STFT frames
+        hop_length (int): Number of samples between the STFT frames
+        block_frames (int): Number of STFT frames processed at once
+        jobs (int): Number of worker processes, 0 uses all CPU cores
+        cache (AnalysisCache): Cache of the background spectra, None disables caching
+
+    Returns:
+        None
+    """
+    rates = {open_wav(input_wav).sample_rate for input_wav in input_wavs}
+    backgrounds = {
+        rate: background_spectra(background_wav, rate, aligned, n_fft, hop_length, block_frames * hop_length, cache)
+        for rate in rates
+    }
+
+    clean = functools.partial(clean_with_background, n_fft=n_fft, hop_length=hop_length, block_frames=block_frames)
+    jobs = jobs or os.cpu_count()
+    if jobs == 1 or len(input_wavs) == 1:
+        init_worker(backgrounds)
+        for input_wav, output_wav in zip(input_wavs, output_wavs):
+            clean(input_wav, output_wav)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(jobs, len(input_wavs)), initializer=init_worker, initargs=(backgrounds,)
+        ) as executor:
+            # Consume the results to surface the errors of the workers
+            list(executor.map(clean, input_wavs, output_wavs))
+
+def output_path(input_wav, output_dir, suffix):
+    """
+    Names the output file of an input in the batch mode
+
+    Args:
+        input_wav (str): Path to the input audio file
+        output_dir (str): Directory of the output files, None uses the directory of the input
+        suffix (str): Suffix appended to the input file name
+
+    Returns:
+        str: Path to the output file
+    """
+    path = Path(input_wav)
+    directory = Path(output_dir) if output_dir is not None else path.parent
+    return str(directory / f"{path.stem}{suffix}{path.suffix}")
+
+def main(argv=None):
+    """
+    Runs the command line interface
+
+    Args:
+        argv (List[str]): Command line arguments, None uses sys.argv
+    """
     import argparse
-    parser = argparse.ArgumentParser(description="Remove audio bleed from source speaker using spectral subtraction")
-    parser.add_argument("input", help="WAV file to be filtered")
-    parser.add_argument("reference", help="WAV file with only the bleeding audio")
-    parser.add_argument("output", help="Output WAV file with background removed")
-    
-    args = parser.parse_args()
-    remove_background(args.input, args.reference, args.output)
+    parser = argparse.ArgumentParser(
+        description="Remove audio bleed from source speaker using spectral subtraction",
+        usage="%(prog)s [options] input reference output\n"
+              "       %(prog)s [options] --background reference input [input ...]")
+    parser.add_argument("files", nargs="+", metavar="input reference output",
+                        help="WAV file to be filtered, WAV file with only the bleeding audio and output WAV file "
+                             "with background removed, or only the files to be filtered with --background")
+    parser.add_argument("--background", metavar="reference",
+                        help="Remove the bleeding audio of this WAV file from all the input files, in the streaming "
+                             "mode and in parallel, saving the results next to the inputs")
+    parser.add_argument("--suffix", default="-clean", help="Suffix of the output files of --background")
+    parser.add_argument("--output-dir", help="Directory of the output files of --background")
+    parser.add_argument("--jobs", "-j", type=int, default=0,
+                        help="Number of worker processes of --background, 0 uses all CPU cores")
+    parser.add_argument("--cache-dir", help="Directory of the background spectra cache "
+                                            "(default: ~/.cache/audio-latency-tester/analysis)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or update the background spectra cache")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Process the input block by block against the average background spectrum, "
+                             "with bounded memory usage and recordings of any length")
+    parser.add_argument("--aligned", action="store_true",
+                        help="In the streaming and --background modes, subtract the background frame by frame "
+                             "while it lasts")
+    parser.add_argument("--n-fft", type=int, default=2048,
+                        help="Length of the STFT frames in the streaming and --background modes")
+    parser.add_argument("--hop-length", type=int, default=512,
+                        help="Number of samples between the STFT frames in the streaming and --background modes")
+
+    args = parser.parse_args(argv)
+    if args.background is not None:
+        cache = None if args.no_cache else AnalysisCache(args.cache_dir)
+        outputs = [output_path(input_wav, args.output_dir, args.suffix) for input_wav in args.files]
+        remove_background_batch(args.files, args.background, outputs, args.aligned, args.n_fft, args.hop_length,
+                                jobs=args.jobs, cache=cache)
+    elif len(args.files) != 3:
+        parser.error("provide an input, a reference and an output file, or use --background")
+    elif args.streaming:
+        remove_background_streaming(*args.files, args.aligned, args.n_fft, args.hop_length)
+    else:
+        remove_background(*args.files)
+
+if __name__ == "__main__":
+    main()
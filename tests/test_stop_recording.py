@@ -0,0 +1,59 @@
+"""Stopping the streaming recordings of `AudioController`, against the simulated devices."""
+
+from pathlib import Path
+
+import sys
+import threading
+import wave
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from audio_controller import AudioController  # noqa: E402
+from device_simulator import LoopbackSimulator  # noqa: E402
+
+SAMPLE_RATE = 16000
+DURATION_S = 0.5
+
+
+def frame_count(path):
+    with wave.open(str(path), "rb") as wav:
+        return wav.getnframes()
+
+
+def record_stream(controller, path, duration_s=DURATION_S):
+    controller.start_recording(path, path.with_suffix(".bin"), duration_s=duration_s, stream=True)
+    return frame_count(path)
+
+
+def test_stale_stop_is_ignored(tmp_path):
+    with LoopbackSimulator(seed=0) as simulator:
+        controller = AudioController(session=simulator.session())
+
+        # Before any stream
+        controller.stop_recording()
+        assert record_stream(controller, tmp_path / "first.wav") >= DURATION_S * SAMPLE_RATE
+
+        # After a stream ended by its duration, and during a regular recording
+        controller.stop_recording()
+        controller.start_recording(tmp_path / "regular.wav", tmp_path / "regular.bin", duration_s=DURATION_S)
+        controller.stop_recording()
+        assert record_stream(controller, tmp_path / "second.wav") >= DURATION_S * SAMPLE_RATE
+
+
+def test_stop_ends_open_ended_stream(tmp_path):
+    with LoopbackSimulator(seed=0) as simulator:
+        controller = AudioController(session=simulator.session())
+        started = threading.Event()
+
+        recorder = threading.Thread(
+            target=controller.start_recording,
+            args=(tmp_path / "stream.wav", tmp_path / "stream.bin"),
+            kwargs={"on_ready": started.set, "stream": True},
+        )
+        recorder.start()
+        assert started.wait(5)
+        controller.stop_recording()
+        recorder.join(10)
+
+        assert not recorder.is_alive()
+        assert frame_count(tmp_path / "stream.wav") > 0
@@ -0,0 +1,135 @@
+"""Binary logs of the buffer timestamps reported by the playback and capture devices."""
+
+from dataclasses import dataclass
+from pathlib import Path
+
+import argparse
+import numpy as np
+import struct
+
+TIMESTAMP_LOG_MAGIC = b"ALTT"
+TIMESTAMP_LOG_VERSION = 1
+# Magic, version, USB product ID of the device, run ID, sample rate, samples per buffer and number of timestamps
+RUN_HEADER = struct.Struct("<4sHHQIIQ")
+# Microseconds since the boot of the device, as sent over USB
+TIMESTAMP_DTYPE = np.dtype("<u8")
+
+# Formats of the timestamp logs and the suffixes of their default file names
+BINARY = "binary"
+TEXT = "text"
+LOG_SUFFIXES = {BINARY: ".bin", TEXT: ".log"}
+
+
+class TimestampLogError(ValueError):
+    """Raised when a file is not a valid binary timestamp log."""
+
+
+@dataclass
+class TimestampRun:
+    """Timestamps of the audio buffers of a single playback or capture run."""
+
+    device: int
+    run_id: int
+    sample_rate: int
+    samples_per_buffer: int
+    timestamps: np.ndarray
+
+
+def decode_timestamps(raw, count: int) -> np.ndarray:
+    """Converts the timestamp packets received from a device into an array.
+
+    Args:
+        raw: Buffer with the timestamp packets, the last one padded.
+        count: Number of timestamps sent by the device.
+
+    Returns:
+        Timestamps in microseconds, a view of `raw`.
+    """
+    return np.frombuffer(raw, dtype=TIMESTAMP_DTYPE, count=count)
+
+
+def append_run(path, run: TimestampRun, log_format: str = BINARY):
+    """Appends the timestamps of a run to a log.
+
+    In the binary format each run starts with a header, so the runs appended to the same file stay
+    separated. The text format has a timestamp per line, without the run boundaries.
+
+    Args:
+        path: Path to the log file.
+        run: Timestamps of the run.
+        log_format: Format of the log, either "binary" or "text".
+    """
+    if log_format == TEXT:
+        with open(path, "a") as f:
+            f.writelines(f"{timestamp}\n" for timestamp in run.timestamps.tolist())
+        return
+
+    header = RUN_HEADER.pack(
+        TIMESTAMP_LOG_MAGIC,
+        TIMESTAMP_LOG_VERSION,
+        run.device,
+        run.run_id,
+        run.sample_rate,
+        run.samples_per_buffer,
+        len(run.timestamps),
+    )
+    with open(path, "ab") as f:
+        f.write(header)
+        f.write(np.asarray(run.timestamps, dtype=TIMESTAMP_DTYPE).tobytes())
+
+
+def read_log(path) -> list[TimestampRun]:
+    """Reads all the runs stored in a binary timestamp log.
+
+    Args:
+        path: Path to the log file.
+
+    Returns:
+        Runs in the order they were appended, their timestamps are views of the file contents.
+    """
+    path = Path(path)
+    data = path.read_bytes()
+    runs = []
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < RUN_HEADER.size:
+            raise TimestampLogError(f"{path}: truncated run header at byte {offset}")
+        magic, version, device, run_id, sample_rate, samples_per_buffer, count = (
+            RUN_HEADER.unpack_from(data, offset)
+        )
+        if magic != TIMESTAMP_LOG_MAGIC:
+            raise TimestampLogError(f"{path}: no run header at byte {offset}")
+        if version != TIMESTAMP_LOG_VERSION:
+            raise TimestampLogError(f"{path}: unsupported version {version}")
+
+        offset += RUN_HEADER.size
+        if len(data) - offset < count * TIMESTAMP_DTYPE.itemsize:
+            raise TimestampLogError(f"{path}: truncated run {run_id}")
+        timestamps = np.frombuffer(data, dtype=TIMESTAMP_DTYPE, count=count, offset=offset)
+        runs.append(TimestampRun(device, run_id, sample_rate, samples_per_buffer, timestamps))
+        offset += count * TIMESTAMP_DTYPE.itemsize
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a binary timestamp log as text")
+    parser.add_argument("file", help="Binary timestamp log")
+    parser.add_argument(
+        "--no-headers",
+        action="store_true",
+        help="Print only the timestamps, in the text log format",
+    )
+    args = parser.parse_args()
+
+    for run in read_log(args.file):
+        if not args.no_headers:
+            print(
+                f"# run {run.run_id}, device {run.device:#06x}, {run.sample_rate} Hz, "
+                f"{run.samples_per_buffer} samples per buffer, {len(run.timestamps)} timestamps"
+            )
+        for timestamp in run.timestamps.tolist():
+            print(timestamp)
+
+
+if __name__ == "__main__":
+    main()
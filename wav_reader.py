@@ -0,0 +1,201 @@
+"""Memory-mapped reader for PCM WAV files."""
+
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+
+import numpy as np
+import struct
+import wave
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Sample types of the supported formats, indexed by (format tag, sample width)
+SAMPLE_DTYPES = {
+    (WAVE_FORMAT_PCM, 1): np.dtype(np.uint8),
+    (WAVE_FORMAT_PCM, 2): np.dtype("<i2"),
+    (WAVE_FORMAT_PCM, 4): np.dtype("<i4"),
+    (WAVE_FORMAT_IEEE_FLOAT, 4): np.dtype("<f4"),
+    (WAVE_FORMAT_IEEE_FLOAT, 8): np.dtype("<f8"),
+}
+
+
+class WavFormatError(wave.Error):
+    """Raised when a file is not a supported WAV file."""
+
+
+def decode_pcm(raw, sample_width: int, format_tag: int = WAVE_FORMAT_PCM) -> np.ndarray:
+    """Converts raw little-endian sample data into a NumPy array.
+
+    Args:
+        raw: Buffer with the raw sample data.
+        sample_width: Number of bytes per sample.
+        format_tag: WAV format of the samples.
+
+    Returns:
+        Decoded samples, a view of `raw` unless the samples are 24-bit.
+    """
+    if format_tag == WAVE_FORMAT_PCM and sample_width == 3:
+        # Sign-extend little-endian 24-bit samples to 32 bits
+        raw = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples -= (samples & 0x800000) << 1
+        return samples
+
+    try:
+        dtype = SAMPLE_DTYPES[(format_tag, sample_width)]
+    except KeyError:
+        raise WavFormatError(
+            f"Unsupported sample format {format_tag:#x} with {sample_width} bytes per sample"
+        )
+    return np.frombuffer(raw, dtype=dtype)
+
+
+@dataclass
+class WavFile:
+    """WAV file with the sample data exposed as a read-only memory map.
+
+    Only the header is parsed when the file is opened, the samples are paged in from
+    the file when they are accessed.
+    """
+
+    path: Path
+    format_tag: int
+    channels: int
+    sample_rate: int
+    sample_width: int
+    data_offset: int
+    frame_count: int
+
+    @property
+    def frame_size(self) -> int:
+        """Number of bytes in a single frame."""
+        return self.channels * self.sample_width
+
+    @property
+    def duration(self) -> float:
+        """Length of the recording in seconds."""
+        return self.frame_count / self.sample_rate
+
+    @cached_property
+    def raw(self) -> np.ndarray:
+        """Sample data as a flat array of bytes."""
+        size = self.frame_count * self.frame_size
+        if size == 0:
+            return np.empty(0, dtype=np.uint8)
+        return np.memmap(
+            self.path, dtype=np.uint8, mode="r", offset=self.data_offset, shape=(size,)
+        )
+
+    @property
+    def frames(self) -> np.ndarray:
+        """Samples with one row per frame and one column per channel.
+
+        24-bit samples cannot be viewed directly, use `samples` to decode them.
+        """
+        if self.sample_width == 3:
+            raise WavFormatError("24-bit samples have no memory-mapped view, use samples()")
+        return decode_pcm(self.raw, self.sample_width, self.format_tag).reshape(
+            -1, self.channels
+        )
+
+    def samples(self, start: int = 0, stop: int | None = None) -> np.ndarray:
+        """Returns the frames from `start` to `stop`, decoding 24-bit samples to 32 bits.
+
+        Args:
+            start: First frame to return.
+            stop: Frame after the last one to return, None reads until the end of the file.
+
+        Returns:
+            Samples with one row per frame, a view of the file unless the samples are 24-bit.
+        """
+        start, stop, _ = slice(start, stop).indices(self.frame_count)
+        stop = max(start, stop)
+        raw = self.raw[start * self.frame_size : stop * self.frame_size]
+        return decode_pcm(raw, self.sample_width, self.format_tag).reshape(
+            -1, self.channels
+        )
+
+    def to_float(
+        self, start: int = 0, stop: int | None = None, mono: bool = False
+    ) -> np.ndarray:
+        """Returns the frames from `start` to `stop` scaled to the [-1, 1) range.
+
+        Args:
+            start: First frame to return.
+            stop: Frame after the last one to return, None reads until the end of the file.
+            mono: Whether to average the channels.
+
+        Returns:
+            float32 samples with one row per frame, or a flat array if `mono` is set.
+        """
+        samples = self.samples(start, stop)
+        if self.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+            scaled = samples.astype(np.float32)
+        elif self.sample_width == 1:
+            scaled = (samples.astype(np.float32) - 128) / 128
+        else:
+            scaled = samples.astype(np.float32) / float(1 << (8 * self.sample_width - 1))
+        return scaled.mean(axis=1) if mono else scaled
+
+
+def open_wav(path) -> WavFile:
+    """Parses the header of a WAV file and locates its sample data.
+
+    Args:
+        path: Path to the WAV file.
+
+    Returns:
+        WavFile describing the file.
+    """
+    path = Path(path)
+    file_size = path.stat().st_size
+    fmt = None
+
+    with open(path, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WAVE":
+            raise WavFormatError(f"{path} is not a RIFF WAVE file")
+
+        while header := f.read(8):
+            if len(header) < 8:
+                break
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                f.seek(chunk_size % 2, 1)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise WavFormatError(f"{path}: data chunk precedes the fmt chunk")
+                format_tag, channels, sample_rate, _, _, bits = struct.unpack(
+                    "<HHIIHH", fmt[:16]
+                )
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    # The format is stored in the first two bytes of the sub-format GUID
+                    format_tag = struct.unpack("<H", fmt[24:26])[0]
+                sample_width = (bits + 7) // 8
+
+                if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+                    raise WavFormatError(f"{path}: unsupported format {format_tag:#x}")
+                if channels == 0 or sample_width == 0:
+                    raise WavFormatError(f"{path}: invalid fmt chunk")
+
+                # Recorders that were interrupted may leave the chunk size unset
+                data_offset = f.tell()
+                data_size = min(chunk_size, file_size - data_offset)
+                return WavFile(
+                    path=path,
+                    format_tag=format_tag,
+                    channels=channels,
+                    sample_rate=sample_rate,
+                    sample_width=sample_width,
+                    data_offset=data_offset,
+                    frame_count=data_size // (channels * sample_width),
+                )
+            else:
+                f.seek(chunk_size + chunk_size % 2, 1)
+
+    raise WavFormatError(f"{path}: no data chunk found")